@@ -0,0 +1,450 @@
+"""Load test of FileUploadScanMiddleware and scan_upload on an in-process FastAPI app.
+
+Drives the app straight through ASGI, without a server or an HTTP client,
+with multipart uploads from a traffic mix, and compares the scanning
+configurations side by side with an app that does not scan at all:
+
+    - requests/s, and p50/p95/p99 latency from the first body chunk to the end of the response
+    - peak RSS of the process, each case running in a fresh interpreter
+    - bytes per request handed to the engine, from the hiss_scanned_bytes metric
+    - bytes per request through read()/write() system calls, from /proc/self/io (Linux only)
+
+The last column is system call I/O, not every copy: socket send()/recv(),
+e.g. to clamd, and copies within the heap (parser slices, in-memory spools,
+replaying the body to the app) are not counted. Uploads that fit in memory
+therefore show close to 0 there; it mostly tracks spooling large bodies to
+disk and reading them back, and piping to clamscan.
+
+Runs offline by default against hiss.testing.FakeClamd, started by this
+process so that the copies clamd makes are not counted against hiss.
+
+    python benchmarks/asgi.py
+    python benchmarks/asgi.py --mixes many large --configs unscanned middleware decorator --concurrency 1 16
+    python benchmarks/asgi.py --engine clamscan --output results.json
+    python benchmarks/asgi.py --baseline results.json --tolerance 0.2
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from typing import Callable, List, NamedTuple
+
+import report
+from fastapi import FastAPI, File, UploadFile
+
+from hiss import metrics
+from hiss.cache import VerdictCache
+from hiss.engines import ClamdEngine, ClamscanEngine, Engine
+from hiss.fastapi.decorators import scan_upload
+from hiss.fastapi.middleware import FileUploadScanMiddleware
+from hiss.options import ClamdOptions
+from hiss.scanner import ScanScheduler, Scanner
+from hiss.testing import EICAR, FakeClamd, fake_clamscan
+
+BOUNDARY = "hiss-load-test-boundary"
+# Body chunks the server is handed, about what an ASGI server reads from a socket
+CHUNK_SIZE = 64 * 1024
+COLUMNS = (
+    "case",
+    "requests",
+    "rejected",
+    "busy",
+    "failed",
+    "requests_per_s",
+    "slowdown",
+    "p50_ms",
+    "p95_ms",
+    "p99_ms",
+    "peak_rss_mib",
+    "engine_kib_per_request",
+    "io_kib_per_request",
+)
+
+
+class Upload(NamedTuple):
+    """The files of one request, as (size, infected) pairs."""
+
+    files: tuple[tuple[int, bool], ...]
+
+
+# Traffic mixes, as (weight, upload) pairs
+MIXES: dict[str, list[tuple[float, Upload]]] = {
+    "small": [(1, Upload(((16 * 1024, False),)))],
+    "many": [(1, Upload(((8 * 1024, False),) * 25))],
+    "large": [(1, Upload(((32 * 1024 * 1024, False),)))],
+    "infected": [(1, Upload(((16 * 1024, True),)))],
+    "realistic": [
+        (70, Upload(((16 * 1024, False),))),
+        (15, Upload(((8 * 1024, False),) * 25)),
+        (5, Upload(((32 * 1024 * 1024, False),))),
+        (10, Upload(((16 * 1024, True),))),
+    ],
+}
+DEFAULT_MIXES = ("small", "many", "large", "infected")
+# The scanning set up of the app, "-cache" adding a VerdictCache to the scanner
+CONFIGS = (
+    "unscanned",
+    "middleware",
+    "decorator",
+    "middleware-cache",
+    "decorator-cache",
+)
+DEFAULT_CONFIGS = ("unscanned", "middleware", "decorator")
+
+
+def build_app(config: str, scanner: Scanner) -> Callable:
+    """Returns the FastAPI app of a configuration, with an /upload endpoint reading every file."""
+    app = FastAPI()
+    decorated = config.startswith("decorator")
+
+    async def upload(files: List[UploadFile] = File(...)):
+        return {"sizes": [len(await file.read()) for file in files]}
+
+    if decorated:
+        upload = scan_upload(scanner=scanner)(upload)
+    app.post("/upload")(upload)
+    if config.startswith("middleware"):
+        app.add_middleware(FileUploadScanMiddleware, scanner=scanner)
+    return app
+
+
+def multipart_body(upload: Upload, seed: int) -> bytes:
+    """Builds the multipart/form-data body of an upload, the same on every run."""
+    rng = random.Random(seed)
+    parts = []
+    for index, (size, infected) in enumerate(upload.files):
+        content = rng.randbytes(size - len(EICAR) if infected else size)
+        if infected:
+            content += EICAR
+        parts.append(
+            f"--{BOUNDARY}\r\n"
+            f'Content-Disposition: form-data; name="files"; filename="{index}.bin"\r\n'
+            "Content-Type: application/octet-stream\r\n\r\n".encode()
+            + content
+            + b"\r\n"
+        )
+    parts.append(f"--{BOUNDARY}--\r\n".encode())
+    return b"".join(parts)
+
+
+def body_messages(body: bytes) -> list[dict]:
+    """Splits a body into the http.request messages a server would hand the app."""
+    chunks = [body[i : i + CHUNK_SIZE] for i in range(0, len(body), CHUNK_SIZE)]
+    return [
+        {"type": "http.request", "body": chunk, "more_body": index < len(chunks) - 1}
+        for index, chunk in enumerate(chunks)
+    ]
+
+
+async def request(
+    app: Callable, messages: list[dict], length: int
+) -> tuple[int, float]:
+    """Sends one upload through the app, returns the status and the latency in seconds."""
+    pending = iter(messages)
+    done = asyncio.Event()
+    status = 0
+
+    async def receive():
+        message = next(pending, None)
+        if message is None:
+            # Like a server, report the disconnect only once the response went out
+            await done.wait()
+            return {"type": "http.disconnect"}
+        return dict(message)
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body" and not message.get(
+            "more_body", False
+        ):
+            done.set()
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": "/upload",
+        "raw_path": b"/upload",
+        "query_string": b"",
+        "root_path": "",
+        "headers": [
+            (b"content-type", f"multipart/form-data; boundary={BOUNDARY}".encode()),
+            (b"content-length", str(length).encode()),
+        ],
+        "client": ("127.0.0.1", 50000),
+        "server": ("127.0.0.1", 8000),
+    }
+    started = time.perf_counter()
+    await app(scope, receive, send)
+    done.set()
+    return status, time.perf_counter() - started
+
+
+def syscall_io_bytes() -> int | None:
+    """Bytes this process passed through read() and write() system calls so far, None if the platform does not tell."""
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+    except OSError:
+        return None
+    return int(counters["rchar"]) + int(counters["wchar"])
+
+
+def peak_rss() -> float:
+    """Peak resident memory of this process in MiB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, KiB elsewhere
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def open_engine(args: argparse.Namespace) -> Engine:
+    if args.engine == "clamscan":
+        return ClamscanEngine([args.clamscan])
+    return ClamdEngine(ClamdOptions(socket_path=args.clamd_socket, pool_size=8))
+
+
+async def run_case(args: argparse.Namespace) -> dict:
+    """Runs one configuration against one mix, in this process."""
+    scanner = Scanner(
+        engine=open_engine(args),
+        scheduler=ScanScheduler(args.scan_slots, max_queue=args.scan_queue),
+        cache=VerdictCache() if args.config.endswith("-cache") else None,
+    )
+    app = build_app(args.config, scanner)
+    rng = random.Random(0)
+    weights, uploads = zip(*MIXES[args.mix])
+    shapes = []
+    for seed, upload in enumerate(uploads):
+        body = multipart_body(upload, seed)
+        shapes.append((body_messages(body), len(body)))
+    average = sum(w * length for w, (_, length) in zip(weights, shapes)) / sum(weights)
+    total = max(args.concurrency, min(args.requests, int(args.max_bytes // average)))
+    plan = rng.choices(range(len(shapes)), weights, k=total)
+
+    # Warm up: imports, engine connections, the page cache
+    for shape in set(plan):
+        await request(app, *shapes[shape])
+    latencies: list[float] = []
+    statuses: dict[int, int] = {}
+    # Counts the bytes every scan hands to the engine
+    metrics.registry.enable()
+    scanned_before = metrics.SCANNED_BYTES.value(backend=scanner.engine.name)
+    io_before = syscall_io_bytes()
+
+    async def client():
+        while plan:
+            status, latency = await request(app, *shapes[plan.pop()])
+            latencies.append(latency)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+    io_after = syscall_io_bytes()
+    scanned = metrics.SCANNED_BYTES.value(backend=scanner.engine.name) - scanned_before
+    await scanner.close()
+    return {
+        "requests": len(latencies),
+        "rejected": statuses.get(400, 0),
+        "busy": statuses.get(503, 0) + statuses.get(429, 0),
+        "failed": sum(
+            count
+            for status, count in statuses.items()
+            if status not in (200, 400, 429, 503)
+        ),
+        "requests_per_s": len(latencies) / elapsed,
+        **report.latency_summary(latencies),
+        "peak_rss_mib": peak_rss(),
+        "engine_kib_per_request": scanned / len(latencies) / 1024,
+        "io_kib_per_request": (io_after - io_before) / len(latencies) / 1024
+        if io_before is not None
+        else None,
+    }
+
+
+async def run(args: argparse.Namespace) -> list[dict]:
+    """Runs every case in a fresh interpreter, so each one gets its own peak RSS."""
+    results = []
+    with tempfile.TemporaryDirectory(prefix="hiss-load-") as directory:
+        clamd = None
+        if args.engine == "clamscan" and args.clamscan is None:
+            args.clamscan = fake_clamscan(directory)
+        elif args.engine == "clamd" and args.clamd_socket is None:
+            args.clamd_socket = os.path.join(directory, "clamd.sock")
+            clamd = FakeClamd(args.clamd_socket, latency=args.clamd_latency)
+            await clamd.start()
+        try:
+            for mix in args.mixes:
+                for concurrency in args.concurrency:
+                    for config in args.configs:
+                        case = f"{mix}/c{concurrency}/{config}"
+                        row = await _run_child(args, mix, concurrency, config)
+                        results.append(
+                            {
+                                "case": case,
+                                "mix": mix,
+                                "concurrency": concurrency,
+                                "config": config,
+                                **row,
+                            }
+                        )
+                        print(
+                            f"{case}: {row['requests_per_s']:.1f} requests/s,"
+                            f" p95 {row['p95_ms']:.1f} ms",
+                            file=sys.stderr,
+                        )
+        finally:
+            if clamd is not None:
+                await clamd.stop()
+    _add_slowdown(results)
+    return results
+
+
+async def _run_child(
+    args: argparse.Namespace, mix: str, concurrency: int, config: str
+) -> dict:
+    command = [
+        sys.executable,
+        os.path.abspath(__file__),
+        "--case",
+        "--mixes",
+        mix,
+        "--concurrency",
+        str(concurrency),
+        "--configs",
+        config,
+        "--engine",
+        args.engine,
+        "--requests",
+        str(args.requests),
+        "--max-bytes",
+        str(args.max_bytes),
+        "--scan-slots",
+        str(args.scan_slots),
+        "--scan-queue",
+        str(args.scan_queue),
+    ]
+    if args.clamscan:
+        command += ["--clamscan", args.clamscan]
+    if args.clamd_socket:
+        command += ["--clamd-socket", args.clamd_socket]
+    process = await asyncio.create_subprocess_exec(
+        *command, stdout=asyncio.subprocess.PIPE
+    )
+    stdout, _ = await process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError(f"{mix}/c{concurrency}/{config} failed")
+    return json.loads(stdout)
+
+
+def _add_slowdown(results: list[dict]) -> None:
+    """Adds how many times fewer requests/s each case served than the unscanned app on the same load."""
+    unscanned = {
+        (row["mix"], row["concurrency"]): row["requests_per_s"]
+        for row in results
+        if row["config"] == "unscanned"
+    }
+    for row in results:
+        baseline = unscanned.get((row["mix"], row["concurrency"]))
+        if baseline is not None:
+            row["slowdown"] = baseline / row["requests_per_s"]
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--mixes", nargs="+", choices=list(MIXES), default=list(DEFAULT_MIXES)
+    )
+    parser.add_argument(
+        "--configs", nargs="+", choices=CONFIGS, default=list(DEFAULT_CONFIGS)
+    )
+    parser.add_argument(
+        "--concurrency",
+        nargs="+",
+        type=int,
+        default=[1, 8],
+        help="Requests in flight at once",
+    )
+    parser.add_argument(
+        "--requests", type=int, default=200, help="Requests per case, at most"
+    )
+    parser.add_argument(
+        "--max-bytes",
+        type=report.parse_size,
+        default=report.parse_size("1GiB"),
+        help="Bytes uploaded per case, at most, which lowers --requests for large mixes",
+    )
+    parser.add_argument("--engine", choices=("clamd", "clamscan"), default="clamd")
+    parser.add_argument("--clamscan", help="clamscan binary (default: a stub)")
+    parser.add_argument("--clamd-socket", help="clamd socket (default: FakeClamd)")
+    parser.add_argument(
+        "--clamd-latency",
+        type=float,
+        default=0,
+        help="Seconds FakeClamd adds to every scan",
+    )
+    parser.add_argument(
+        "--scan-slots", type=int, default=8, help="Scans running at once"
+    )
+    parser.add_argument(
+        "--scan-queue", type=int, default=64, help="Scans waiting for a slot"
+    )
+    parser.add_argument("--output", help="Save the results as JSON")
+    parser.add_argument("--baseline", help="Compare with results saved by --output")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Fraction a metric may get worse than the baseline (default: 0.2)",
+    )
+    parser.add_argument("--case", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    # A log line per file would be a large part of what is measured
+    logging.disable(logging.CRITICAL)
+
+    if args.case:
+        args.mix, args.concurrency, args.config = (
+            args.mixes[0],
+            args.concurrency[0],
+            args.configs[0],
+        )
+        print(json.dumps(asyncio.run(run_case(args))))
+        return 0
+
+    results = asyncio.run(run(args))
+    print()
+    report.print_table(results, COLUMNS)
+    if args.output:
+        report.save(args.output, results)
+    if args.baseline:
+        regressions = report.compare(
+            results,
+            report.load(args.baseline),
+            higher_is_better=("requests_per_s",),
+            lower_is_better=(
+                "p95_ms",
+                "peak_rss_mib",
+                "engine_kib_per_request",
+                "io_kib_per_request",
+            ),
+            tolerance=args.tolerance,
+        )
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,249 @@
+"""Micro-benchmarks of Scanner.scan_file across engine backends, file sizes and concurrency levels.
+
+Runs offline by default: clamscan is a stub that only looks for EICAR and
+clamd is hiss.testing.FakeClamd, so the numbers measure hiss itself (process
+spawning, piping, the clamd protocol, descriptor passing, scheduling) rather
+than signature matching. Point --clamscan and --clamd-socket at the real
+thing to benchmark ClamAV too, and pass --libclamav-database to include the
+in-process backend, which always needs a real database.
+
+    python benchmarks/engines.py
+    python benchmarks/engines.py --backends clamd clamd-instream --sizes 1KiB 1MiB 1GiB --concurrency 1 16
+    python benchmarks/engines.py --output results.json
+    python benchmarks/engines.py --baseline results.json --tolerance 0.2
+
+With --baseline, the run fails when the throughput of a case fell, or its
+p95 latency rose, by more than the tolerance, so CI can track regressions.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+import report
+
+from hiss.engines import ClamdEngine, ClamscanEngine, Engine, Verdict
+from hiss.options import ClamdOptions, ScannerOptions
+from hiss.scanner import ScanScheduler, Scanner
+from hiss.testing import FakeClamd, fake_clamscan
+
+BACKENDS = ("clamscan", "clamd", "clamd-instream", "libclamav")
+DEFAULT_BACKENDS = ("clamscan", "clamd", "clamd-instream")
+DEFAULT_SIZES = ("1KiB", "64KiB", "1MiB", "16MiB")
+DEFAULT_CONCURRENCY = (1, 4)
+COLUMNS = (
+    "case",
+    "scans",
+    "errors",
+    "scans_per_s",
+    "mib_per_s",
+    "p50_ms",
+    "p95_ms",
+    "p99_ms",
+    "max_ms",
+)
+BLOCK_SIZE = 1024 * 1024
+
+
+def write_sample(directory: str, size: int) -> str:
+    """Writes a clean file of `size` bytes, the same on every run, and returns its path."""
+    path = os.path.join(directory, f"sample-{size}")
+    block = random.Random(size).randbytes(min(size, BLOCK_SIZE))
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining:
+            remaining -= f.write(block[:remaining])
+    return path
+
+
+async def bench_case(
+    engine: Engine, path: str, size: int, concurrency: int, scans: int
+) -> dict:
+    """Scans the file at `path` `scans` times, `concurrency` at a time, and summarizes the run."""
+    scanner = Scanner(
+        engine=engine,
+        scheduler=ScanScheduler(concurrency, max_queue=concurrency),
+        scan_timeout=None,
+    )
+    # Warm up: spawn paths, connection pools, page cache
+    await scanner.scan(path)
+    latencies: list[float] = []
+    errors = 0
+    remaining = scans
+
+    async def worker():
+        nonlocal remaining, errors
+        while remaining:
+            remaining -= 1
+            started = time.perf_counter()
+            verdict = await scanner.scan(path)
+            latencies.append(time.perf_counter() - started)
+            errors += verdict is not Verdict.CLEAN
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        "scans": len(latencies),
+        "errors": errors,
+        "scans_per_s": len(latencies) / elapsed,
+        "mib_per_s": size * len(latencies) / elapsed / 1024**2,
+        **report.latency_summary(latencies),
+    }
+
+
+async def open_engine(
+    backend: str, args: argparse.Namespace, directory: str, pool_size: int
+) -> Engine | None:
+    """Builds the engine of a backend, None with a note when it cannot run here."""
+    if backend == "clamscan":
+        return ClamscanEngine([args.clamscan or fake_clamscan(directory)])
+    if backend in ("clamd", "clamd-instream"):
+        return ClamdEngine(
+            ClamdOptions(
+                socket_path=args.clamd_socket,
+                pool_size=pool_size,
+                fd_passing=backend == "clamd",
+            )
+        )
+    if args.libclamav_database is None:
+        print(f"Skipping {backend}: it needs --libclamav-database", file=sys.stderr)
+        return None
+    from hiss.engines.libclamav import LibClamavEngine, LibClamavError
+
+    try:
+        return LibClamavEngine(
+            ScannerOptions(database=args.libclamav_database), max_workers=pool_size
+        )
+    except (LibClamavError, OSError) as e:
+        print(f"Skipping {backend}: {e}", file=sys.stderr)
+        return None
+
+
+async def run(args: argparse.Namespace) -> list[dict]:
+    sizes = [report.parse_size(size) for size in args.sizes]
+    results = []
+    with tempfile.TemporaryDirectory(prefix="hiss-bench-") as directory:
+        clamd = None
+        if args.clamd_socket is None and any(
+            backend.startswith("clamd") for backend in args.backends
+        ):
+            args.clamd_socket = os.path.join(directory, "clamd.sock")
+            clamd = FakeClamd(args.clamd_socket, latency=args.clamd_latency)
+            await clamd.start()
+        try:
+            for size in sizes:
+                path = write_sample(directory, size)
+                for backend in args.backends:
+                    engine = await open_engine(
+                        backend, args, directory, max(args.concurrency)
+                    )
+                    if engine is None:
+                        continue
+                    try:
+                        for concurrency in args.concurrency:
+                            scans = max(
+                                concurrency,
+                                min(args.scans, args.max_bytes // size or 1),
+                            )
+                            case = (
+                                f"{backend}/{report.format_size(size)}/c{concurrency}"
+                            )
+                            row = await bench_case(
+                                engine, path, size, concurrency, scans
+                            )
+                            results.append(
+                                {
+                                    "case": case,
+                                    "backend": backend,
+                                    "size": size,
+                                    "concurrency": concurrency,
+                                    **row,
+                                }
+                            )
+                            print(
+                                f"{case}: {row['mib_per_s']:.1f} MiB/s,"
+                                f" p95 {row['p95_ms']:.1f} ms",
+                                file=sys.stderr,
+                            )
+                    finally:
+                        await engine.close()
+                os.unlink(path)
+        finally:
+            if clamd is not None:
+                await clamd.stop()
+    return results
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--backends", nargs="+", choices=BACKENDS, default=list(DEFAULT_BACKENDS)
+    )
+    parser.add_argument(
+        "--sizes",
+        nargs="+",
+        default=list(DEFAULT_SIZES),
+        help="File sizes, e.g. 1KiB 1MiB 1GiB",
+    )
+    parser.add_argument(
+        "--concurrency", nargs="+", type=int, default=list(DEFAULT_CONCURRENCY)
+    )
+    parser.add_argument("--scans", type=int, default=50, help="Scans per case, at most")
+    parser.add_argument(
+        "--max-bytes",
+        type=report.parse_size,
+        default=report.parse_size("512MiB"),
+        help="Bytes scanned per case, at most, which lowers --scans for large files",
+    )
+    parser.add_argument("--clamscan", help="clamscan binary (default: a stub)")
+    parser.add_argument("--clamd-socket", help="clamd socket (default: FakeClamd)")
+    parser.add_argument(
+        "--clamd-latency",
+        type=float,
+        default=0,
+        help="Seconds FakeClamd adds to every scan",
+    )
+    parser.add_argument("--libclamav-database", help="Database for libclamav")
+    parser.add_argument("--output", help="Save the results as JSON")
+    parser.add_argument("--baseline", help="Compare with results saved by --output")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Fraction a metric may get worse than the baseline (default: 0.2)",
+    )
+    parser.add_argument(
+        "--log", action="store_true", help="Keep hiss logging every scan"
+    )
+    args = parser.parse_args(argv)
+    if not args.log:
+        # A log line per scan would be a large part of what is measured
+        logging.disable(logging.INFO)
+
+    results = asyncio.run(run(args))
+    print()
+    report.print_table(results, COLUMNS)
+    if args.output:
+        report.save(args.output, results)
+    if args.baseline:
+        regressions = report.compare(
+            results,
+            report.load(args.baseline),
+            higher_is_better=("mib_per_s",),
+            lower_is_better=("p95_ms",),
+            tolerance=args.tolerance,
+        )
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
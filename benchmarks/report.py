@@ -0,0 +1,124 @@
+"""Contains the helpers the benchmarks share to summarize, print, save and compare their results"""
+
+import json
+import math
+import platform
+import re
+import sys
+from typing import Iterable
+
+SIZE_UNITS = {"": 1, "k": 1024, "m": 1024**2, "g": 1024**3}
+
+
+def parse_size(value: str) -> int:
+    """Converts a size like "64KiB", "16M" or "1g" into bytes."""
+    match = re.fullmatch(r"\s*(\d+)\s*([kmg]?)(?:i?b)?\s*", value, re.IGNORECASE)
+    if match is None:
+        raise ValueError(f"Invalid size {value!r}")
+    return int(match[1]) * SIZE_UNITS[match[2].lower()]
+
+
+def format_size(size: int) -> str:
+    """Converts a size in bytes into its shortest exact label, e.g. 1048576 into "1MiB"."""
+    for unit, label in (("g", "GiB"), ("m", "MiB"), ("k", "KiB")):
+        if size >= SIZE_UNITS[unit] and size % SIZE_UNITS[unit] == 0:
+            return f"{size // SIZE_UNITS[unit]}{label}"
+    return f"{size}B"
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Returns the `q` percentile (0-100) of `values`, interpolating between the closest ranks."""
+    if not values:
+        return math.nan
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * q / 100
+    low, high = math.floor(rank), math.ceil(rank)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def latency_summary(latencies: list[float]) -> dict[str, float]:
+    """Returns the p50/p95/p99 and max of a list of latencies, in milliseconds."""
+    return {
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": max(latencies, default=math.nan) * 1000,
+    }
+
+
+def environment() -> dict[str, str]:
+    """Describes the machine the results were taken on, saved with them."""
+    return {
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+    }
+
+
+def print_table(rows: list[dict], columns: Iterable[str]) -> None:
+    """Prints the rows as a plain aligned table, one column per key."""
+    columns = list(columns)
+    cells = [[_cell(row.get(column)) for column in columns] for row in rows]
+    widths = [
+        max([len(column)] + [len(line[index]) for line in cells])
+        for index, column in enumerate(columns)
+    ]
+    print("  ".join(column.rjust(width) for column, width in zip(columns, widths)))
+    for line in cells:
+        print("  ".join(cell.rjust(width) for cell, width in zip(line, widths)))
+
+
+def _cell(value) -> str:
+    if isinstance(value, float):
+        return f"{value:.2f}" if math.isfinite(value) else "-"
+    return "-" if value is None else str(value)
+
+
+def save(path: str, results: list[dict]) -> None:
+    with open(path, "w") as f:
+        json.dump({"environment": environment(), "results": results}, f, indent=2)
+
+
+def load(path: str) -> list[dict]:
+    with open(path) as f:
+        return json.load(f)["results"]
+
+
+def compare(
+    results: list[dict],
+    baseline: list[dict],
+    higher_is_better: Iterable[str],
+    lower_is_better: Iterable[str],
+    tolerance: float,
+) -> list[str]:
+    """Lists the metrics that got worse than the baseline by more than `tolerance` (a fraction).
+
+    Results are matched to the baseline by their "case" key, cases missing
+    from either side are ignored.
+    """
+    previous = {row["case"]: row for row in baseline}
+    directions = [(metric, -1) for metric in higher_is_better] + [
+        (metric, 1) for metric in lower_is_better
+    ]
+    regressions = []
+    for row in results:
+        old = previous.get(row["case"])
+        if old is None:
+            continue
+        for metric, worse in directions:
+            change = _change(old.get(metric), row.get(metric))
+            if change is not None and change * worse > tolerance:
+                regressions.append(
+                    f"{row['case']}: {metric} {old[metric]:.2f} -> {row[metric]:.2f}"
+                    f" ({change:+.0%})"
+                )
+    return regressions
+
+
+def _change(before, after) -> float | None:
+    """Relative change from `before` to `after`, None if either is missing or unusable."""
+    if not isinstance(before, (int, float)) or not isinstance(after, (int, float)):
+        return None
+    if not (math.isfinite(before) and math.isfinite(after)) or before <= 0:
+        return None
+    return (after - before) / before
@@ -0,0 +1,138 @@
+"""Contains the TrustedHashes class, which lets uploads of known-good content skip the scan"""
+
+import asyncio
+import inspect
+import os
+from typing import Awaitable, Callable, Iterable
+
+from hiss.logger import Hisss
+
+hisss = Hisss()
+
+HashLoader = Callable[[], Iterable[str] | Awaitable[Iterable[str]]]
+
+
+def parse_trusted_hashes(lines: Iterable[str]) -> frozenset[bytes]:
+    """Parses hex SHA-256 digests, one per line, into a set of raw digests.
+
+    Blank lines and `#` comments are skipped, and anything after the digest is
+    ignored, so the output of `sha256sum` can be used as is.
+    """
+    digests = set()
+    for line in lines:
+        fields = line.split("#", 1)[0].split()
+        if not fields:
+            continue
+        try:
+            digest = bytes.fromhex(fields[0])
+        except ValueError:
+            hisss.warning(msg=f"Skipping invalid trusted hash: {fields[0]!r}")
+            continue
+        if len(digest) != 32:
+            hisss.warning(msg=f"Skipping invalid trusted hash: {fields[0]!r}")
+            continue
+        digests.add(digest)
+    return frozenset(digests)
+
+
+def _read_lines(path: str) -> list[str]:
+    with open(path, encoding="utf-8") as f:
+        return f.readlines()
+
+
+class TrustedHashes:
+    """An allowlist of SHA-256 digests whose content is accepted without scanning.
+
+    The digests come from a file (one hex digest per line, `sha256sum` output
+    works) or from a `loader` callback, sync or async, returning hex digests.
+    They are held as raw 32 byte digests in a frozenset. `refresh` builds the
+    new set off the event loop and swaps it in at once, so lookups never wait on
+    a reload, and a failed reload keeps the previous set. With a file, nothing
+    is re-read unless its modification time changed.
+
+    Every upload let through is logged with its digest and counted in `bypassed`.
+
+    Attributes:
+        - path (str): File listing the trusted digests (default: None)
+        - loader (Callable): Returns the trusted digests, used when there is no `path` (default: None)
+        - reload_interval (float): Seconds between two refreshes once started (default: 60)
+        - bypassed (int): Scans skipped because the content was trusted so far
+    """
+
+    def __init__(
+        self,
+        path: str | os.PathLike | None = None,
+        loader: HashLoader | None = None,
+        reload_interval: float = 60,
+    ):
+        if (path is None) == (loader is None):
+            raise ValueError("Pass either a path or a loader")
+        self.path = os.fspath(path) if path is not None else None
+        self.loader = loader
+        self.reload_interval = reload_interval
+        self.bypassed = 0
+        self._digests: frozenset[bytes] = frozenset()
+        self._mtime: float | None = None
+        self._refresher: asyncio.Task | None = None
+
+    def __len__(self) -> int:
+        return len(self._digests)
+
+    def __contains__(self, digest: str) -> bool:
+        try:
+            return bytes.fromhex(digest) in self._digests
+        except ValueError:
+            return False
+
+    def check(self, digest: str) -> bool:
+        """True if the content with this hex SHA-256 is trusted. Counts and logs the bypass."""
+        if digest not in self:
+            return False
+        self.bypassed += 1
+        hisss.info(msg=f"Trusted content {digest}, scan skipped.")
+        return True
+
+    async def refresh(self) -> None:
+        """Reloads the trusted digests, keeping the current ones if that fails."""
+        try:
+            if self.path is not None:
+                mtime = os.stat(self.path).st_mtime
+                if mtime == self._mtime:
+                    return
+                lines = await asyncio.to_thread(_read_lines, self.path)
+            elif inspect.iscoroutinefunction(self.loader):
+                lines = await self.loader()
+            else:
+                lines = await asyncio.to_thread(lambda: list(self.loader()))
+            digests = await asyncio.to_thread(parse_trusted_hashes, lines)
+        except Exception as e:
+            hisss.error(msg=f"Unable to load the trusted hashes: {e!r}")
+            return
+        self._digests = digests
+        if self.path is not None:
+            self._mtime = mtime
+        hisss.info(msg=f"Loaded {len(digests)} trusted hashes.")
+
+    def start(self) -> None:
+        """Starts refreshing the digests every `reload_interval` seconds in the background."""
+        if self._refresher is None or self._refresher.done():
+            self._refresher = asyncio.ensure_future(self._refresh_forever())
+
+    async def stop(self) -> None:
+        """Stops the background refresher."""
+        if self._refresher is not None:
+            self._refresher.cancel()
+            try:
+                await self._refresher
+            except asyncio.CancelledError:
+                pass
+            self._refresher = None
+
+    async def _refresh_forever(self) -> None:
+        while True:
+            await self.refresh()
+            await asyncio.sleep(self.reload_interval)
+
+    def stats(self) -> dict:
+        """Returns the size of the allowlist and the number of bypassed scans."""
+        return {"trusted": len(self), "bypassed": self.bypassed}
@@ -0,0 +1,218 @@
+"""Contains the BatchScan class, which scans large numbers of files in batched engine calls"""
+
+import asyncio
+import time
+from typing import TYPE_CHECKING, AsyncIterable, AsyncIterator, Iterable
+
+from hiss import metrics
+from hiss.engines import Verdict
+from hiss.engines.base import file_size, open_item
+from hiss.logger import Hisss
+
+if TYPE_CHECKING:
+    from hiss.scanner import Scanner
+
+hisss = Hisss()
+
+# Sentinel marking the end of the results
+_DONE = object()
+# Bytes per second a batch is expected to be scanned at, at worst
+MIN_THROUGHPUT = 1024 * 1024
+
+
+class BatchScan:
+    """An async iterator of (index, verdict) over the items given to Scanner.scan_many().
+
+    Items are taken from the source lazily and grouped into batches of
+    `batch_size`, each scanned with a single `Engine.scan_batch` call, e.g. one
+    clamscan run over a file list. Up to `concurrency` batches run at once,
+    each holding one scheduler slot, and verdicts are yielded as they come in,
+    not in input order. `index` is the position of the item in the source.
+    Items go through the scanner's allowlist, hash index and verdict cache
+    first, like single scans, and only the rest reach the engine, behind the
+    scanner's circuit breaker. A batch still running after the scanner's
+    `scan_timeout`, or longer for batches too large to scan at
+    `MIN_THROUGHPUT` in that time, is cancelled and its unreported items get
+    TIMEOUT.
+
+    Attributes:
+        - batch_size (int): Items per engine call (default: 64)
+        - concurrency (int): Batches scanned at the same time (default: 1)
+        - files (int): Items scanned so far
+        - bytes (int): Bytes scanned so far
+        - verdicts (dict[Verdict, int]): Count of each verdict so far
+    """
+
+    def __init__(
+        self,
+        scanner: "Scanner",
+        items: Iterable | AsyncIterable,
+        batch_size: int = 64,
+        concurrency: int = 1,
+    ):
+        self.scanner = scanner
+        self.items = items
+        self.batch_size = max(1, batch_size)
+        self.concurrency = max(1, concurrency)
+        self.files = 0
+        self.bytes = 0
+        self.verdicts = {verdict: 0 for verdict in Verdict}
+        self._started: float | None = None
+        self._finished: float | None = None
+
+    async def __aiter__(self) -> AsyncIterator[tuple[int, Verdict]]:
+        self._started = time.monotonic()
+        results: asyncio.Queue = asyncio.Queue()
+        producer = asyncio.ensure_future(self._produce(results))
+        try:
+            while (result := await results.get()) is not _DONE:
+                if isinstance(result, BaseException):
+                    raise result
+                index, verdict = result
+                self.files += 1
+                self.verdicts[verdict] += 1
+                yield index, verdict
+        finally:
+            producer.cancel()
+            try:
+                await producer
+            except asyncio.CancelledError:
+                pass
+            self._finished = time.monotonic()
+
+    async def _batches(self) -> AsyncIterator[list[tuple[int, object]]]:
+        batch = []
+        if isinstance(self.items, AsyncIterable):
+            index = 0
+            async for item in self.items:
+                batch.append((index, item))
+                index += 1
+                if len(batch) == self.batch_size:
+                    yield batch
+                    batch = []
+        else:
+            for index, item in enumerate(self.items):
+                batch.append((index, item))
+                if len(batch) == self.batch_size:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+
+    async def _produce(self, results: asyncio.Queue) -> None:
+        running: set[asyncio.Task] = set()
+        try:
+            async for batch in self._batches():
+                while len(running) >= self.concurrency:
+                    done, running = await asyncio.wait(
+                        running, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    for task in done:
+                        task.result()
+                running.add(asyncio.ensure_future(self._scan(batch, results)))
+            for task in asyncio.as_completed(running):
+                await task
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await results.put(e)
+        finally:
+            for task in running:
+                task.cancel()
+        await results.put(_DONE)
+
+    async def _scan(self, batch: list[tuple[int, object]], results: asyncio.Queue):
+        scanner = self.scanner
+        sizes = [file_size(item) for _, item in batch]
+        self.bytes += sum(size or 0 for size in sizes)
+        pending = []
+        for (index, item), size in zip(batch, sizes):
+            verdict, digest, version = await self._shortcut(item)
+            if verdict is None:
+                pending.append((index, item, size, digest, version))
+            else:
+                await results.put((index, verdict))
+        if not pending:
+            return
+        # Unknown sizes go to the scheduler's large lane
+        size = None if None in sizes else sum(size for _, _, size, _, _ in pending)
+        breaker = scanner.breaker
+        if breaker is not None and not breaker.allow():
+            for index, *_ in pending:
+                await results.put((index, Verdict.UNAVAILABLE))
+            return
+        try:
+            async with scanner.scheduler.slot(size=size):
+                started = time.monotonic()
+                outcome = await self._engine_scan(pending, size, results)
+        except BaseException:
+            if breaker is not None:
+                breaker.discard()
+            raise
+        if breaker is not None:
+            breaker.record(outcome, (time.monotonic() - started) / len(pending))
+        hisss.debug(msg=f"Scanned a batch of {len(batch)} files.")
+
+    async def _shortcut(self, item) -> tuple[Verdict | None, str | None, str | None]:
+        """Runs an item through the scanner's allowlist, hash index and cache, like a single scan."""
+        if not self.scanner._has_shortcuts:
+            return None, None, None
+        try:
+            with open_item(item) as file:
+                return await self.scanner._shortcut(file)
+        except OSError:
+            # Left to the engine, which reports it
+            return None, None, None
+
+    async def _engine_scan(
+        self, pending: list[tuple], size: int | None, results: asyncio.Queue
+    ) -> Verdict:
+        """Scans the items with one engine call, returns the outcome of the whole batch for the breaker."""
+        scanner = self.scanner
+        reported: set[int] = set()
+        errors = 0
+
+        async def scan_batch():
+            nonlocal errors
+            async for position, verdict in scanner.engine.scan_batch(
+                [item for _, item, _, _, _ in pending]
+            ):
+                index, _, _, digest, version = pending[position]
+                reported.add(position)
+                errors += verdict is Verdict.ERROR
+                await scanner._remember(digest, version, verdict)
+                await results.put((index, verdict))
+
+        try:
+            await asyncio.wait_for(scan_batch(), self._deadline(size))
+        except asyncio.TimeoutError:
+            scanner.timeouts += 1
+            metrics.SCAN_TIMEOUTS.inc(reason="deadline")
+            hisss.error(msg=f"Batch of {len(pending)} files exceeded its deadline.")
+            for position, (index, *_) in enumerate(pending):
+                if position not in reported:
+                    await results.put((index, Verdict.TIMEOUT))
+            return Verdict.TIMEOUT
+        # A few unreadable files are the files' fault, not the engine's
+        return Verdict.ERROR if errors == len(pending) else Verdict.CLEAN
+
+    def _deadline(self, size: int | None) -> float | None:
+        """The scanner's `scan_timeout`, stretched for batches too large to scan at MIN_THROUGHPUT within it."""
+        if self.scanner.scan_timeout is None:
+            return None
+        return max(self.scanner.scan_timeout, (size or 0) / MIN_THROUGHPUT)
+
+    def stats(self) -> dict:
+        """Returns the progress and throughput of the scan so far."""
+        if self._started is None:
+            seconds = 0.0
+        else:
+            seconds = (self._finished or time.monotonic()) - self._started
+        return {
+            "files": self.files,
+            "bytes": self.bytes,
+            "seconds": seconds,
+            "files_per_second": self.files / seconds if seconds else 0.0,
+            "mb_per_second": self.bytes / seconds / 1e6 if seconds else 0.0,
+            **{verdict.value: count for verdict, count in self.verdicts.items()},
+        }
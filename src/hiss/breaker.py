@@ -0,0 +1,206 @@
+"""Contains the CircuitBreaker class, which fails scans fast while the engine is unhealthy"""
+
+import collections
+import enum
+import threading
+import time
+from typing import Callable
+
+from hiss import metrics
+from hiss.engines import Verdict
+from hiss.logger import Hisss
+
+hisss = Hisss()
+
+# Verdicts counted as failures of the engine
+FAILURES = (Verdict.ERROR, Verdict.TIMEOUT)
+
+
+class BreakerState(str, enum.Enum):
+    """The state of a CircuitBreaker."""
+
+    # Scans go through, and their outcomes are watched
+    CLOSED = "closed"
+    # Scans are refused straight away
+    OPEN = "open"
+    # A few probe scans go through to see whether the engine recovered
+    HALF_OPEN = "half_open"
+
+
+StateListener = Callable[[BreakerState, BreakerState], None]
+
+
+class CircuitBreaker:
+    """Stops sending scans to an engine that keeps failing or crawling.
+
+    The outcome of every scan in the last `window` seconds is kept. Once there
+    are at least `min_calls` of them and the share of failures (ERROR or
+    TIMEOUT verdicts, and scans slower than `slow_call_seconds`) reaches
+    `failure_rate`, the breaker opens: scans are refused without touching the
+    engine and the Scanner returns UNAVAILABLE at once, instead of every
+    request waiting for its own timeout. After `open_seconds` the breaker goes
+    half-open and lets `probes` scans through. If they all succeed it closes,
+    if one fails it opens again.
+
+    Listeners registered with `add_listener` are called with the old and new
+    state on every change, and the changes are counted in `stats()` and in
+    the hiss_breaker_state/hiss_breaker_transitions metrics, labelled with
+    the breaker's `name`.
+
+    Attributes:
+        - failure_rate (float): Share of failed scans that opens the breaker (default: 0.5)
+        - min_calls (int): Scans needed in the window before the rate is trusted (default: 10)
+        - window (float): Seconds of history the rate is computed over (default: 30)
+        - slow_call_seconds (float): Scans taking longer count as failures, None to only count errors (default: None)
+        - open_seconds (float): Seconds scans are refused before probing the engine again (default: 30)
+        - probes (int): Successful probe scans needed to close the breaker again (default: 1)
+        - name (str): Labels the breaker's metrics, None for the name of the engine of the Scanner using it (default: None)
+    """
+
+    def __init__(
+        self,
+        failure_rate: float = 0.5,
+        min_calls: int = 10,
+        window: float = 30,
+        slow_call_seconds: float | None = None,
+        open_seconds: float = 30,
+        probes: int = 1,
+        name: str | None = None,
+    ):
+        self.failure_rate = failure_rate
+        self.min_calls = max(1, min_calls)
+        self.window = window
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+        self.probes = max(1, probes)
+        self.name = name
+        self.state = BreakerState.CLOSED
+        self.rejected = 0
+        self.transitions = {state: 0 for state in BreakerState}
+        self._calls: collections.deque[tuple[float, bool]] = collections.deque()
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = 0
+        self._probe_successes = 0
+        self._listeners: list[StateListener] = []
+        self._lock = threading.Lock()
+        self.add_listener(self._record_transition)
+
+    def add_listener(self, listener: StateListener) -> None:
+        """Registers a function called with (old state, new state) on every state change."""
+        self._listeners.append(listener)
+
+    @property
+    def retry_after(self) -> float:
+        """Seconds until the breaker lets a probe through, 0 unless it is open."""
+        if self.state is not BreakerState.OPEN:
+            return 0.0
+        return max(0.0, self._opened_at + self.open_seconds - time.monotonic())
+
+    def allow(self) -> bool:
+        """True if a scan may go to the engine. Report its outcome with `record`, or `discard` it."""
+        with self._lock:
+            if self.state is BreakerState.OPEN:
+                if time.monotonic() - self._opened_at < self.open_seconds:
+                    self.rejected += 1
+                    return False
+                changed = self._transition(BreakerState.HALF_OPEN)
+            else:
+                changed = None
+            if self.state is BreakerState.HALF_OPEN:
+                allowed = self._probing < self.probes - self._probe_successes
+                if allowed:
+                    self._probing += 1
+                else:
+                    self.rejected += 1
+            else:
+                allowed = True
+        self._notify(changed)
+        return allowed
+
+    def record(self, verdict: Verdict, seconds: float) -> None:
+        """Reports the outcome of a scan let through by `allow`."""
+        failed = verdict in FAILURES or (
+            self.slow_call_seconds is not None and seconds > self.slow_call_seconds
+        )
+        changed = None
+        with self._lock:
+            if self.state is BreakerState.HALF_OPEN:
+                if self._probing:
+                    self._probing -= 1
+                if failed:
+                    changed = self._transition(BreakerState.OPEN)
+                else:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self.probes:
+                        changed = self._transition(BreakerState.CLOSED)
+            elif self.state is BreakerState.CLOSED:
+                now = time.monotonic()
+                self._calls.append((now, failed))
+                self._failures += failed
+                while self._calls and self._calls[0][0] < now - self.window:
+                    self._failures -= self._calls.popleft()[1]
+                if (
+                    len(self._calls) >= self.min_calls
+                    and self._failures / len(self._calls) >= self.failure_rate
+                ):
+                    changed = self._transition(BreakerState.OPEN)
+        self._notify(changed)
+
+    def discard(self) -> None:
+        """Forgets a scan let through by `allow` that ended without a verdict, e.g. cancelled."""
+        with self._lock:
+            if self.state is BreakerState.HALF_OPEN and self._probing:
+                self._probing -= 1
+
+    def _transition(self, state: BreakerState) -> tuple[BreakerState, BreakerState]:
+        previous, self.state = self.state, state
+        self.transitions[state] += 1
+        if state is BreakerState.OPEN:
+            self._opened_at = time.monotonic()
+        self._calls.clear()
+        self._failures = 0
+        self._probing = 0
+        self._probe_successes = 0
+        return previous, state
+
+    def _record_transition(self, previous: BreakerState, state: BreakerState) -> None:
+        name = self.name or ""
+        metrics.BREAKER_TRANSITIONS.inc(
+            breaker=name, previous=previous.value, state=state.value
+        )
+        for candidate in BreakerState:
+            metrics.BREAKER_STATE.set(
+                int(candidate is state), breaker=name, state=candidate.value
+            )
+
+    def _notify(self, changed: tuple[BreakerState, BreakerState] | None) -> None:
+        if changed is None:
+            return
+        previous, state = changed
+        if state is BreakerState.OPEN:
+            hisss.error(
+                msg=f"Circuit breaker opened, scans fail fast for {self.open_seconds}s."
+            )
+        else:
+            hisss.warning(msg=f"Circuit breaker {previous.value} -> {state.value}.")
+        for listener in self._listeners:
+            try:
+                listener(previous, state)
+            except Exception as e:
+                hisss.error(msg=f"Circuit breaker listener failed: {e!r}")
+
+    def stats(self) -> dict:
+        """Returns the state of the breaker and its counters."""
+        with self._lock:
+            calls = len(self._calls)
+            return {
+                "state": self.state.value,
+                "calls": calls,
+                "failure_rate": self._failures / calls if calls else 0.0,
+                "rejected": self.rejected,
+                **{
+                    f"{state.value}_transitions": count
+                    for state, count in self.transitions.items()
+                },
+            }
@@ -0,0 +1,385 @@
+"""Contains the VerdictCache and SharedVerdictCache classes, which remember verdicts by content hash so repeated uploads skip the engine"""
+
+import asyncio
+import collections
+import hashlib
+import os
+import sqlite3
+import stat
+import sys
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+
+from hiss.engines.base import Verdict, iter_chunks
+from hiss.logger import Hisss
+
+hisss = Hisss()
+
+# Rough per-entry cost of the OrderedDict slot and the entry object, on top of the key
+ENTRY_OVERHEAD = 200
+
+
+@dataclass
+class CacheEntry:
+    verdict: Verdict
+    expires: float
+    cost: int
+
+
+async def sha256_digest(file) -> tuple[str, int]:
+    """Hashes a sync or async file-like object.
+
+    Returns:
+        tuple[str, int]: The hex SHA-256 of the content and its size in bytes.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    async for chunk in iter_chunks(file):
+        digest.update(chunk)
+        size += len(chunk)
+    return digest.hexdigest(), size
+
+
+class VerdictCache:
+    """An in-process LRU cache of verdicts keyed by the SHA-256 of the content.
+
+    The Scanner prefixes the digest with a fingerprint of its engine's
+    settings, so scanners with different profiles can share a cache.
+
+    Every lookup carries the signature database version. A newer version than
+    the one the cached entries were produced with drops the whole cache, so a
+    verdict never outlives the signatures that produced it. An older one, e.g.
+    from a scanner whose engine hasn't reloaded yet, misses without touching
+    the entries, and its verdicts aren't stored.
+
+    Attributes:
+        - max_entries (int): Maximum number of verdicts kept (default: 100000)
+        - max_bytes (int): Maximum approximate memory used by the entries (default: 32MiB)
+        - ttl (float): Seconds a verdict stays valid (default: 3600)
+        - hits, misses, evictions (int): Counters for sizing the cache
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 100_000,
+        max_bytes: int = 32 * 1024 * 1024,
+        ttl: float = 3600,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.version: str | None = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: collections.OrderedDict[str, CacheEntry] = (
+            collections.OrderedDict()
+        )
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def size_bytes(self) -> int:
+        return self._bytes
+
+    def get(self, digest: str, version: str) -> Verdict | None:
+        """Returns the cached verdict for a digest, or None on a miss."""
+        with self._lock:
+            entry = self._entries.get(digest) if self._check_version(version) else None
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry.expires <= time.monotonic():
+                self._remove(digest)
+                self.evictions += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(digest)
+            self.hits += 1
+            return entry.verdict
+
+    def put(self, digest: str, version: str, verdict: Verdict) -> None:
+        """Caches a verdict produced with the given signature version."""
+        with self._lock:
+            if not self._check_version(version):
+                return
+            if digest in self._entries:
+                self._remove(digest)
+            entry = CacheEntry(
+                verdict=verdict,
+                expires=time.monotonic() + self.ttl,
+                cost=sys.getsizeof(digest) + ENTRY_OVERHEAD,
+            )
+            self._entries[digest] = entry
+            self._bytes += entry.cost
+            while self._entries and (
+                len(self._entries) > self.max_entries or self._bytes > self.max_bytes
+            ):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    async def lookup(self, digest: str, version: str) -> Verdict | None:
+        """Like `get`, for callers on the event loop."""
+        return self.get(digest, version)
+
+    async def store(self, digest: str, version: str, verdict: Verdict) -> None:
+        """Like `put`, for callers on the event loop."""
+        self.put(digest, version, verdict)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        """Returns the counters and current size of the cache."""
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def _check_version(self, version: str) -> bool:
+        """Drops the entries of an older version than `version`. Returns False if `version` is the older one."""
+        if version == self.version:
+            return True
+        if self.version is not None and _is_older(version, self.version):
+            return False
+        self._entries.clear()
+        self._bytes = 0
+        self.version = version
+        return True
+
+    def _remove(self, digest: str) -> None:
+        entry = self._entries.pop(digest)
+        self._bytes -= entry.cost
+
+
+class SharedVerdictCache:
+    """A verdict cache shared by every worker process on a host.
+
+    Verdicts live in an SQLite file in WAL mode, so lookups from many processes
+    run concurrently without blocking each other, and a verdict stored by one
+    worker is served to all of them. The file records the signature version its
+    verdicts were produced with; the first worker to see a newer version clears
+    the table, and verdicts are only served to workers on the same version.
+    The Scanner goes through `lookup` and `store`, which wait for a locked
+    database on a worker thread instead of the event loop. The cache only
+    saves work, so a database that stays locked or fails is logged and
+    treated as a miss, never as a failed scan.
+
+    Attributes:
+        - path (str): Location of the SQLite file, in a directory only trusted users can write to (default: verdicts.sqlite3 in private_directory())
+        - max_entries (int): Approximate maximum number of verdicts kept; least recently used ones are evicted (default: 1000000)
+        - ttl (float): Seconds a verdict stays valid (default: 3600)
+        - timeout (float): Seconds to wait for another worker's lock before giving up (default: 5)
+        - hits, misses, evictions (int): Counters for this process
+        - errors (int): Lookups and stores that failed in this process
+    """
+
+    # Puts between two checks of the table size
+    TRIM_INTERVAL = 256
+    # Hits only refresh an entry's last use when it is older than this many seconds
+    TOUCH_INTERVAL = 60
+
+    def __init__(
+        self,
+        path: str | None = None,
+        max_entries: int = 1_000_000,
+        ttl: float = 3600,
+        timeout: float = 5,
+    ):
+        self.path = path or os.path.join(private_directory(), "verdicts.sqlite3")
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.timeout = timeout
+        self.version: str | None = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.errors = 0
+        self._puts = 0
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS verdicts ("
+                "digest TEXT PRIMARY KEY, version TEXT NOT NULL, verdict TEXT NOT NULL, "
+                "expires REAL NOT NULL, used REAL NOT NULL) WITHOUT ROWID"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS verdicts_used ON verdicts(used)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections must stay on the thread that created them
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.path, timeout=self.timeout, isolation_level=None
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, digest: str, version: str) -> Verdict | None:
+        """Returns the cached verdict for a digest, or None on a miss or when the database fails."""
+        try:
+            return self._get(digest, version)
+        except sqlite3.Error as e:
+            self.errors += 1
+            self.misses += 1
+            hisss.warning(msg=f"Verdict cache lookup failed, scanning: {e!r}")
+            return None
+
+    def _get(self, digest: str, version: str) -> Verdict | None:
+        if not self._check_version(version):
+            self.misses += 1
+            return None
+        conn = self._connection()
+        row = conn.execute(
+            "SELECT verdict, expires, used FROM verdicts WHERE digest = ? AND version = ?",
+            (digest, version),
+        ).fetchone()
+        now = time.time()
+        if row is None or row[1] <= now:
+            self.misses += 1
+            return None
+        if now - row[2] > self.TOUCH_INTERVAL:
+            conn.execute("UPDATE verdicts SET used = ? WHERE digest = ?", (now, digest))
+        self.hits += 1
+        return Verdict(row[0])
+
+    def put(self, digest: str, version: str, verdict: Verdict) -> None:
+        """Caches a verdict produced with the given signature version, unless the database fails."""
+        try:
+            self._put(digest, version, verdict)
+        except sqlite3.Error as e:
+            self.errors += 1
+            hisss.warning(msg=f"Verdict cache store failed, skipping it: {e!r}")
+
+    def _put(self, digest: str, version: str, verdict: Verdict) -> None:
+        if not self._check_version(version):
+            return
+        conn = self._connection()
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO verdicts (digest, version, verdict, expires, used) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (digest, version, verdict.value, now + self.ttl, now),
+        )
+        self._puts += 1
+        if self._puts % self.TRIM_INTERVAL == 0:
+            self.trim()
+
+    async def lookup(self, digest: str, version: str) -> Verdict | None:
+        """Like `get`, run on a worker thread so a locked database never blocks the event loop."""
+        return await asyncio.to_thread(self.get, digest, version)
+
+    async def store(self, digest: str, version: str, verdict: Verdict) -> None:
+        """Like `put`, run on a worker thread so a locked database never blocks the event loop."""
+        await asyncio.to_thread(self.put, digest, version, verdict)
+
+    def trim(self) -> None:
+        """Drops expired verdicts, then the least recently used ones above `max_entries`."""
+        conn = self._connection()
+        expired = conn.execute(
+            "DELETE FROM verdicts WHERE expires <= ?", (time.time(),)
+        )
+        self.evictions += expired.rowcount
+        (count,) = conn.execute("SELECT count(*) FROM verdicts").fetchone()
+        if count > self.max_entries:
+            evicted = conn.execute(
+                "DELETE FROM verdicts WHERE digest IN "
+                "(SELECT digest FROM verdicts ORDER BY used LIMIT ?)",
+                (count - self.max_entries,),
+            )
+            self.evictions += evicted.rowcount
+
+    def clear(self) -> None:
+        self._connection().execute("DELETE FROM verdicts")
+
+    def __len__(self) -> int:
+        return self._connection().execute("SELECT count(*) FROM verdicts").fetchone()[0]
+
+    def stats(self) -> dict:
+        """Returns this process's counters and the current size of the shared table."""
+        return {
+            "entries": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "errors": self.errors,
+        }
+
+    def _check_version(self, version: str) -> bool:
+        """Makes sure the table holds verdicts for `version`. Returns False if this process is behind."""
+        if version == self.version:
+            return True
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT value FROM meta WHERE key = 'version'"
+            ).fetchone()
+            stored = row[0] if row else None
+            if stored is not None and _is_older(version, stored):
+                conn.execute("COMMIT")
+                return False
+            if stored != version:
+                conn.execute("DELETE FROM verdicts")
+                conn.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)",
+                    (version,),
+                )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        self.version = version
+        return True
+
+
+def private_directory() -> str:
+    """Returns the hiss directory of the current user in the temp directory, creating it if needed.
+
+    Anyone can create files in the temp directory, so a shared cache at a
+    predictable path there could be planted with CLEAN verdicts by another
+    user. The directory is created with mode 0700, and refused if it already
+    exists with another owner or with access for anyone else.
+
+    Raises:
+        PermissionError: If the directory is not private to the current user.
+    """
+    if not hasattr(os, "getuid"):
+        # The temp directory is already per user on Windows
+        return tempfile.gettempdir()
+    directory = os.path.join(tempfile.gettempdir(), f"hiss-{os.getuid()}")
+    try:
+        os.mkdir(directory, 0o700)
+    except FileExistsError:
+        pass
+    info = os.lstat(directory)
+    if (
+        not stat.S_ISDIR(info.st_mode)
+        or info.st_uid != os.getuid()
+        or info.st_mode & 0o077
+    ):
+        raise PermissionError(
+            f"{directory} is not a directory private to this user, pass an explicit cache path"
+        )
+    return directory
+
+
+def _is_older(version: str, other: str) -> bool:
+    if version.isdigit() and other.isdigit():
+        return int(version) < int(other)
+    return False
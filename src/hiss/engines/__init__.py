@@ -0,0 +1,6 @@
+from hiss.engines.base import Engine, Verdict
+from hiss.engines.clamd import ClamdEngine
+from hiss.engines.clamscan import ClamscanEngine
+from hiss.engines.libclamav import LibClamavEngine
+
+__all__ = ["ClamdEngine", "ClamscanEngine", "Engine", "LibClamavEngine", "Verdict"]
@@ -0,0 +1,288 @@
+"""Contains the Engine base class and the Verdict every scan backend returns"""
+
+import asyncio
+import contextlib
+import enum
+import inspect
+import io
+import mmap
+import os
+import tempfile
+from typing import AsyncIterator, Iterator, Sequence
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+# Data streamed to an engine without native streaming support is kept in memory up to this size, then on disk
+SPOOL_MAX_SIZE = 1024 * 1024
+
+
+class Verdict(str, enum.Enum):
+    """The outcome of a single scan."""
+
+    CLEAN = "clean"
+    INFECTED = "infected"
+    ERROR = "error"
+    # The scan ran past the scanner's deadline and was killed
+    TIMEOUT = "timeout"
+    # The scan was refused without trying, the engine's circuit breaker is open
+    UNAVAILABLE = "unavailable"
+
+
+class ScanSession:
+    """Feeds a single file to an engine chunk by chunk, as it arrives."""
+
+    async def write(self, chunk: bytes) -> None:
+        """Sends the next chunk of the file to the engine."""
+        raise NotImplementedError
+
+    async def finish(self) -> Verdict:
+        """Signals the end of the file and returns the verdict."""
+        raise NotImplementedError
+
+    async def abort(self) -> None:
+        """Gives up on the scan and releases the engine resources it holds."""
+
+
+class SpooledSession(ScanSession):
+    """A session for engines that can only scan a complete file.
+
+    Chunks are spooled to a SpooledTemporaryFile, so memory stays bounded
+    however large the file is, and handed to `Engine.scan` on `finish`.
+    """
+
+    def __init__(self, engine: "Engine", max_size: int = SPOOL_MAX_SIZE):
+        self.engine = engine
+        self._spool = tempfile.SpooledTemporaryFile(max_size=max_size)
+
+    async def write(self, chunk: bytes) -> None:
+        self._spool.write(chunk)
+
+    async def finish(self) -> Verdict:
+        try:
+            return await self.engine.scan(self._spool)
+        finally:
+            self._spool.close()
+
+    async def abort(self) -> None:
+        self._spool.close()
+
+
+class Engine:
+    """Base class for scan backends.
+
+    Subclasses implement `scan` and may override `settings`, `open_session`, `ping`, `version`, `reload` and `close`.
+
+    Attributes:
+        - name (str): Short backend name used in logs (default: "engine")
+    """
+
+    name = "engine"
+
+    @property
+    def settings(self) -> str:
+        """Describes the configuration the verdicts depend on, so verdicts of differently configured engines are cached apart."""
+        return self.name
+
+    async def scan(self, file) -> Verdict:
+        """Scans a file-like object (BytesIO or UploadFile) for malware.
+
+        Args:
+            file (BytesIO | UploadFile): The file to scan.
+
+        Returns:
+            Verdict: The outcome of the scan.
+        """
+        raise NotImplementedError
+
+    async def open_session(self) -> ScanSession:
+        """Starts a streaming scan. Engines without native streaming spool the data first."""
+        return SpooledSession(self)
+
+    async def scan_batch(self, items: Sequence) -> AsyncIterator[tuple[int, Verdict]]:
+        """Scans several buffers, paths or file-like objects, yielding (position, verdict) as each completes.
+
+        The default runs a `scan` per item concurrently. Engines with a cheaper
+        way to scan many files at once override it.
+        """
+
+        async def scan(position: int, item) -> tuple[int, Verdict]:
+            try:
+                with open_item(item) as file:
+                    return position, await self.scan(file)
+            except OSError:
+                return position, Verdict.ERROR
+
+        tasks = [
+            asyncio.ensure_future(scan(position, item))
+            for position, item in enumerate(items)
+        ]
+        try:
+            for result in asyncio.as_completed(tasks):
+                yield await result
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def ping(self) -> bool:
+        """Returns True if the backend is able to scan."""
+        return True
+
+    async def version(self) -> str | None:
+        """Returns the backend's ClamAV/signature version string, if known."""
+        return None
+
+    async def reload(self, version: str | None = None) -> None:
+        """Switches to a freshly updated signature database.
+
+        Args:
+            version (str): The signature version now on disk, if known.
+        """
+
+    async def close(self) -> None:
+        """Releases any resources held by the backend."""
+
+
+def signature_version(version: str | None) -> str | None:
+    """Extracts the signature database version from a "ClamAV 1.0.1/26800/<date>" version string."""
+    if not version:
+        return None
+    parts = version.split("/")
+    return parts[1] if len(parts) > 1 else version
+
+
+BUFFER_TYPES = (bytes, bytearray, memoryview, mmap.mmap)
+
+
+class BufferReader:
+    """A read-only file-like view over bytes, a memoryview or an mmap.
+
+    Reads return memoryview slices of the original buffer, so the data is
+    never copied on its way to the engine.
+    """
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self._view = memoryview(buffer).cast("B")
+        self._position = 0
+
+    def read(self, size: int = -1) -> memoryview:
+        end = (
+            len(self._view) if size < 0 else min(self._position + size, len(self._view))
+        )
+        chunk = self._view[self._position : end]
+        self._position = end
+        return chunk
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += len(self._view)
+        self._position = max(0, offset)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+    def getbuffer(self) -> memoryview:
+        return self._view
+
+    def close(self) -> None:
+        # Lets the buffer be resized or, for an mmap, closed again
+        self._view.release()
+
+
+def as_file(item):
+    """Wraps a bytes-like buffer in a BufferReader, leaving file-like objects as they are."""
+    if isinstance(item, BUFFER_TYPES):
+        return BufferReader(item)
+    return item
+
+
+@contextlib.contextmanager
+def open_item(item) -> Iterator:
+    """Gives a file-like object for a path, buffer or file-like object, closing it afterwards if it was opened here."""
+    if isinstance(item, (str, os.PathLike)):
+        with open(item, "rb") as file:
+            yield file
+    elif isinstance(item, BUFFER_TYPES):
+        reader = BufferReader(item)
+        try:
+            yield reader
+        finally:
+            reader.close()
+    else:
+        yield item
+
+
+def file_descriptor(file) -> int | None:
+    """Returns the descriptor behind a file-like object, if it is backed by a real file.
+
+    Spooled uploads only have one once they rolled over to disk.
+    """
+    raw = file.file if inspect.iscoroutinefunction(file.seek) else file
+    if isinstance(raw, tempfile.SpooledTemporaryFile) and not raw._rolled:
+        return None
+    try:
+        raw.flush()
+        return raw.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
+
+
+def memory_buffer(file) -> memoryview | None:
+    """Returns a zero-copy view of the content of an in-memory file-like object, if it is one."""
+    raw = (
+        getattr(file, "file", file) if inspect.iscoroutinefunction(file.seek) else file
+    )
+    if isinstance(raw, tempfile.SpooledTemporaryFile) and not raw._rolled:
+        raw = raw._file
+    if isinstance(raw, (io.BytesIO, BufferReader)):
+        return raw.getbuffer()
+    return None
+
+
+def item_size(item) -> int:
+    """Returns the size in bytes of a buffer, path or seekable file-like object, or 0 if unknown."""
+    return known_size(item) or 0
+
+
+def file_size(file) -> int | None:
+    """Returns the size of a file-like object, UploadFile, buffer or path in bytes, or None if unknown."""
+    size = getattr(file, "size", None)  # UploadFile knows its size
+    if size is None:
+        size = known_size(getattr(file, "file", file))
+    return size
+
+
+def known_size(item) -> int | None:
+    """Returns the size in bytes of a buffer, path or seekable file-like object, or None if unknown."""
+    if isinstance(item, (bytes, bytearray)):
+        return len(item)
+    if isinstance(item, (memoryview, mmap.mmap)):
+        return memoryview(item).nbytes
+    if isinstance(item, (str, os.PathLike)):
+        try:
+            return os.path.getsize(item)
+        except OSError:
+            return None
+    try:
+        position = item.tell()
+        size = item.seek(0, os.SEEK_END)
+        item.seek(position)
+    except (AttributeError, OSError, TypeError):
+        return None
+    return size if isinstance(size, int) else None
+
+
+async def iter_chunks(
+    file, chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> AsyncIterator[bytes]:
+    """Yields the contents of a sync or async file-like object from the start, in chunks."""
+    if inspect.iscoroutinefunction(file.seek):
+        await file.seek(0)
+        while chunk := await file.read(chunk_size):
+            yield chunk
+    else:
+        file.seek(0)
+        while chunk := file.read(chunk_size):
+            yield chunk
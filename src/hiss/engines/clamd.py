@@ -0,0 +1,397 @@
+"""Contains the ClamdEngine class, which scans through a running clamd daemon over its socket protocol"""
+
+import array
+import asyncio
+import collections
+import socket
+import struct
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from hiss import metrics, tracing
+from hiss.engines.base import (
+    Engine,
+    ScanSession,
+    Verdict,
+    file_descriptor,
+    iter_chunks,
+    signature_version,
+)
+from hiss.logger import Hisss
+from hiss.options import ClamdOptions
+
+hisss = Hisss()
+
+
+class ClamdError(Exception):
+    """Raised when clamd cannot be reached or answers with something unexpected."""
+
+
+CLAMD_ERRORS = (OSError, ClamdError, asyncio.TimeoutError)
+
+
+class ClamdConnection:
+    """A single clamd connection kept open in IDSESSION mode.
+
+    Commands are sent "z" prefixed and null terminated, and every reply is
+    prefixed with the id of the command it answers, so the same socket can be
+    reused for any number of scans until clamd's IdleTimeout closes it.
+    """
+
+    def __init__(self, options: ClamdOptions):
+        self.options = options
+        self.sock: socket.socket | None = None
+        self.last_used = time.monotonic()
+        self._next_id = 1
+        self._request_id = 0
+        self._buffer = b""
+
+    async def connect(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self.options.socket_path:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            address = self.options.socket_path
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            address = (self.options.host, self.options.port)
+        sock.setblocking(False)
+        try:
+            await asyncio.wait_for(
+                loop.sock_connect(sock, address), self.options.connect_timeout
+            )
+            await loop.sock_sendall(sock, b"zIDSESSION\0")
+        except BaseException:
+            sock.close()
+            raise
+        self.sock = sock
+        metrics.ENGINE_CONNECTIONS.inc(backend="clamd")
+
+    @property
+    def closed(self) -> bool:
+        return self.sock is None
+
+    def is_stale(self) -> bool:
+        return time.monotonic() - self.last_used > self.options.idle_timeout
+
+    async def command(self, command: bytes) -> str:
+        """Sends a single command (PING, VERSION, ...) and returns clamd's reply."""
+        await self._send(b"z" + command + b"\0")
+        return await self._reply()
+
+    async def instream(self, chunks: AsyncIterator[bytes]) -> str:
+        """Streams the chunks to clamd with INSTREAM and returns the scan reply."""
+        await self.start_instream()
+        async for chunk in chunks:
+            await self.send_chunk(chunk)
+        return await self.end_instream()
+
+    async def fildes(self, fd: int) -> str:
+        """Passes an open file descriptor to clamd with FILDES and returns the scan reply.
+
+        clamd reads the file itself, so none of its content goes through this process.
+        """
+        await self._send(b"zFILDES\0")
+        loop = asyncio.get_running_loop()
+        # The descriptor travels as SCM_RIGHTS ancillary data alongside a single byte
+        ancillary = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", [fd]))]
+        while True:
+            try:
+                self.sock.sendmsg([b"\0"], ancillary)
+                break
+            except BlockingIOError:
+                await _writable(loop, self.sock)
+        return await self._reply()
+
+    async def start_instream(self) -> None:
+        await self._send(b"zINSTREAM\0")
+
+    async def send_chunk(self, chunk: bytes) -> None:
+        loop = asyncio.get_running_loop()
+        # clamd expects each chunk prefixed by its length as a 4 byte big endian integer
+        for offset in range(0, len(chunk), self.options.chunk_size):
+            part = chunk[offset : offset + self.options.chunk_size]
+            await loop.sock_sendall(self.sock, struct.pack("!L", len(part)))
+            await loop.sock_sendall(self.sock, part)
+
+    async def end_instream(self) -> str:
+        loop = asyncio.get_running_loop()
+        await loop.sock_sendall(self.sock, struct.pack("!L", 0))
+        return await self._reply()
+
+    async def _send(self, data: bytes) -> None:
+        loop = asyncio.get_running_loop()
+        self._request_id = self._next_id
+        self._next_id += 1
+        await loop.sock_sendall(self.sock, data)
+
+    async def _reply(self) -> str:
+        loop = asyncio.get_running_loop()
+        while b"\0" not in self._buffer:
+            data = await loop.sock_recv(self.sock, 4096)
+            if not data:
+                raise ClamdError("clamd closed the connection")
+            self._buffer += data
+        raw, self._buffer = self._buffer.split(b"\0", 1)
+        self.last_used = time.monotonic()
+        request_id, _, reply = raw.decode(errors="replace").partition(": ")
+        if request_id != str(self._request_id):
+            raise ClamdError(f"Unexpected clamd reply: {raw!r}")
+        return reply
+
+    def close(self) -> None:
+        if self.sock is None:
+            return
+        try:
+            self.sock.send(b"zEND\0")
+        except OSError:
+            pass
+        self.sock.close()
+        self.sock = None
+        metrics.ENGINE_CONNECTIONS.dec(backend="clamd")
+
+
+class ClamdConnectionPool:
+    """A bounded pool of ClamdConnection objects.
+
+    At most `options.pool_size` connections exist at once. Callers beyond that
+    wait until a connection is released. Waiters are woken through their own
+    event loop, so a pool can be shared by scanners running on different loops.
+    """
+
+    def __init__(self, options: ClamdOptions):
+        self.options = options
+        self._idle: collections.deque[ClamdConnection] = collections.deque()
+        self._waiters: collections.deque[asyncio.Future] = collections.deque()
+        self._size = 0
+
+    @property
+    def size(self) -> int:
+        """The number of open or opening connections."""
+        return self._size
+
+    async def acquire(self) -> ClamdConnection:
+        while True:
+            while self._idle:
+                conn = self._idle.popleft()
+                if not conn.is_stale():
+                    return conn
+                conn.close()
+                self._size -= 1
+            if self._size < self.options.pool_size:
+                self._size += 1
+                conn = ClamdConnection(self.options)
+                try:
+                    await conn.connect()
+                except BaseException:
+                    self._size -= 1
+                    self._wake_one()
+                    raise
+                return conn
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                else:
+                    # We were already woken, pass the wake-up on to the next waiter
+                    self._wake_one()
+                raise
+
+    def release(self, conn: ClamdConnection, reuse: bool = True) -> None:
+        if reuse and not conn.closed:
+            self._idle.append(conn)
+        else:
+            conn.close()
+            self._size -= 1
+        self._wake_one()
+
+    @asynccontextmanager
+    async def connection(self) -> AsyncIterator[ClamdConnection]:
+        conn = await self.acquire()
+        reuse = False
+        try:
+            yield conn
+            reuse = True
+        finally:
+            self.release(conn, reuse=reuse)
+
+    def _wake_one(self) -> None:
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.get_loop().call_soon_threadsafe(_set_waiter, waiter)
+                return
+
+    def close(self) -> None:
+        while self._idle:
+            self._idle.popleft().close()
+            self._size -= 1
+
+
+async def _writable(loop: asyncio.AbstractEventLoop, sock: socket.socket) -> None:
+    waiter = loop.create_future()
+    loop.add_writer(sock.fileno(), _set_waiter, waiter)
+    try:
+        await waiter
+    finally:
+        loop.remove_writer(sock.fileno())
+
+
+def _set_waiter(waiter: asyncio.Future) -> None:
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class ClamdSession(ScanSession):
+    """Streams a file to clamd over a pooled connection as its chunks arrive."""
+
+    def __init__(self, engine: "ClamdEngine"):
+        self.engine = engine
+        self.conn: ClamdConnection | None = None
+        self.error: Exception | None = None
+
+    async def start(self) -> None:
+        try:
+            self.conn = await self.engine.pool.acquire()
+            await self.conn.start_instream()
+        except CLAMD_ERRORS as e:
+            self._fail(e)
+
+    async def write(self, chunk: bytes) -> None:
+        if self.conn is None:
+            return
+        try:
+            await self.conn.send_chunk(chunk)
+        except CLAMD_ERRORS as e:
+            self._fail(e)
+
+    async def finish(self) -> Verdict:
+        if self.conn is None:
+            hisss.error(msg=f"clamd scan failed: {self.error!r}")
+            return Verdict.ERROR
+        try:
+            reply = await self.conn.end_instream()
+        except CLAMD_ERRORS as e:
+            self._fail(e)
+            return await self.finish()
+        except BaseException:
+            await self.abort()
+            raise
+        self.engine.pool.release(self.conn)
+        self.conn = None
+        return self.engine.parse_reply(reply)
+
+    async def abort(self) -> None:
+        if self.conn is not None:
+            # The connection is mid-stream, it can't be reused
+            self.engine.pool.release(self.conn, reuse=False)
+            self.conn = None
+
+    def _fail(self, error: Exception) -> None:
+        self.error = error
+        if self.conn is not None:
+            self.engine.pool.release(self.conn, reuse=False)
+            self.conn = None
+
+
+class ClamdEngine(Engine):
+    """Scans files by streaming them to a running clamd with INSTREAM.
+
+    The signature database stays loaded in the daemon, and connections are kept
+    alive in a bounded pool, so a scan only pays for the data transfer and the
+    matching itself. Over a unix socket, files already on disk (e.g. uploads
+    Starlette spooled to a temporary file) skip the transfer too: their
+    descriptor is passed to clamd with FILDES. In-memory files are streamed.
+
+    Attributes:
+        - options (ClamdOptions): Where and how to connect to clamd (default: ClamdOptions())
+    """
+
+    name = "clamd"
+
+    def __init__(self, options: ClamdOptions = ClamdOptions()):
+        self.options = options
+        self.pool = ClamdConnectionPool(options)
+
+    @property
+    def settings(self) -> str:
+        # The scan settings live in the daemon's clamd.conf, so tell daemons apart
+        options = self.options
+        return options.socket_path or f"{options.host}:{options.port}"
+
+    async def scan(self, file) -> Verdict:
+        fd = file_descriptor(file) if self.can_pass_descriptors else None
+        try:
+            async with self.pool.connection() as conn:
+                reply = None
+                if fd is not None:
+                    with tracing.span("hiss.clamd.fildes"):
+                        reply = await conn.fildes(fd)
+                    if reply.endswith(" ERROR"):
+                        hisss.debug(msg=f"FILDES failed, streaming instead: {reply}")
+                        reply = None
+                if reply is None:
+                    with tracing.span("hiss.clamd.instream"):
+                        reply = await conn.instream(
+                            iter_chunks(file, self.options.chunk_size)
+                        )
+        except CLAMD_ERRORS as e:
+            hisss.error(msg=f"clamd scan failed: {e!r}")
+            return Verdict.ERROR
+        return self.parse_reply(reply)
+
+    @property
+    def can_pass_descriptors(self) -> bool:
+        """True when files on disk are handed to clamd as descriptors."""
+        return (
+            self.options.fd_passing
+            and self.options.socket_path is not None
+            and hasattr(socket, "SCM_RIGHTS")
+        )
+
+    async def open_session(self) -> ClamdSession:
+        session = ClamdSession(self)
+        await session.start()
+        return session
+
+    @staticmethod
+    def parse_reply(reply: str) -> Verdict:
+        hisss.debug(msg=reply)
+        if reply.endswith(" FOUND"):
+            return Verdict.INFECTED
+        elif reply.endswith(": OK"):
+            return Verdict.CLEAN
+        return Verdict.ERROR
+
+    async def ping(self) -> bool:
+        try:
+            return await self._command(b"PING") == "PONG"
+        except CLAMD_ERRORS:
+            return False
+
+    async def version(self) -> str | None:
+        try:
+            return await self._command(b"VERSION")
+        except CLAMD_ERRORS:
+            return None
+
+    async def reload(self, version: str | None = None) -> None:
+        # clamd is shared by every worker on the host, and only the first to
+        # hear of an update needs to have it load the new database
+        if version is not None and signature_version(await self.version()) == version:
+            hisss.debug(msg=f"clamd already runs signature version {version}.")
+            return
+        # clamd keeps scanning with the old database until the new one is loaded
+        reply = await self._command(b"RELOAD")
+        if reply != "RELOADING":
+            raise ClamdError(f"Unexpected clamd reply to RELOAD: {reply}")
+
+    async def _command(self, command: bytes) -> str:
+        async with self.pool.connection() as conn:
+            return await conn.command(command)
+
+    async def close(self) -> None:
+        self.pool.close()
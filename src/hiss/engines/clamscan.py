@@ -0,0 +1,231 @@
+"""Contains the ClamscanEngine class, which scans by running the clamscan command line tool"""
+
+import asyncio
+import contextlib
+import inspect
+import json
+import os
+import shutil
+import tempfile
+from io import BytesIO
+from typing import AsyncIterator, List, Sequence
+
+from hiss import metrics, tracing
+from hiss.engines.base import Engine, ScanSession, Verdict, as_file, iter_chunks
+from hiss.logger import Hisss
+from starlette.datastructures import UploadFile
+
+hisss = Hisss()
+
+# Flags that hide per-file results, dropped when parsing the output of a batch
+QUIET_FLAGS = {"--quiet", "--infected", "--suppress-ok-results"}
+
+
+class ClamscanSession(ScanSession):
+    """Pipes a file to a clamscan process as its chunks arrive."""
+
+    def __init__(self, engine: "ClamscanEngine"):
+        self.engine = engine
+        self.process: asyncio.subprocess.Process | None = None
+        self.failed = False
+        self._reaped = False
+
+    async def start(self) -> None:
+        self.process = await self.engine._spawn()
+        metrics.ENGINE_PROCESSES.inc(backend="clamscan")
+
+    async def write(self, chunk: bytes) -> None:
+        if self.failed:
+            return
+        try:
+            self.process.stdin.write(chunk)
+            await self.process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # clamscan exited early, finish() reports its exit code
+            self.failed = True
+
+    async def finish(self) -> Verdict:
+        try:
+            # communicate() only closes stdin itself when given input before 3.12
+            if not self.process.stdin.is_closing():
+                self.process.stdin.close()
+                try:
+                    await self.process.stdin.wait_closed()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+            stdout, stderr = await self.process.communicate()
+        except BaseException:
+            await self.abort()
+            raise
+        self._exited()
+        return self.engine._verdict(self.process, stdout, stderr)
+
+    async def abort(self) -> None:
+        if self.process is not None and self.process.returncode is None:
+            self.process.kill()
+            await self.process.wait()
+        self._exited()
+
+    def _exited(self) -> None:
+        if self.process is not None and not self._reaped:
+            self._reaped = True
+            metrics.ENGINE_PROCESSES.dec(backend="clamscan")
+
+
+class ClamscanEngine(Engine):
+    """Scans files by piping them to a fresh `clamscan` process.
+
+    Every scan reloads the signature database, so this backend is the simplest
+    to deploy but also the slowest.
+
+    Attributes:
+        - command (List[str]): The clamscan command list, as built by ScannerOptions.build_command_list()
+    """
+
+    name = "clamscan"
+
+    def __init__(self, command: List[str]):
+        self.command = command
+
+    @property
+    def settings(self) -> str:
+        return json.dumps(self.command)
+
+    async def scan(self, file: BytesIO | UploadFile) -> Verdict:
+        # Stream the file to clamscan's stdin in chunks instead of reading it whole
+        with tracing.span("hiss.clamscan.spawn"):
+            session = await self.open_session()
+        try:
+            with tracing.span("hiss.clamscan.transfer"):
+                async for chunk in iter_chunks(file):
+                    await session.write(chunk)
+        except BaseException:
+            await session.abort()
+            raise
+        with tracing.span("hiss.clamscan.wait"):
+            return await session.finish()
+
+    async def open_session(self) -> ClamscanSession:
+        session = ClamscanSession(self)
+        await session.start()
+        return session
+
+    async def scan_batch(self, items: Sequence) -> AsyncIterator[tuple[int, Verdict]]:
+        """Scans all the items with a single clamscan run over a --file-list.
+
+        Paths are scanned in place, buffers and file-like objects are written to
+        a temporary directory first. Verdicts are yielded as clamscan prints them,
+        so the database is loaded once for the whole batch.
+        """
+        with tempfile.TemporaryDirectory(prefix="hiss-batch-") as directory:
+            positions: dict[str, list[int]] = {}
+            for position, item in enumerate(items):
+                if isinstance(item, (str, os.PathLike)):
+                    path = os.path.abspath(item)
+                else:
+                    path = os.path.join(directory, str(position))
+                    await _spool(as_file(item), path)
+                positions.setdefault(path, []).append(position)
+            file_list = os.path.join(directory, "file-list")
+            with open(file_list, "w") as f:
+                f.write("\n".join(positions))
+
+            command = [flag for flag in self.command if flag not in QUIET_FLAGS]
+            process = await _start_process(
+                *command,
+                "--no-summary",
+                f"--file-list={file_list}",
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+            metrics.ENGINE_PROCESSES.inc(backend="clamscan")
+            try:
+                async for line in process.stdout:
+                    path, _, result = (
+                        line.decode(errors="replace").rstrip("\n").rpartition(": ")
+                    )
+                    for position in positions.pop(path, ()):
+                        yield position, self._line_verdict(result)
+                await process.wait()
+            finally:
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+                metrics.ENGINE_PROCESSES.dec(backend="clamscan")
+            # Anything clamscan did not report on could not be scanned
+            for remaining in positions.values():
+                for position in remaining:
+                    yield position, Verdict.ERROR
+
+    @staticmethod
+    def _line_verdict(result: str) -> Verdict:
+        if result in ("OK", "Empty file"):
+            return Verdict.CLEAN
+        elif result.endswith(" FOUND"):
+            return Verdict.INFECTED
+        hisss.debug(msg=result)
+        return Verdict.ERROR
+
+    async def _spawn(self) -> asyncio.subprocess.Process:
+        # Read the file from stdin
+        full_command = self.command + ["-"]
+
+        return await _start_process(
+            *full_command,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+
+    def _verdict(
+        self, process: asyncio.subprocess.Process, stdout: bytes, stderr: bytes
+    ) -> Verdict:
+        if stdout:
+            hisss.debug(msg=stdout.decode())
+        if stderr:
+            hisss.debug(msg=stderr.decode())
+
+        if process.returncode == 0:
+            return Verdict.CLEAN
+        elif process.returncode == 1:
+            return Verdict.INFECTED
+        else:
+            return Verdict.ERROR
+
+    async def version(self) -> str | None:
+        process = await asyncio.create_subprocess_exec(
+            self.command[0],
+            "--version",
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        stdout, _ = await process.communicate()
+        if process.returncode != 0:
+            return None
+        return stdout.decode().strip()
+
+
+async def _start_process(*command: str, **kwargs) -> asyncio.subprocess.Process:
+    """Starts a process, killing and reaping it if the caller is cancelled while it starts."""
+    spawn = asyncio.ensure_future(asyncio.create_subprocess_exec(*command, **kwargs))
+    try:
+        return await asyncio.shield(spawn)
+    except asyncio.CancelledError:
+        # The child may already be running, e.g. a scan deadline hit during the fork
+        with contextlib.suppress(Exception):
+            process = await spawn
+            process.kill()
+            await process.wait()
+        raise
+
+
+async def _spool(file, path: str) -> None:
+    """Copies a sync or async file-like object to a file on disk."""
+    with open(path, "wb") as out:
+        if inspect.iscoroutinefunction(file.seek):
+            await file.seek(0)
+            while chunk := await file.read(1024 * 1024):
+                out.write(chunk)
+        else:
+            file.seek(0)
+            shutil.copyfileobj(file, out)
@@ -1,27 +1,84 @@
 """Contains the clamav_scanner decorator function for FastAPI Routes"""
 
-from fastapi import File, UploadFile, HTTPException
-from hiss import Options
-from hiss.scanner import Scanner
-import io
+from fastapi import HTTPException
+from starlette.datastructures import UploadFile
+from hiss import tracing
+from hiss.engines import Verdict
+from hiss.options import ScannerOptions as Options
+from hiss.scanner import ScanGroup, Scanner, ScannerBusy, get_scanner
 import functools
+import math
 
 
-def scan_upload(scanner_options: Options = None):
+def _upload_files(arguments: dict) -> list[UploadFile]:
+    """Finds the UploadFile and List[UploadFile] arguments of an endpoint call."""
+    files = []
+    for value in arguments.values():
+        if isinstance(value, UploadFile):
+            files.append(value)
+        elif isinstance(value, (list, tuple)):
+            files.extend(item for item in value if isinstance(item, UploadFile))
+    return files
+
+
+def scan_upload(
+    scanner_options: Options = None,
+    scanner: Scanner | None = None,
+    max_concurrency: int = 4,
+    busy_status_code: int = 503,
+    fail_open: bool = False,
+):
+    """Rejects the request with a 400 unless every uploaded file of the endpoint is clean.
+
+    Works with `UploadFile` and `List[UploadFile]` parameters. The files of a
+    request are scanned concurrently, up to `max_concurrency` at once, and the
+    remaining scans are cancelled as soon as one file is infected. When the
+    scheduler has no room for the scans, the request is answered with
+    `busy_status_code` (503, or 429) and a Retry-After header, and so is it
+    while the scanner's circuit breaker is open, unless `fail_open` lets the
+    files of this route through unscanned.
+    """
     if scanner_options is None:
         scanner_options = Options()
 
     def decorator(func):
         @functools.wraps(func)
-        async def wrapper(file: UploadFile = File(...)):
-            scanner = Scanner(options=scanner_options)
-            bytes_io = io.BytesIO(await file.read())
-            bytes_io.seek(0)
-            is_clean = await scanner.scan_file(bytes_io)
-            if is_clean:
-                return await func(file)
-            else:
+        async def wrapper(*args, **kwargs):
+            nonlocal scanner
+            if scanner is None:
+                scanner = get_scanner(scanner_options)
+            accept = {Verdict.CLEAN}
+            if fail_open:
+                accept.add(Verdict.UNAVAILABLE)
+            group = ScanGroup(max_concurrency, accept)
+            files = _upload_files(kwargs)
+            try:
+                with tracing.span("hiss.scan_upload", files=len(files)):
+                    for file in files:
+                        await group.add(file.filename, scanner.scan(file))
+                    is_clean = await group.wait()
+            except ScannerBusy as e:
+                raise HTTPException(
+                    status_code=busy_status_code,
+                    detail="Scanner is busy, try again later",
+                    headers={"Retry-After": str(math.ceil(e.retry_after))},
+                )
+            finally:
+                await group.cancel()
+            if not is_clean and group.unavailable:
+                breaker = getattr(scanner, "breaker", None)
+                retry_after = breaker.retry_after if breaker is not None else 1
+                raise HTTPException(
+                    status_code=busy_status_code,
+                    detail="Scanner is unavailable, try again later",
+                    headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+                )
+            if not is_clean:
                 raise HTTPException(status_code=400, detail="File is infected")
+            for file in files:
+                await file.seek(0)
+            with tracing.span("hiss.endpoint"):
+                return await func(*args, **kwargs)
 
         return wrapper
 
@@ -1,41 +1,389 @@
-from starlette.middleware.base import BaseHTTPMiddleware
-from hiss.scanner import Scanner
+"""Contains the FileUploadScanMiddleware class, which scans multipart uploads as they stream in"""
+
+import math
+import tempfile
+from typing import Callable
+
+from hiss import tracing
+from hiss.engines import Verdict
+from hiss.scanner import (
+    ScanGroup,
+    Scanner,
+    ScannerBusy,
+    ScannerSession,
+    get_scanner,
+)
 from hiss.logger import Hisss
-from starlette.datastructures import UploadFile
+from starlette.datastructures import Headers, UploadFile
 from starlette.requests import Request
 from starlette.responses import Response
-from starlette.middleware.base import RequestResponseEndpoint
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:  # python-multipart < 0.0.13
+    from multipart.multipart import MultipartParser, parse_options_header
 
 guard_log = Hisss()
 
+# Request bodies are kept in memory up to this size, then spooled to disk
+SPOOL_MAX_SIZE = 1024 * 1024
+# Size of the body chunks replayed to the application
+REPLAY_CHUNK_SIZE = 64 * 1024
+# Files of a single request scanned at the same time
+MAX_CONCURRENT_SCANS = 4
+# Bytes of a file part held back to learn its size before its scan is started
+SIZE_LOOKAHEAD = 256 * 1024
+# Verdicts letting an upload through, failing closed or open while the engine is unavailable
+ACCEPT = frozenset({Verdict.CLEAN})
+ACCEPT_FAIL_OPEN = frozenset({Verdict.CLEAN, Verdict.UNAVAILABLE})
+
+
+class MultipartScan:
+    """Parses a multipart/form-data body as it arrives and streams every file part into its own scan.
+
+    Parts arrive one after the other, but a part's scan keeps running in a
+    ScanGroup while the next ones are received, so up to `max_concurrency`
+    files of the request are scanned at once.
+
+    So the scheduler can keep large files in their own lane, a part's scan
+    starts once its size is known: the first `SIZE_LOOKAHEAD` bytes are held
+    back, and a part ending within them is scanned with its exact size. Longer
+    parts are sized by their own Content-Length header if they have one, else
+    by what is left of the request's Content-Length, an upper bound that is
+    exact for the last part.
+    """
+
+    def __init__(
+        self,
+        boundary: bytes,
+        scanner: Scanner,
+        max_concurrency: int = MAX_CONCURRENT_SCANS,
+        busy_status_code: int = 503,
+        content_length: int | None = None,
+        accept: set[Verdict] = ACCEPT,
+    ):
+        self.scanner = scanner
+        self.content_length = content_length
+        self.group = ScanGroup(max_concurrency, accept)
+        self._events: list[tuple[str, bytes]] = []
+        self._header_field = b""
+        self._header_value = b""
+        self._headers: dict[bytes, bytes] = {}
+        self._session: ScannerSession | None = None
+        self._filename: str | None = None
+        # Data of the current file part received before its session is opened
+        self._pending: list[bytes] | None = None
+        self._pending_size = 0
+        self._size_hint: int | None = None
+        self._received = 0
+        self._parser = MultipartParser(
+            boundary,
+            {
+                "on_part_begin": lambda: self._events.append(("part_begin", b"")),
+                "on_part_data": lambda data, start, end: self._events.append(
+                    ("part_data", data[start:end])
+                ),
+                "on_part_end": lambda: self._events.append(("part_end", b"")),
+                "on_header_field": lambda data, start, end: self._events.append(
+                    ("header_field", data[start:end])
+                ),
+                "on_header_value": lambda data, start, end: self._events.append(
+                    ("header_value", data[start:end])
+                ),
+                "on_header_end": lambda: self._events.append(("header_end", b"")),
+                "on_headers_finished": lambda: self._events.append(
+                    ("headers_finished", b"")
+                ),
+            },
+        )
+
+    @property
+    def infected(self) -> bool:
+        return self.group.rejected
+
+    async def feed(self, chunk: bytes) -> None:
+        """Parses the next chunk of the body and forwards file data to the scanner."""
+        # Bytes of the body the parts starting in this chunk can still span
+        remaining = (
+            self.content_length - self._received
+            if self.content_length is not None
+            else None
+        )
+        self._received += len(chunk)
+        self._parser.write(chunk)
+        events, self._events = self._events, []
+        for event, data in events:
+            if self.infected:
+                # The request is rejected, nothing after the infected part needs scanning
+                break
+            if event == "part_begin":
+                self._headers = {}
+            elif event == "header_field":
+                self._header_field += data
+            elif event == "header_value":
+                self._header_value += data
+            elif event == "header_end":
+                self._headers[self._header_field.lower()] = self._header_value
+                self._header_field = self._header_value = b""
+            elif event == "headers_finished":
+                await self._start_file(remaining)
+            elif event == "part_data" and self._session is not None:
+                await self._session.write(data)
+            elif event == "part_data" and self._pending is not None:
+                self._pending.append(data)
+                self._pending_size += len(data)
+                if self._pending_size > SIZE_LOOKAHEAD:
+                    await self._open_session(self._size_hint)
+            elif event == "part_end":
+                if self._pending is not None:
+                    await self._open_session(self._pending_size)
+                if self._session is not None:
+                    session, self._session = self._session, None
+                    self.group.start(
+                        self._filename, self._finish(self._filename, session)
+                    )
+
+    async def _start_file(self, remaining: int | None) -> None:
+        _, params = parse_options_header(self._headers.get(b"content-disposition", b""))
+        if b"filename" not in params:
+            return
+        self._filename = params[b"filename"].decode("latin-1")
+        await self.group.reserve()
+        if not self.infected:
+            length = self._headers.get(b"content-length", b"").strip()
+            self._size_hint = int(length) if length.isdigit() else remaining
+            self._pending = []
+            self._pending_size = 0
+
+    async def _open_session(self, size: int | None) -> None:
+        """Starts the scan of the current part and hands it the data held back so far."""
+        pending, self._pending = self._pending, None
+        self._session = await self.scanner.open_session(size)
+        for data in pending:
+            await self._session.write(data)
+
+    async def _finish(self, filename: str, session: ScannerSession) -> Verdict:
+        verdict = await session.finish()
+        guard_log.debug(msg=f"Virus Detected: {verdict is not Verdict.CLEAN}")
+        if verdict is Verdict.CLEAN:
+            guard_log.info(msg=f"File {filename} is clean.")
+        elif verdict is Verdict.UNAVAILABLE:
+            guard_log.warning(
+                msg=f"File {filename} was not scanned, engine unavailable."
+            )
+        elif verdict is Verdict.TIMEOUT:
+            guard_log.warning(msg=f"File {filename} was not scanned in time.")
+        else:
+            guard_log.critical(msg=f"File {filename} is infected.")
+        return verdict
+
+    async def complete(self) -> None:
+        """Waits for the scans of the parts already received."""
+        await self.group.wait()
+
+    async def abort(self) -> None:
+        """Aborts the part being received and cancels the scans still running."""
+        self._pending = None
+        if self._session is not None:
+            await self._session.abort()
+            self._session = None
+        await self.group.cancel()
+
+
+class FileUploadScanMiddleware:
+    """ASGI middleware scanning every file uploaded with multipart/form-data.
+
+    The body is parsed as it is received and each file part is streamed
+    straight into the scanner, so scanning overlaps with the upload. The body
+    is spooled (in memory up to `spool_max_size`, then on disk) and replayed
+    to the application once every file came back clean, so memory stays
+    bounded however large the upload is.
+
+    With `abort_on_infection`, the middleware stops reading the request as soon
+    as a file comes back infected: the rejection is sent with `Connection: close`
+    and the rest of the body is never received or scanned. Otherwise the body
+    is drained first, for clients that can't handle an early response.
+
+    While the scanner's circuit breaker is open, uploads fail closed with
+    `busy_status_code` and a Retry-After header, unless `fail_open` lets them
+    through unscanned. `fail_open` is either a flag or a function of the ASGI
+    scope, to choose per route.
+
+    Attributes:
+        - scanner (Scanner): The scanner used for every upload, resolved at application startup or on the first request (default: the shared get_scanner())
+        - spool_max_size (int): Bytes of the body kept in memory before spooling to disk (default: 1MiB)
+        - abort_on_infection (bool): Reject and close the connection without reading the rest of the body (default: True)
+        - max_concurrency (int): Files of a single request scanned at the same time (default: 4)
+        - busy_status_code (int): Status sent with a Retry-After header when the scanner's scheduler is full, 503 or 429 (default: 503)
+        - fail_open (bool | Callable[[Scope], bool]): Accept uploads unscanned while the circuit breaker is open (default: False)
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        scanner: Scanner | None = None,
+        spool_max_size: int = SPOOL_MAX_SIZE,
+        abort_on_infection: bool = True,
+        max_concurrency: int = MAX_CONCURRENT_SCANS,
+        busy_status_code: int = 503,
+        fail_open: bool | Callable[[Scope], bool] = False,
+    ):
+        self.app = app
+        # Building the default scanner discovers clamconf, which doesn't belong at import time
+        self._scanner = scanner
+        self.spool_max_size = spool_max_size
+        self.abort_on_infection = abort_on_infection
+        self.max_concurrency = max_concurrency
+        self.busy_status_code = busy_status_code
+        self.fail_open = fail_open
+
+    @property
+    def scanner(self) -> Scanner:
+        if self._scanner is None:
+            self._scanner = get_scanner()
+        return self._scanner
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "lifespan" and self._scanner is None:
+            # Build the shared scanner at startup rather than on the first upload
+            self._scanner = get_scanner()
+        if scope["type"] != "http" or scope["method"] != "POST":
+            await self.app(scope, receive, send)
+            return
+        headers = Headers(scope=scope)
+        content_type, params = parse_options_header(headers.get("content-type", ""))
+        if content_type != b"multipart/form-data" or b"boundary" not in params:
+            await self.app(scope, receive, send)
+            return
+
+        with tracing.span("hiss.upload", path=scope.get("path")):
+            await self._scan_upload(scope, receive, send, headers, params)
+
+    async def _scan_upload(
+        self,
+        scope: Scope,
+        receive: Receive,
+        send: Send,
+        headers: Headers,
+        params: dict[bytes, bytes],
+    ) -> None:
+        spool = tempfile.SpooledTemporaryFile(max_size=self.spool_max_size)
+        try:
+            content_length = headers.get("content-length")
+            scan = MultipartScan(
+                params[b"boundary"],
+                self.scanner,
+                self.max_concurrency,
+                content_length=int(content_length)
+                if content_length and content_length.isdigit()
+                else None,
+                accept=ACCEPT_FAIL_OPEN if self._fails_open(scope) else ACCEPT,
+            )
+            try:
+                with tracing.span("hiss.receive_body"):
+                    received = await self._receive_body(receive, spool, scan)
+                if received:
+                    with tracing.span("hiss.scan_wait"):
+                        await scan.complete()
+            except ScannerBusy as e:
+                guard_log.warning(msg=f"Upload refused: {e}")
+                response = Response(
+                    content="Scanner is busy, try again later.",
+                    status_code=self.busy_status_code,
+                    headers={
+                        "Retry-After": str(math.ceil(e.retry_after)),
+                        "Connection": "close",
+                    },
+                )
+                await response(scope, receive, send)
+                return
+            finally:
+                await scan.abort()
+            if not received:
+                return
+            if scan.infected and scan.group.unavailable:
+                guard_log.warning(msg="Upload refused, scan engine unavailable.")
+                breaker = getattr(self.scanner, "breaker", None)
+                retry_after = breaker.retry_after if breaker is not None else 1
+                response = Response(
+                    content="Scanner is unavailable, try again later.",
+                    status_code=self.busy_status_code,
+                    headers={
+                        "Retry-After": str(max(1, math.ceil(retry_after))),
+                        "Connection": "close",
+                    },
+                )
+                await response(scope, receive, send)
+                return
+            if scan.infected:
+                response = Response(
+                    content="Infected file detected. File upload rejected.",
+                    status_code=400,
+                    # The unread rest of the body leaves the connection unusable
+                    headers={"Connection": "close"}
+                    if self.abort_on_infection
+                    else None,
+                )
+                await response(scope, receive, send)
+                return
+            with tracing.span("hiss.app"):
+                await self.app(scope, self._replay(spool, receive), send)
+        finally:
+            spool.close()
+
+    def _fails_open(self, scope: Scope) -> bool:
+        if callable(self.fail_open):
+            return self.fail_open(scope)
+        return self.fail_open
+
+    async def _receive_body(
+        self,
+        receive: Receive,
+        spool: tempfile.SpooledTemporaryFile,
+        scan: MultipartScan,
+    ) -> bool:
+        """Receives the body into the spool while scanning it. Returns False if the client disconnected.
+
+        Stops early, leaving the rest of the body unread, once a file is infected and `abort_on_infection` is set.
+        """
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return False
+            body = message.get("body", b"")
+            if body and not scan.infected:
+                spool.write(body)
+                await scan.feed(body)
+            if scan.infected and self.abort_on_infection:
+                guard_log.debug(
+                    msg="Infected upload, rejecting without reading the rest."
+                )
+                return True
+            if not message.get("more_body", False):
+                return True
+
+    def _replay(
+        self, spool: tempfile.SpooledTemporaryFile, receive: Receive
+    ) -> Receive:
+        size = spool.tell()
+        spool.seek(0)
+        replayed = False
+
+        async def replay() -> Message:
+            nonlocal replayed
+            if replayed:
+                return await receive()
+            chunk = spool.read(REPLAY_CHUNK_SIZE)
+            more_body = spool.tell() < size
+            replayed = not more_body
+            return {"type": "http.request", "body": chunk, "more_body": more_body}
 
-class FileUploadScanMiddleware(BaseHTTPMiddleware):
-    async def dispatch(
-        self, request: Request, call_next: RequestResponseEndpoint
-    ) -> Response:
-        await (
-            request.body()
-        )  # DO NOT REMOVE OR ELSE IT DOES NOT WORK AND THROWS 422 I DO NOT KNOW WHY LOL
-        if request.method == "POST" and request.headers.get(
-            "content-type", ""
-        ).startswith("multipart/form-data"):
-            form = await request.form()
-            for form_field, upload_file in form.items():
-                if isinstance(upload_file, UploadFile):
-                    virus_was_detected = await self.detect_virus(upload_file)
-                    guard_log.debug(msg=f"Virus Detected: {virus_was_detected}")
-                    if virus_was_detected:
-                        return Response(
-                            content="Infected file detected. File upload rejected.",
-                            status_code=400,
-                        )
-        response = await call_next(request)
-        return response
+        return replay
 
     async def detect_virus(self, file: UploadFile):
-        scanner = Scanner()
         file.file.seek(0)
-        result = await scanner.scan_file(file)
+        result = await self.scanner.scan_file(file)
         if not result:
             guard_log.critical(msg=f"File {file.filename} is infected.")
             return True
@@ -50,10 +398,10 @@ class FileUploadScanMiddleware(BaseHTTPMiddleware):
         guard_log.debug(msg=f"Request Headers: {request.headers}")
         guard_log.debug(msg=f"Request Query Parameters: {request.query_params}")
         guard_log.debug(
-            msg=f"Request Client Host: {request.client.host if request.client else "Client host unknown"}"
+            msg=f"Request Client Host: {request.client.host if request.client else 'Client host unknown'}"
         )
         guard_log.debug(
-            msg=f"Request Client Port: {request.client.port if request.client else "Client port unknown"}"
+            msg=f"Request Client Port: {request.client.port if request.client else 'Client port unknown'}"
         )
         item_id = request.path_params.get("item_id", "Unknown")
         guard_log.debug(f"Request Path parameter item_id: {item_id}")
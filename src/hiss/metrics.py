@@ -0,0 +1,355 @@
+"""Contains the MetricsRegistry class, which collects counters, gauges and histograms about scans and exposes them to Prometheus"""
+
+import bisect
+import math
+import threading
+from typing import Iterable, Iterator, NamedTuple
+
+from starlette.types import Receive, Scope, Send
+
+# Seconds, from a cached verdict to a large archive
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# Size classes scans are broken down by, as (upper bound in bytes, label)
+SIZE_CLASSES = (
+    (64 * 1024, "64KiB"),
+    (1024 * 1024, "1MiB"),
+    (16 * 1024 * 1024, "16MiB"),
+    (256 * 1024 * 1024, "256MiB"),
+)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def size_class(size: int | None) -> str:
+    """Returns the size class label of a file of `size` bytes, e.g. "1MiB" for up to 1MiB."""
+    if size is None:
+        return "unknown"
+    for bound, label in SIZE_CLASSES:
+        if size <= bound:
+            return label
+    return "large"
+
+
+class Sample(NamedTuple):
+    name: str
+    labels: dict[str, str]
+    value: float
+
+
+class Metric:
+    """A named family of series, one per combination of label values.
+
+    Counter and histogram updates return straight away while the registry is
+    disabled, so instrumented code costs one attribute check when metrics are
+    off. Gauges always track their value, since they mirror live state, e.g.
+    scans holding a slot, that was entered before the registry was enabled.
+    """
+
+    type = "untyped"
+
+    @property
+    def family(self) -> str:
+        """The name the metric is exposed under."""
+        return self.name
+
+    def __init__(
+        self,
+        registry: "MetricsRegistry",
+        name: str,
+        help: str,
+        labelnames: Iterable[str] = (),
+    ):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _labels(self, key: tuple[str, ...]) -> dict[str, str]:
+        return dict(zip(self.labelnames, key))
+
+    def samples(self) -> Iterator[Sample]:
+        raise NotImplementedError
+
+    def clear(self) -> None:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """A value that only goes up, e.g. the number of scans."""
+
+    type = "counter"
+
+    @property
+    def family(self) -> str:
+        return f"{self.name}_total"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> Iterator[Sample]:
+        for key, value in list(self._values.items()):
+            yield Sample(self.family, self._labels(key), value)
+
+    def clear(self) -> None:
+        self._values = {}
+
+
+class Gauge(Metric):
+    """A value that goes up and down, e.g. the number of scans waiting for a slot."""
+
+    type = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels: str) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> Iterator[Sample]:
+        for key, value in list(self._values.items()):
+            yield Sample(self.name, self._labels(key), value)
+
+    def clear(self) -> None:
+        self._values = {}
+
+
+class Histogram(Metric):
+    """Counts observations, e.g. scan durations, into cumulative buckets."""
+
+    type = "histogram"
+
+    def __init__(self, *args, buckets: Iterable[float] = LATENCY_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+        # Per series: a count per bucket (the last one is +Inf), then the sum
+        self._values: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            series[0][index] += 1
+            series[1][0] += value
+
+    def count(self, **labels: str) -> int:
+        series = self._values.get(self._key(labels))
+        return sum(series[0]) if series is not None else 0
+
+    def samples(self) -> Iterator[Sample]:
+        for key, (counts, total) in list(self._values.items()):
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield Sample(
+                    f"{self.name}_bucket", {**labels, "le": _format(bound)}, cumulative
+                )
+            yield Sample(f"{self.name}_sum", labels, total[0])
+            yield Sample(f"{self.name}_count", labels, cumulative)
+
+    def clear(self) -> None:
+        self._values = {}
+
+
+class MetricsRegistry:
+    """The metrics of the process, rendered in the Prometheus text format.
+
+    The registry starts disabled: counters and histograms ignore updates and
+    nothing is exposed until `enable()`, while gauges keep tracking their value.
+    `render()` is the Prometheus exposition, served by `metrics_app`; other
+    exporters can read the raw samples of each metric from `metrics`.
+
+    Attributes:
+        - enabled (bool): Whether updates are recorded and exposed (default: False)
+        - metrics (dict[str, Metric]): Every registered metric by name
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.metrics: dict[str, Metric] = {}
+
+    def _register(self, metric: Metric) -> Metric:
+        existing = self.metrics.get(metric.name)
+        if existing is not None:
+            if type(existing) is not type(metric):
+                raise ValueError(f"Metric {metric.name} is already a {existing.type}")
+            return existing
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self._register(Counter(self, name, help, labelnames))
+
+    def gauge(self, name: str, help: str, labelnames: Iterable[str] = ()) -> Gauge:
+        return self._register(Gauge(self, name, help, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labelnames: Iterable[str] = (),
+        buckets: Iterable[float] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self._register(Histogram(self, name, help, labelnames, buckets=buckets))
+
+    def enable(self) -> None:
+        self.enabled = True
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    def clear(self) -> None:
+        """Drops every recorded value, keeping the metrics registered."""
+        for metric in self.metrics.values():
+            metric.clear()
+
+    def render(self) -> str:
+        """Returns every metric in the Prometheus text exposition format, nothing while disabled."""
+        if not self.enabled:
+            return ""
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.family} {_escape(metric.help)}")
+            lines.append(f"# TYPE {metric.family} {metric.type}")
+            for sample in metric.samples():
+                if sample.labels:
+                    labels = ",".join(
+                        f'{name}="{_escape(value)}"'
+                        for name, value in sample.labels.items()
+                    )
+                    lines.append(f"{sample.name}{{{labels}}} {_format(sample.value)}")
+                else:
+                    lines.append(f"{sample.name} {_format(sample.value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _format(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+registry = MetricsRegistry()
+
+
+async def metrics_app(scope: Scope, receive: Receive, send: Send) -> None:
+    """ASGI app serving the registry in the Prometheus text format, e.g. app.mount("/metrics", metrics_app)."""
+    body = registry.render().encode()
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", CONTENT_TYPE.encode())],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+# Scans
+SCAN_SECONDS = registry.histogram(
+    "hiss_scan_duration_seconds",
+    "Time engines took to scan a file",
+    ("backend", "size"),
+)
+SCANNED_BYTES = registry.counter(
+    "hiss_scanned_bytes", "Bytes handed to the engines", ("backend",)
+)
+VERDICTS = registry.counter(
+    "hiss_verdicts", "Verdicts returned by scanners", ("verdict",)
+)
+SKIPPED_SCANS = registry.counter(
+    "hiss_skipped_scans",
+    "Scans answered without the engine, by reason (cache, trusted, known_bad, coalesced)",
+    ("reason",),
+)
+SCAN_TIMEOUTS = registry.counter(
+    "hiss_scan_timeouts",
+    "Scans given up on, by reason (deadline, idle)",
+    ("reason",),
+)
+CACHE_LOOKUPS = registry.counter(
+    "hiss_cache_lookups", "Verdict cache lookups", ("result",)
+)
+
+# Admission control
+ACTIVE_SCANS = registry.gauge("hiss_active_scans", "Scans holding a scheduler slot")
+QUEUE_DEPTH = registry.gauge("hiss_queue_depth", "Scans waiting for a scheduler slot")
+QUEUE_WAIT_SECONDS = registry.histogram(
+    "hiss_queue_wait_seconds", "Time scans waited for a scheduler slot"
+)
+ADMISSIONS = registry.counter(
+    "hiss_admissions",
+    "Scheduler decisions (admitted, rejected, timed_out)",
+    ("result",),
+)
+
+# Engines
+ENGINE_PROCESSES = registry.gauge(
+    "hiss_engine_processes", "Scan processes running", ("backend",)
+)
+ENGINE_CONNECTIONS = registry.gauge(
+    "hiss_engine_connections", "Connections open to the scan daemon", ("backend",)
+)
+
+# Circuit breaker
+BREAKER_STATE = registry.gauge(
+    "hiss_breaker_state",
+    "1 for each circuit breaker's current state",
+    ("breaker", "state"),
+)
+BREAKER_TRANSITIONS = registry.counter(
+    "hiss_breaker_transitions",
+    "Circuit breaker state changes",
+    ("breaker", "previous", "state"),
+)
+
+# Signature updates
+UPDATE_SECONDS = registry.histogram(
+    "hiss_freshclam_duration_seconds",
+    "Time freshclam runs took",
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600),
+)
+UPDATES = registry.counter(
+    "hiss_freshclam_runs", "freshclam runs (updated, current, failed)", ("result",)
+)
+SIGNATURE_VERSION = registry.gauge(
+    "hiss_signature_version", "Version of the daily signature database"
+)
@@ -2,7 +2,9 @@
 
 from typing import List, Literal
 
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
+import asyncio
+import functools
 import re
 import subprocess
 from hiss.logger import Hisss
@@ -70,6 +72,54 @@ PUA_TYPES = Literal[
 
 YON = Literal["yes", "no"]
 
+SIZE_SUFFIXES = {"k": 1024, "m": 1024 * 1024}
+
+
+CLAMCONF_DATABASE_PATTERN = r"DatabaseDirectory\s*=\s*\"?([^\"\n]+)"
+
+# The database directory reported by clamconf, looked up once per process
+_virus_db_directory: str | None = None
+
+
+def _parse_clamconf(output: str) -> str:
+    global _virus_db_directory
+    # Use a regular expression to find the line containing the database directory
+    match = re.search(CLAMCONF_DATABASE_PATTERN, output, re.MULTILINE)
+    if not match:
+        raise ValueError("Unable to find virus database directory in clamconf output.")
+    _virus_db_directory = match.group(1)
+    return _virus_db_directory
+
+
+async def discover_virus_db_directory() -> str:
+    """Finds the signature database directory with clamconf without blocking the event loop.
+
+    The result is kept for the lifetime of the process, so calling this at
+    startup means no scanner ever runs clamconf on a request path.
+    """
+    if _virus_db_directory is not None:
+        return _virus_db_directory
+    process = await asyncio.create_subprocess_exec(
+        "clamconf",
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    stdout, stderr = await process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError(f"Error executing clamconf: {stderr.decode()}")
+    return _parse_clamconf(stdout.decode())
+
+
+def parse_size(value: int | str) -> int:
+    """Converts a ClamAV size value ("100M", "500k", 1024) into bytes."""
+    if isinstance(value, int):
+        return value
+    value = value.strip()
+    multiplier = SIZE_SUFFIXES.get(value[-1:].lower())
+    if multiplier is None:
+        return int(value)
+    return int(value[:-1]) * multiplier
+
 
 class ScannerOptions(BaseModel):
     """Builder class for configuring ClamAVScanner options.
@@ -168,8 +218,13 @@ class ScannerOptions(BaseModel):
         - pcre_recmatch_limit (int): Maximum recursive calls to the PCRE match function (default: 2000).
         - pcre_max_filesize (int): Maximum size file to perform PCRE subsig matching (default: 100 MB).
         - disable_cache (bool): Disable caching and cache checks for hash sums of scanned files (default: None)
+
+    Options are frozen and hashable, so the command list built from them is
+    memoized per options value and scanners can be shared by options.
     """
 
+    model_config = ConfigDict(frozen=True)
+
     # Non-ClamAV related
     command: str = "clamscan"
 
@@ -262,32 +317,38 @@ class ScannerOptions(BaseModel):
     pcre_max_filesize: int = 100000000
     disable_cache: bool = False
 
+    def __hash__(self) -> int:
+        # List fields (include_pua, exclude_pua) aren't hashable, hash the serialized values instead
+        return hash(self.model_dump_json())
+
     def get_virus_db_directory(self):
+        """Returns the database directory reported by clamconf, running it only the first time.
+
+        Prefer awaiting `discover_virus_db_directory()` at startup, which doesn't block the event loop.
+        """
+        if _virus_db_directory is not None:
+            return _virus_db_directory
         try:
             # Execute the clamconf command and capture its output
             output = subprocess.check_output(["clamconf"], text=True)
-
-            # Use a regular expression to find the line containing the database directory
-            pattern = r"DatabaseDirectory\s*=\s*\"?([^\"\n]+)"
-            match = re.search(pattern, output, re.MULTILINE)
-
-            if match:
-                return match.group(1)
-            else:
-                raise ValueError(
-                    "Unable to find virus database directory in clamconf output."
-                )
-
         except subprocess.CalledProcessError as e:
             raise RuntimeError(f"Error executing clamconf: {e.stderr}") from e
+        return _parse_clamconf(output)
 
     def build_command_list(self) -> List[str]:
         """Builds a list of command arguments based on the set attributes.
+
+        The list is built once per options value and copied on every call.
+
         Returns:
             List[str]: A list of command-line arguments for ClamAV.
         """
-        if self.database is None:
-            self.database = self.get_virus_db_directory()
+        return list(_command_list(self))
+
+    def _build_command_list(self) -> tuple[str, ...]:
+        database = self.database
+        if database is None:
+            database = self.get_virus_db_directory()
         command_list = [self.command]
         pure_flags = set(
             [
@@ -318,6 +379,8 @@ class ScannerOptions(BaseModel):
                 command_list.append(f"--copy={field_value}")
             elif field_name == "command":
                 continue
+            elif field_name == "database":
+                command_list.append(f"{flagged_field_name}={database}")
             # Handle pure flags
             elif field_name in pure_flags:
                 if field_value:
@@ -332,4 +395,34 @@ class ScannerOptions(BaseModel):
             else:
                 hisss.debug(msg=f"Field Name: {field_name} Field Value: {field_value}")
 
-        return command_list
+        return tuple(command_list)
+
+
+@functools.lru_cache(maxsize=64)
+def _command_list(options: ScannerOptions) -> tuple[str, ...]:
+    return options._build_command_list()
+
+
+class ClamdOptions(BaseModel):
+    """Builder class for configuring how the ClamdEngine reaches clamd.
+
+    Attributes:
+
+        - socket_path (str): Path to clamd's LocalSocket. Takes precedence over host/port when set (default: None)
+        - host (str): Host clamd listens on with TCPSocket (default: "127.0.0.1")
+        - port (int): Port clamd listens on with TCPSocket (default: 3310)
+        - pool_size (int): Maximum number of connections kept open to clamd (default: 4)
+        - connect_timeout (float): Seconds to wait for a connection to clamd (default: 5.0)
+        - idle_timeout (float): Seconds after which an idle pooled connection is discarded. Keep it below clamd's IdleTimeout (default: 25.0)
+        - chunk_size (int): Size of the INSTREAM chunks sent to clamd in bytes. Keep it below clamd's StreamMaxLength (default: 65536)
+        - fd_passing (bool): Over a unix socket, hand files that live on disk to clamd as descriptors (FILDES) instead of streaming them (default: True)
+    """
+
+    socket_path: str | None = None
+    host: str = "127.0.0.1"
+    port: int = 3310
+    pool_size: int = 4
+    connect_timeout: float = 5.0
+    idle_timeout: float = 25.0
+    chunk_size: int = 64 * 1024
+    fd_passing: bool = True
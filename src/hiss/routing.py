@@ -0,0 +1,184 @@
+"""Contains the ProfileRouter class, which sends each file to the scan profile matching its type"""
+
+import inspect
+import os
+
+from hiss.engines import Verdict
+from hiss.engines.base import BUFFER_TYPES
+from hiss.logger import Hisss
+from hiss.options import ScannerOptions as Options
+from hiss.scanner import ScanInput, Scanner, ScannerSession, get_scanner
+
+hisss = Hisss()
+
+# Bytes of the file looked at to tell its type (the tar magic sits at offset 257)
+HEAD_SIZE = 512
+
+# File type by magic bytes, each entry a list of (offset, bytes) that must all match
+MAGIC: list[tuple[str, tuple[tuple[int, bytes], ...]]] = [
+    ("image", ((0, b"\x89PNG\r\n\x1a\n"),)),
+    ("image", ((0, b"\xff\xd8\xff"),)),
+    ("image", ((0, b"GIF87a"),)),
+    ("image", ((0, b"GIF89a"),)),
+    ("image", ((0, b"RIFF"), (8, b"WEBP"))),
+    ("image", ((0, b"II*\x00"),)),
+    ("image", ((0, b"MM\x00*"),)),
+    ("pdf", ((0, b"%PDF-"),)),
+    ("office", ((0, b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"),)),
+    ("archive", ((0, b"PK\x03\x04"),)),
+    ("archive", ((0, b"PK\x05\x06"),)),
+    ("archive", ((0, b"\x1f\x8b"),)),
+    ("archive", ((0, b"BZh"),)),
+    ("archive", ((0, b"\xfd7zXZ\x00"),)),
+    ("archive", ((0, b"7z\xbc\xaf\x27\x1c"),)),
+    ("archive", ((0, b"Rar!\x1a\x07"),)),
+    ("archive", ((0, b"MSCF"),)),
+    ("archive", ((257, b"ustar"),)),
+    ("executable", ((0, b"MZ"),)),
+    ("executable", ((0, b"\x7fELF"),)),
+    ("executable", ((0, b"\xcf\xfa\xed\xfe"),)),
+    ("executable", ((0, b"\xca\xfe\xba\xbe"),)),
+]
+
+
+def sniff(head: bytes) -> str:
+    """Tells the type of a file from its first bytes.
+
+    Returns:
+        str: One of "image", "pdf", "office", "archive", "executable", or "other".
+    """
+    for kind, magic in MAGIC:
+        if all(head[offset : offset + len(value)] == value for offset, value in magic):
+            return kind
+    return "other"
+
+
+async def read_head(file: ScanInput, size: int = HEAD_SIZE) -> bytes:
+    """Reads the first bytes of a file-like object, buffer or path, leaving file-like objects rewound."""
+    if isinstance(file, BUFFER_TYPES):
+        return bytes(memoryview(file)[:size])
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, "rb") as f:
+            return f.read(size)
+    if inspect.iscoroutinefunction(file.seek):
+        await file.seek(0)
+        head = await file.read(size)
+        await file.seek(0)
+    else:
+        file.seek(0)
+        head = file.read(size)
+        file.seek(0)
+    return bytes(head)
+
+
+class ProfileRouter:
+    """Scans each file with the scanner of the profile its type maps to.
+
+    The type is sniffed from the magic bytes at the start of the file, e.g.
+    "image" or "archive", and looked up in `routes` to find the profile name.
+    Types without a route use the profile of the same name, and unknown
+    profiles fall back to `default`. A profile is either a Scanner, which can
+    have its own engine pool, or ScannerOptions, resolved with get_scanner().
+    Cheap types can then get a tight budget (e.g. a low `max_scantime` and
+    `scan_archive="no"` for images) while archives get the full treatment on
+    engines of their own.
+
+    The router has the `scan`, `scan_file` and `open_session` methods of a
+    Scanner, so it can be passed as the scanner of the middleware or decorator.
+
+    Attributes:
+        - profiles (dict[str, Scanner]): Scanner of each profile, must include `default`
+        - routes (dict[str, str]): Profile name by file type (default: None, every type goes to the profile of the same name)
+        - default (str): Profile for the types without one (default: "default")
+        - routed (dict[str, int]): Files sent to each profile so far
+    """
+
+    def __init__(
+        self,
+        profiles: dict[str, Scanner | Options],
+        routes: dict[str, str] | None = None,
+        default: str = "default",
+    ):
+        if default not in profiles:
+            raise ValueError(f"No {default!r} profile")
+        self.profiles = {
+            name: profile if isinstance(profile, Scanner) else get_scanner(profile)
+            for name, profile in profiles.items()
+        }
+        self.routes = routes or {}
+        self.default = default
+        self.routed = {name: 0 for name in self.profiles}
+
+    def profile_for(self, head: bytes) -> str:
+        """Returns the name of the profile for a file starting with `head`."""
+        kind = sniff(head)
+        name = self.routes.get(kind, kind)
+        if name not in self.profiles:
+            name = self.default
+        self.routed[name] += 1
+        hisss.debug(msg=f"Routing {kind} file to the {name!r} profile.")
+        return name
+
+    async def route(self, file: ScanInput) -> Scanner:
+        """Returns the scanner of the profile for a file."""
+        return self.profiles[self.profile_for(await read_head(file))]
+
+    async def scan_file(self, file: ScanInput) -> bool:
+        """Scans a file with the scanner of its profile.
+
+        Returns:
+            bool: Returns True if file is clean, else False
+        """
+        return await self.scan(file) is Verdict.CLEAN
+
+    async def scan(self, file: ScanInput) -> Verdict:
+        """Scans a file with the scanner of its profile, see Scanner.scan()."""
+        scanner = await self.route(file)
+        return await scanner.scan(file)
+
+    async def open_session(self, size: int | None = None) -> "RoutedSession":
+        """Opens a streaming scan, routed once its first HEAD_SIZE bytes are written."""
+        return RoutedSession(self, size)
+
+    def stats(self) -> dict:
+        """Returns the number of files routed to each profile."""
+        return dict(self.routed)
+
+
+class RoutedSession:
+    """A streaming scan that holds the first bytes back until it knows which profile to use.
+
+    The session of the chosen scanner, and its scheduler slot, is only opened
+    once HEAD_SIZE bytes were written or on `finish`, so ScannerBusy can be
+    raised by `write` as well.
+    """
+
+    def __init__(self, router: ProfileRouter, size: int | None = None):
+        self.router = router
+        self.size = size
+        self.session: ScannerSession | None = None
+        self._head = bytearray()
+
+    async def _open(self) -> ScannerSession:
+        scanner = self.router.profiles[self.router.profile_for(bytes(self._head))]
+        self.session = await scanner.open_session(self.size)
+        head, self._head = self._head, bytearray()
+        if head:
+            await self.session.write(bytes(head))
+        return self.session
+
+    async def write(self, chunk: bytes) -> None:
+        if self.session is not None:
+            await self.session.write(chunk)
+            return
+        self._head += chunk
+        if len(self._head) >= HEAD_SIZE:
+            await self._open()
+
+    async def finish(self) -> Verdict:
+        session = self.session if self.session is not None else await self._open()
+        return await session.finish()
+
+    async def abort(self) -> None:
+        if self.session is not None:
+            await self.session.abort()
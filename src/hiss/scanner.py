@@ -1,108 +1,998 @@
-"""Contains the ClamAVScanner class, which handles the actual scanning and database update functionality"""
+"""Contains the Scanner class, which handles the actual scanning and database update functionality"""
 
 import asyncio
-import inspect
+import collections
+import contextlib
+import hashlib
+import os
+import threading
+import time
+from typing import AsyncIterable, AsyncIterator, Awaitable, Callable, Iterable
+import mmap
 from io import BytesIO
 
+from hiss.allowlist import TrustedHashes
+from hiss.batch import BatchScan
+from hiss.breaker import CircuitBreaker
+from hiss.cache import SharedVerdictCache, VerdictCache, sha256_digest
+from hiss.engines import ClamscanEngine, Engine, Verdict
+from hiss.engines.base import (
+    ScanSession,
+    file_size,
+    open_item,
+    signature_version,
+)
+from hiss import metrics, tracing
 from hiss.logger import Hisss
 from .update import FreshClam
 from hiss.options import ScannerOptions as Options
+from hiss.signatures import HashIndex
 from starlette.datastructures import UploadFile
 
 hisss = Hisss()
 
+ScanInput = (
+    BytesIO
+    | UploadFile
+    | bytes
+    | bytearray
+    | memoryview
+    | mmap.mmap
+    | str
+    | os.PathLike
+)
+
+
+class ScannerBusy(Exception):
+    """Raised when a scan is not admitted, because the wait queue is full or its deadline passed.
+
+    Attributes:
+        - retry_after (float): Seconds the client should wait before retrying
+    """
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class ScanScheduler:
+    """Process-wide admission control for scans.
+
+    At most `max_concurrency` scans hold a slot at once. Further scans wait in a
+    FIFO queue of at most `max_queue` entries for up to `queue_timeout`
+    seconds. A scan arriving at a full queue, or waiting past its deadline,
+    raises ScannerBusy straight away so the request can be answered with a
+    429/503 instead of piling up. Waiters are woken through their own event
+    loop, so one scheduler can be shared by scanners on different loops.
+
+    Attributes:
+        - max_concurrency (int): Scans running at the same time (default: number of CPUs)
+        - max_queue (int): Scans allowed to wait for a slot (default: 64)
+        - queue_timeout (float): Seconds a scan may wait for a slot (default: 30)
+        - retry_after (float): Seconds suggested to rejected clients (default: 1)
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int | None = None,
+        max_queue: int = 64,
+        queue_timeout: float = 30,
+        retry_after: float = 1,
+    ):
+        self.max_concurrency = max_concurrency or os.cpu_count() or 1
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self._active = 0
+        self._waiters: collections.deque[asyncio.Future] = collections.deque()
+        self._lock = threading.Lock()
+
+    @property
+    def active(self) -> int:
+        """The number of scans holding a slot."""
+        return self._active
+
+    @property
+    def queue_depth(self) -> int:
+        """The number of scans waiting for a slot."""
+        return len(self._waiters)
+
+    async def acquire(
+        self, timeout: float | None = None, size: int | None = None
+    ) -> None:
+        """Waits for a slot, for at most `timeout` seconds (default: `queue_timeout`).
+
+        Args:
+            timeout (float): Seconds to wait for a slot (default: `queue_timeout`)
+            size (int): Size of the file to scan in bytes, if known. Pass the same to `release`.
+
+        Raises:
+            ScannerBusy: If the queue is full or no slot freed up in time.
+        """
+        with self._lock:
+            if self._can_take(size):
+                self._take(size)
+                metrics.ACTIVE_SCANS.inc()
+                self._admit(0.0)
+                return
+            waiters = self._queue(size)
+            if len(waiters) >= self._queue_limit(size):
+                self.rejected += 1
+                metrics.ADMISSIONS.inc(result="rejected")
+                raise ScannerBusy("Scan queue is full", self.retry_after)
+            waiter = asyncio.get_running_loop().create_future()
+            waiters.append(waiter)
+            metrics.QUEUE_DEPTH.inc()
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(
+                asyncio.shield(waiter),
+                self.queue_timeout if timeout is None else timeout,
+            )
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            with self._lock:
+                handed_over = waiter not in waiters
+                if not handed_over:
+                    waiters.remove(waiter)
+                    metrics.QUEUE_DEPTH.dec()
+            if handed_over:
+                # A slot was handed to us just as we gave up, pass it on
+                self.release(size)
+            if isinstance(e, asyncio.TimeoutError):
+                with self._lock:
+                    self.timed_out += 1
+                metrics.ADMISSIONS.inc(result="timed_out")
+                raise ScannerBusy("Timed out waiting for a scan slot", self.retry_after)
+            raise
+        with self._lock:
+            self._admit(time.monotonic() - started)
+
+    def _admit(self, waited: float) -> None:
+        self.admitted += 1
+        self.wait_seconds_total += waited
+        self.wait_seconds_max = max(self.wait_seconds_max, waited)
+        metrics.ADMISSIONS.inc(result="admitted")
+        metrics.QUEUE_WAIT_SECONDS.observe(waited)
+
+    def _can_take(self, size: int | None) -> bool:
+        return self._active < self.max_concurrency and not self._waiters
+
+    def _take(self, size: int | None) -> None:
+        self._active += 1
+
+    def _queue(self, size: int | None) -> collections.deque[asyncio.Future]:
+        return self._waiters
+
+    def _queue_limit(self, size: int | None) -> int:
+        return self.max_queue
+
+    def _free(self, size: int | None) -> None:
+        self._active -= 1
+
+    def _next_waiter(self) -> tuple[asyncio.Future, int | None] | None:
+        """Pops the waiter the next free slot goes to, with the size it waits for."""
+        if self._active < self.max_concurrency and self._waiters:
+            return self._waiters.popleft(), None
+        return None
+
+    def release(self, size: int | None = None) -> None:
+        """Frees a slot, handing it straight to the next waiter if there is one."""
+        with self._lock:
+            self._free(size)
+            metrics.ACTIVE_SCANS.dec()
+            while (next_waiter := self._next_waiter()) is not None:
+                waiter, waiter_size = next_waiter
+                metrics.QUEUE_DEPTH.dec()
+                if not waiter.done():
+                    self._take(waiter_size)
+                    metrics.ACTIVE_SCANS.inc()
+                    waiter.get_loop().call_soon_threadsafe(_set_waiter, waiter)
+
+    @contextlib.asynccontextmanager
+    async def slot(
+        self, timeout: float | None = None, size: int | None = None
+    ) -> AsyncIterator[None]:
+        await self.acquire(timeout, size)
+        try:
+            yield
+        finally:
+            self.release(size)
+
+    def stats(self) -> dict:
+        """Returns the current load and the admission counters."""
+        return {
+            "active": self._active,
+            "queue_depth": len(self._waiters),
+            "max_concurrency": self.max_concurrency,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "wait_seconds_total": self.wait_seconds_total,
+            "wait_seconds_max": self.wait_seconds_max,
+        }
+
+
+class SizeAwareScheduler(ScanScheduler):
+    """A ScanScheduler with separate lanes for small and large files.
+
+    Files of at least `large_file_size` bytes, and files of unknown size, go to
+    the large lane: they hold at most `max_large` of the slots and wait in their
+    own queue, so the remaining slots always serve small files and a burst of
+    big archives can't hold up small uploads. Small files take any free slot
+    and are served first. So that large scans still make progress under a
+    steady stream of small ones, a free slot goes to a waiting large scan once
+    `small_streak` small scans in a row were preferred over it.
+
+    Attributes:
+        - large_file_size (int): Files of this many bytes or more use the large lane (default: 8MiB)
+        - max_large (int): Slots large files may hold at once (default: half of `max_concurrency`, at least 1)
+        - max_large_queue (int): Large scans allowed to wait for a slot (default: 16)
+        - small_streak (int): Small scans served ahead of a waiting large scan before it gets the next slot (default: 8)
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int | None = None,
+        large_file_size: int = 8 * 1024 * 1024,
+        max_large: int | None = None,
+        max_queue: int = 64,
+        max_large_queue: int = 16,
+        small_streak: int = 8,
+        queue_timeout: float = 30,
+        retry_after: float = 1,
+    ):
+        super().__init__(max_concurrency, max_queue, queue_timeout, retry_after)
+        self.large_file_size = large_file_size
+        self.max_large = max(
+            1, min(max_large or self.max_concurrency // 2, self.max_concurrency)
+        )
+        self.max_large_queue = max_large_queue
+        self.small_streak = small_streak
+        self._large_active = 0
+        self._large_waiters: collections.deque[asyncio.Future] = collections.deque()
+        self._streak = 0
+
+    def is_large(self, size: int | None) -> bool:
+        """True if a file of this size, or of unknown size, uses the large lane."""
+        return size is None or size >= self.large_file_size
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters) + len(self._large_waiters)
+
+    def _can_take(self, size: int | None) -> bool:
+        if self._active >= self.max_concurrency:
+            return False
+        if self.is_large(size):
+            return self._large_active < self.max_large and not self._large_waiters
+        return not self._waiters
+
+    def _take(self, size: int | None) -> None:
+        self._active += 1
+        if self.is_large(size):
+            self._large_active += 1
+
+    def _queue(self, size: int | None) -> collections.deque[asyncio.Future]:
+        return self._large_waiters if self.is_large(size) else self._waiters
+
+    def _queue_limit(self, size: int | None) -> int:
+        return self.max_large_queue if self.is_large(size) else self.max_queue
+
+    def _free(self, size: int | None) -> None:
+        self._active -= 1
+        if self.is_large(size):
+            self._large_active -= 1
+
+    def _next_waiter(self) -> tuple[asyncio.Future, int | None] | None:
+        if self._active >= self.max_concurrency:
+            return None
+        large_ready = bool(self._large_waiters) and self._large_active < self.max_large
+        if self._waiters and not (large_ready and self._streak >= self.small_streak):
+            if large_ready:
+                self._streak += 1
+            return self._waiters.popleft(), 0
+        if large_ready:
+            self._streak = 0
+            return self._large_waiters.popleft(), None
+        return None
+
+    def stats(self) -> dict:
+        return {
+            **super().stats(),
+            "queue_depth": self.queue_depth,
+            "large_active": self._large_active,
+            "large_queue_depth": len(self._large_waiters),
+            "max_large": self.max_large,
+        }
+
+
+def _set_waiter(waiter: asyncio.Future) -> None:
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+_scheduler: ScanScheduler | None = None
+
+
+def get_scheduler() -> ScanScheduler:
+    """Returns the scheduler shared by every Scanner of the process, creating it on first use."""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = ScanScheduler()
+    return _scheduler
+
+
+class ScannerSession:
+    """A streaming scan started with Scanner.open_session().
+
+    When the scanner has a cache, the content is hashed as it streams through
+    and a cached verdict is returned on `finish` without waiting for the engine.
+    With `coalesce`, a session finishing while the same content is already being
+    scanned drops its own engine session and waits for that scan instead.
+    The session holds a scheduler slot from its start until `finish` or `abort`,
+    or until its engine run ends when other sessions share that run.
+    A session left without writes for the scanner's `session_idle_timeout`,
+    e.g. by a stalled upload, is aborted to free that slot, and `finish`
+    then returns TIMEOUT.
+    """
+
+    def __init__(
+        self,
+        scanner: "Scanner",
+        session: ScanSession,
+        slot_size: int | None = None,
+        holds_slot: bool = True,
+    ):
+        self.scanner = scanner
+        self.session = session
+        self.size = 0
+        self._slot_size = slot_size
+        self._digest = hashlib.sha256() if scanner._hashes_content else None
+        index = scanner.hash_index
+        self._hashers = (
+            {algorithm: hashlib.new(algorithm) for algorithm in index.algorithms}
+            if index is not None
+            else {}
+        )
+        self._holds_slot = holds_slot
+        self._slot_in_flight = False
+        # Let through by the breaker, which waits for the outcome
+        self._breaker_call = holds_slot and scanner.breaker is not None
+        self._loop = asyncio.get_running_loop()
+        self._last_write = self._loop.time()
+        # A write held up by the engine's backpressure isn't the client idling
+        self._writing = False
+        self._idle_timer: asyncio.TimerHandle | None = None
+        self._expiry: asyncio.Task | None = None
+        if holds_slot and scanner.session_idle_timeout is not None:
+            self._idle_timer = self._loop.call_later(
+                scanner.session_idle_timeout, self._check_idle
+            )
+
+    def _check_idle(self) -> None:
+        timeout = self.scanner.session_idle_timeout
+        idle = 0 if self._writing else self._loop.time() - self._last_write
+        if idle < timeout:
+            self._idle_timer = self._loop.call_later(timeout - idle, self._check_idle)
+            return
+        self._idle_timer = None
+        self.scanner.timeouts += 1
+        metrics.SCAN_TIMEOUTS.inc(reason="idle")
+        hisss.error(msg=f"Streaming scan idle for {timeout}s, aborting it.")
+        self._expiry = asyncio.ensure_future(self._abort())
+
+    def _stop_watching(self) -> None:
+        if self._idle_timer is not None:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+
+    def _release_slot(self) -> None:
+        if self._breaker_call:
+            self._breaker_call = False
+            self.scanner.breaker.discard()
+        if self._holds_slot:
+            self._holds_slot = False
+            self.scanner.scheduler.release(self._slot_size)
+
+    async def _engine_finish(self) -> Verdict:
+        if not self._breaker_call:
+            return await self.scanner._deadline(self.session.finish(), self.size)
+        self._breaker_call = False
+        return await self.scanner._guarded(self.session.finish(), self.size)
+
+    async def write(self, chunk: bytes) -> None:
+        if self._expiry is not None:
+            return
+        self.size += len(chunk)
+        if self._digest is not None:
+            self._digest.update(chunk)
+        for hasher in self._hashers.values():
+            hasher.update(chunk)
+        self._writing = True
+        try:
+            await self.session.write(chunk)
+        finally:
+            self._writing = False
+            self._last_write = self._loop.time()
+
+    async def finish(self) -> Verdict:
+        self._stop_watching()
+        if self._expiry is not None:
+            await self._expiry
+            return self.scanner._log(Verdict.TIMEOUT)
+        try:
+            with tracing.span("hiss.scan_finish", size=self.size):
+                return await self._finish()
+        finally:
+            if not self._slot_in_flight:
+                self._release_slot()
+
+    async def _finish(self) -> Verdict:
+        digest = self._digest.hexdigest() if self._digest is not None else None
+        trusted = self.scanner.trusted
+        if trusted is not None and trusted.check(digest):
+            metrics.SKIPPED_SCANS.inc(reason="trusted")
+            await self.session.abort()
+            return self.scanner._log(Verdict.CLEAN)
+        index = self.scanner.hash_index
+        if index is not None and index.matches(
+            {algorithm: hasher.digest() for algorithm, hasher in self._hashers.items()},
+            self.size,
+        ):
+            hisss.debug(msg="Known malware hash.")
+            metrics.SKIPPED_SCANS.inc(reason="known_bad")
+            await self.session.abort()
+            return self.scanner._log(Verdict.INFECTED)
+        cache = self.scanner.cache
+        version = None
+        if cache is not None:
+            version = await self.scanner.signature_version()
+            if version is not None:
+                verdict = await self.scanner._cached(digest, version)
+                if verdict is not None:
+                    await self.session.abort()
+                    return self.scanner._log(verdict)
+        if self.scanner.coalesce:
+            finished = False
+
+            async def finish() -> Verdict:
+                nonlocal finished
+                finished = True
+                # The shared scan outlives a cancelled leader, so the slot goes with it
+                self._slot_in_flight = True
+                try:
+                    return await self._engine_finish()
+                finally:
+                    self._release_slot()
+
+            try:
+                verdict = await self.scanner._single_flight(digest, finish)
+            finally:
+                if not finished:
+                    # Another scan of the same content answered for us
+                    await self.session.abort()
+        else:
+            verdict = await self._engine_finish()
+        if version is not None and verdict in (Verdict.CLEAN, Verdict.INFECTED):
+            await cache.store(self.scanner._cache_key(digest), version, verdict)
+        return self.scanner._log(verdict)
+
+    async def abort(self) -> None:
+        self._stop_watching()
+        if self._expiry is not None:
+            await self._expiry
+            return
+        await self._abort()
+
+    async def _abort(self) -> None:
+        try:
+            await self.session.abort()
+        finally:
+            self._release_slot()
+
+
+class ScanGroup:
+    """Runs the scans of one request concurrently and stops at the first file that isn't clean.
+
+    At most `max_concurrency` scans run at once. As soon as one returns a
+    verdict outside `accept`, or is refused by the scheduler, the others still
+    in flight are cancelled and no new ones start.
+
+    Attributes:
+        - max_concurrency (int): Scans allowed to run at the same time (default: 4)
+        - accept (set[Verdict]): Verdicts that let the request through, e.g. UNAVAILABLE too to fail open (default: {CLEAN})
+        - results (list[tuple[str, Verdict]]): The (file name, verdict) of every completed scan
+        - busy (ScannerBusy): Set when a scan was refused by the scheduler (default: None)
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 4,
+        accept: set[Verdict] = frozenset({Verdict.CLEAN}),
+    ):
+        self.max_concurrency = max(1, max_concurrency)
+        self.accept = accept
+        self.results: list[tuple[str, Verdict]] = []
+        self.busy: ScannerBusy | None = None
+        self._pending: set[asyncio.Task] = set()
+
+    @property
+    def rejected(self) -> bool:
+        """True once a scan returned a verdict outside `accept`, or was refused by the scheduler."""
+        return self.busy is not None or any(
+            verdict not in self.accept for _, verdict in self.results
+        )
+
+    @property
+    def unavailable(self) -> bool:
+        """True if a file was rejected only because the engine's circuit breaker is open."""
+        return self.rejected and all(
+            verdict in self.accept or verdict is Verdict.UNAVAILABLE
+            for _, verdict in self.results
+        )
+
+    async def reserve(self) -> None:
+        """Waits until another scan may start."""
+        while len(self._pending) >= self.max_concurrency and not self.rejected:
+            await asyncio.wait(self._pending, return_when=asyncio.FIRST_COMPLETED)
+
+    def start(self, name: str, scan: Awaitable[Verdict]) -> None:
+        """Runs a scan in the background. Call `reserve` first to respect `max_concurrency`."""
+        task = asyncio.ensure_future(scan)
+        task.add_done_callback(lambda task: self._done(name, task))
+        self._pending.add(task)
+
+    async def add(self, name: str, scan: Awaitable[Verdict]) -> None:
+        """Waits for a free slot, then runs the scan in the background."""
+        await self.reserve()
+        if self.rejected:
+            scan.close()
+            return
+        self.start(name, scan)
+
+    def _done(self, name: str, task: asyncio.Task) -> None:
+        self._pending.discard(task)
+        if task.cancelled():
+            return
+        if isinstance(task.exception(), ScannerBusy):
+            self.busy = task.exception()
+        elif task.exception() is not None:
+            hisss.error(msg=f"Scan of {name} failed: {task.exception()!r}")
+            self.results.append((name, Verdict.ERROR))
+        else:
+            self.results.append((name, task.result()))
+        if self.rejected:
+            for pending in self._pending:
+                pending.cancel()
+
+    async def wait(self) -> bool:
+        """Waits for the scans still running. Returns True if every verdict is in `accept`.
+
+        Raises:
+            ScannerBusy: If a scan was refused by the scheduler.
+        """
+        while self._pending:
+            await asyncio.wait(self._pending, return_when=asyncio.FIRST_COMPLETED)
+        if self.busy is not None:
+            raise self.busy
+        return not self.rejected
+
+    async def cancel(self) -> None:
+        """Cancels the scans still running and waits for them to release their engine resources."""
+        pending = list(self._pending)
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+
+
+class _UnavailableSession(ScanSession):
+    """The session handed out while the circuit breaker is open."""
+
+    async def write(self, chunk: bytes) -> None:
+        pass
+
+    async def finish(self) -> Verdict:
+        return Verdict.UNAVAILABLE
+
+
+class _Flight:
+    """A scan in progress, shared by every caller scanning the same content."""
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+        # The caller that started the scan, and whose input it reads, stopped waiting
+        self.leader_left = False
+
 
 class Scanner:
     """Scanner class for scanning files for malware.
 
     Attributes:
-        - options (ClamAVScannerOptions): The options/flags to pass to the scanner (default: ClamAVScannerOptions())
+        - options (ScannerOptions): The options/flags to pass to clamscan (default: ScannerOptions())
+        - engine (Engine): The backend doing the actual scanning, e.g. a ClamdEngine (default: ClamscanEngine built from `options`)
+        - cache (VerdictCache | SharedVerdictCache): Optional cache of verdicts by content hash, per process or shared by all workers on the host (default: None)
+        - version_refresh (float): Seconds between signature version checks used to invalidate the cache (default: 60)
+        - scheduler (ScanScheduler): Limits the scans running at once (default: get_scheduler(), shared by the whole process)
+        - coalesce (bool): Hash the content, and let concurrent scans of identical content share one engine run (default: False)
+        - hash_index (HashIndex): Rejects files matching a known malware hash before they reach the engine (default: None)
+        - trusted (TrustedHashes): Accepts files whose SHA-256 is on this allowlist without scanning them (default: None)
+        - scan_timeout (float): Seconds an engine scan may take before it is killed and TIMEOUT returned, None to wait forever. Keep it above clamd's/clamscan's own `max_scantime` (default: 300)
+        - breaker (CircuitBreaker): Refuses engine scans with UNAVAILABLE while the engine keeps failing (default: None)
+        - session_idle_timeout (float): Seconds a streaming session may go without a write before it is aborted and its slot freed, None to wait forever (default: 30)
+        - timeouts (int): Scans that ran past `scan_timeout`, or sessions idle past `session_idle_timeout`, so far
+        - coalesced (int): Scans answered by another scan of the same content so far
     """
 
     def __init__(
         self,
         options: Options = Options(),
+        engine: Engine | None = None,
+        cache: VerdictCache | SharedVerdictCache | None = None,
+        version_refresh: float = 60,
+        scheduler: ScanScheduler | None = None,
+        coalesce: bool = False,
+        hash_index: HashIndex | None = None,
+        trusted: TrustedHashes | None = None,
+        scan_timeout: float | None = 300,
+        breaker: CircuitBreaker | None = None,
+        session_idle_timeout: float | None = 30,
     ):
-        self.options = options.build_command_list()
+        if engine is None:
+            self.options = options.build_command_list()
+            engine = ClamscanEngine(self.options)
+        else:
+            self.options = None
+        self.engine = engine
+        self.cache = cache
+        # Verdicts depend on the engine's settings, e.g. whether archives are unpacked
+        self._cache_namespace = hashlib.sha256(
+            f"{engine.name}\0{engine.settings}".encode()
+        ).hexdigest()[:16]
+        self.version_refresh = version_refresh
+        self.scheduler = scheduler if scheduler is not None else get_scheduler()
+        self.coalesce = coalesce
+        self.hash_index = hash_index
+        self.trusted = trusted
+        self.scan_timeout = scan_timeout
+        self.breaker = breaker
+        if breaker is not None and breaker.name is None:
+            breaker.name = engine.name
+        self.session_idle_timeout = session_idle_timeout
+        self.timeouts = 0
+        self.coalesced = 0
+        self._inflight: dict[str, _Flight] = {}
+        self._signature_version: str | None = None
+        self._version_checked = 0.0
+        FreshClam().add_listener(self._on_database_update)
 
-    async def scan_file(self, file: BytesIO):
-        """Scans a BytesIO object for malware.
+    async def scan_file(self, file: ScanInput) -> bool:
+        """Scans a file-like object, buffer or path for malware.
 
         Args:
-            file (BytesIO | UploadFile): The BytesIO object containing the file to scan.
+            file (BytesIO | UploadFile | bytes | memoryview | mmap | str | PathLike): The file to scan.
 
         Returns:
             bool: Returns True if file is clean, else False
         """
+        return await self.scan(file) is Verdict.CLEAN
 
-        if inspect.iscoroutinefunction(file.seek):
-            return await self._scan_upload_file(file)
+    async def scan(self, file: ScanInput) -> Verdict:
+        """Scans a file-like object, buffer or path for malware.
 
+        The data is streamed to the engine in chunks, or handed over as a
+        zero-copy view, so no full-size copy of it is made. File-like
+        objects are left at an unspecified position, rewind them before reuse.
+
+        Args:
+            file (BytesIO | UploadFile | bytes | memoryview | mmap | str | PathLike): The file to scan.
+
+        Returns:
+            Verdict: The verdict of the engine, or of the cache when the content was seen before.
+
+        Raises:
+            ScannerBusy: If the scheduler has no slot for the scan.
+        """
+        with tracing.span("hiss.scan", backend=self.engine.name):
+            with contextlib.ExitStack() as owner:
+                return await self._scan(owner.enter_context(open_item(file)), owner)
+
+    @property
+    def _hashes_content(self) -> bool:
+        return self.cache is not None or self.coalesce or self.trusted is not None
+
+    async def _scan(self, file, owner: contextlib.ExitStack | None = None) -> Verdict:
+        verdict, digest, version = await self._shortcut(file)
+        if verdict is not None:
+            return self._log(verdict)
+        if self.coalesce:
+            verdict = await self._single_flight(
+                digest, lambda: self._engine_scan(file), owner
+            )
         else:
-            return await self._scan_non_upload_file(file)
+            verdict = await self._engine_scan(file)
+        await self._remember(digest, version, verdict)
+        return self._log(verdict)
 
-    async def _scan_upload_file(self, file: UploadFile):
-        # Ensure the signature database is up-to-date before scanning
-        await self.update_database()
+    @property
+    def _has_shortcuts(self) -> bool:
+        return self._hashes_content or self.hash_index is not None
 
-        # Add the file path to the command
-        full_command = self.options + ["-"]
+    async def _shortcut(self, file) -> tuple[Verdict | None, str | None, str | None]:
+        """Answers for a file without the engine when the allowlist, the hash index or the cache can.
 
-        process = await asyncio.create_subprocess_exec(
-            *full_command,
-            stdin=asyncio.subprocess.PIPE,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
+        Returns:
+            tuple[Verdict | None, str | None, str | None]: The verdict, None if the engine must scan the file, then the digest and signature version to `_remember` its verdict by.
+        """
+        digest = version = None
+        if self._hashes_content:
+            with tracing.span("hiss.hash"):
+                digest, _ = await sha256_digest(file)
+        if self.trusted is not None and self.trusted.check(digest):
+            metrics.SKIPPED_SCANS.inc(reason="trusted")
+            return Verdict.CLEAN, digest, None
+        if self.hash_index is not None and await self.hash_index.match(file):
+            hisss.debug(msg="Known malware hash.")
+            metrics.SKIPPED_SCANS.inc(reason="known_bad")
+            return Verdict.INFECTED, digest, None
+        if self.cache is not None:
+            version = await self.signature_version()
+            if version is not None:
+                verdict = await self._cached(digest, version)
+                if verdict is not None:
+                    hisss.debug(msg=f"Cached verdict for {digest}: {verdict.value}")
+                    return verdict, digest, None
+        return None, digest, version
 
-        await file.seek(0)
-        stdout, stderr = await process.communicate(await file.read())
-        if stdout:
-            hisss.debug(msg=stdout.decode())
-        if stderr:
-            hisss.debug(msg=stderr.decode())
+    async def _remember(
+        self, digest: str | None, version: str | None, verdict: Verdict
+    ) -> None:
+        if version is not None and verdict in (Verdict.CLEAN, Verdict.INFECTED):
+            await self.cache.store(self._cache_key(digest), version, verdict)
 
-        if process.returncode == 0:
-            hisss.info(msg="No virus detected.")
-            return True
-        elif process.returncode == 1:
-            hisss.warning(msg="Virus detected.")
-            return False
+    def _cache_key(self, digest: str) -> str:
+        """Keys verdicts by content and engine settings, so a lenient profile's CLEAN isn't served to a stricter one."""
+        return f"{self._cache_namespace}:{digest}"
+
+    async def _cached(self, digest: str, version: str) -> Verdict | None:
+        verdict = await self.cache.lookup(self._cache_key(digest), version)
+        if verdict is None:
+            metrics.CACHE_LOOKUPS.inc(result="miss")
         else:
-            hisss.error(msg="Error scanning.")
-            return False
+            metrics.CACHE_LOOKUPS.inc(result="hit")
+            metrics.SKIPPED_SCANS.inc(reason="cache")
+        return verdict
 
-    async def _scan_non_upload_file(self, file: BytesIO):
-        # Ensure the signature database is up-to-date before scanning
-        await self.update_database()
+    async def _engine_scan(self, file) -> Verdict:
+        size = file_size(file)
+        if self.breaker is None:
+            await self._acquire(size)
+            try:
+                return await self._deadline(self.engine.scan(file), size)
+            finally:
+                self.scheduler.release(size)
+        if not self.breaker.allow():
+            return Verdict.UNAVAILABLE
+        try:
+            await self._acquire(size)
+        except BaseException:
+            self.breaker.discard()
+            raise
+        try:
+            return await self._guarded(self.engine.scan(file), size)
+        finally:
+            self.scheduler.release(size)
 
-        # Add the file path to the command
-        full_command = self.options + ["-"]
+    async def _acquire(self, size: int | None) -> None:
+        with tracing.span("hiss.queue", size=size):
+            await self.scheduler.acquire(size=size)
 
-        process = await asyncio.create_subprocess_exec(
-            *full_command,
-            stdin=asyncio.subprocess.PIPE,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
+    async def _guarded(self, scan: Awaitable[Verdict], size: int | None) -> Verdict:
+        """Runs an engine scan under the deadline and reports its outcome to the breaker."""
+        started = time.monotonic()
+        try:
+            verdict = await self._deadline(scan, size)
+        except BaseException:
+            self.breaker.discard()
+            raise
+        self.breaker.record(verdict, time.monotonic() - started)
+        return verdict
+
+    async def _deadline(self, scan: Awaitable[Verdict], size: int | None) -> Verdict:
+        """Awaits an engine scan of a file of `size` bytes for at most `scan_timeout` seconds.
+
+        On timeout the scan is cancelled, which kills the clamscan process or
+        drops the clamd connection, and TIMEOUT is returned. A libclamav scan
+        can't be interrupted and finishes in its worker thread.
+        """
+        started = time.monotonic()
+        try:
+            with tracing.span("hiss.engine", backend=self.engine.name, size=size):
+                verdict = await asyncio.wait_for(scan, self.scan_timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            metrics.SCAN_TIMEOUTS.inc(reason="deadline")
+            hisss.error(msg=f"Scan exceeded its {self.scan_timeout}s deadline.")
+            verdict = Verdict.TIMEOUT
+        if metrics.registry.enabled:
+            backend = self.engine.name
+            metrics.SCAN_SECONDS.observe(
+                time.monotonic() - started,
+                backend=backend,
+                size=metrics.size_class(size),
+            )
+            metrics.SCANNED_BYTES.inc(size or 0, backend=backend)
+        return verdict
+
+    async def _single_flight(
+        self,
+        digest: str,
+        scan: Callable[[], Awaitable[Verdict]],
+        owner: contextlib.ExitStack | None = None,
+    ) -> Verdict:
+        """Joins the scan of `digest` already in flight on this event loop, or starts `scan` as that scan.
+
+        The caller starting the scan hands it `owner`, the stack closing its
+        input, so the input stays open until the scan ends even if that caller
+        is cancelled. The shared scan is cancelled once every caller waiting on
+        it has been cancelled. If it fails after the caller that started it
+        left, e.g. because that caller's upload was closed, the others scan
+        their own input instead.
+        """
+        flight = self._inflight.get(digest)
+        if (
+            flight is not None
+            and not flight.task.done()
+            and flight.task.get_loop() is asyncio.get_running_loop()
+        ):
+            self.coalesced += 1
+            metrics.SKIPPED_SCANS.inc(reason="coalesced")
+            hisss.debug(msg=f"Joining the scan of {digest} already in flight.")
+            leader = False
+        else:
+            flight = self._inflight[digest] = _Flight(asyncio.ensure_future(scan()))
+            flight.task.add_done_callback(lambda _: self._land(digest, flight))
+            if owner is not None:
+                inputs = owner.pop_all()
+                flight.task.add_done_callback(lambda _: inputs.close())
+            leader = True
+        flight.waiters += 1
+        try:
+            verdict = await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            if leader or not flight.leader_left:
+                raise
+            verdict = Verdict.ERROR
+        finally:
+            flight.waiters -= 1
+            if leader and not flight.task.done():
+                flight.leader_left = True
+            if flight.waiters == 0 and not flight.task.done():
+                # Land now: the cancelled task may take a while to unwind,
+                # e.g. while wait_for() waits for the engine on 3.11
+                self._land(digest, flight)
+                flight.task.cancel()
+        if verdict is Verdict.ERROR and not leader and flight.leader_left:
+            hisss.debug(msg=f"Shared scan of {digest} failed, scanning again.")
+            return await scan()
+        return verdict
+
+    def _land(self, digest: str, flight: _Flight) -> None:
+        if self._inflight.get(digest) is flight:
+            del self._inflight[digest]
+
+    def stats(self) -> dict:
+        """Returns the number of coalesced scans, of scans in flight and of timed out scans."""
+        return {
+            "coalesced": self.coalesced,
+            "inflight": len(self._inflight),
+            "timeouts": self.timeouts,
+        }
+
+    def scan_many(
+        self,
+        items: Iterable | AsyncIterable,
+        batch_size: int = 64,
+        concurrency: int = 1,
+    ) -> BatchScan:
+        """Scans many buffers, paths or file-like objects with as few engine calls as possible.
 
-        file.seek(0)
-        stdout, stderr = await process.communicate(file.getvalue())
-        if stdout:
-            hisss.debug(msg=stdout.decode())
-        if stderr:
-            hisss.debug(msg=stderr.decode())
+        Args:
+            items (Iterable | AsyncIterable): The bytes, memoryviews, paths or file-like objects to scan.
+            batch_size (int): Items per engine call, e.g. per clamscan run.
+            concurrency (int): Batches scanned at the same time.
+
+        Returns:
+            BatchScan: An async iterator of (index, verdict) in completion order, with throughput in `stats()`.
+        """
+        return BatchScan(self, items, batch_size, concurrency)
+
+    async def open_session(self, size: int | None = None) -> ScannerSession:
+        """Starts a streaming scan: write() the chunks of a file as they arrive, then finish() for the verdict.
 
-        if process.returncode == 0:
+        Args:
+            size (int): Expected size of the file in bytes, e.g. from Content-Length, used to pick the scheduler lane.
+
+        Raises:
+            ScannerBusy: If the scheduler has no slot for the scan.
+        """
+        if self.breaker is not None and not self.breaker.allow():
+            # Writes go nowhere and finish() answers UNAVAILABLE, without a slot
+            return ScannerSession(self, _UnavailableSession(), size, holds_slot=False)
+        try:
+            await self._acquire(size)
+        except BaseException:
+            if self.breaker is not None:
+                self.breaker.discard()
+            raise
+        try:
+            session = await self.engine.open_session()
+        except BaseException:
+            self.scheduler.release(size)
+            if self.breaker is not None:
+                self.breaker.discard()
+            raise
+        # The session releases the slot on finish or abort
+        return ScannerSession(self, session, size)
+
+    def _log(self, verdict: Verdict) -> Verdict:
+        metrics.VERDICTS.inc(verdict=verdict.value)
+        if verdict is Verdict.CLEAN:
             hisss.info(msg="No virus detected.")
-            return True
-        elif process.returncode == 1:
+        elif verdict is Verdict.INFECTED:
             hisss.warning(msg="Virus detected.")
-            return False
+        elif verdict is Verdict.TIMEOUT:
+            hisss.error(msg="Scan timed out.")
+        elif verdict is Verdict.UNAVAILABLE:
+            hisss.warning(msg="Scan engine unavailable, circuit breaker open.")
         else:
             hisss.error(msg="Error scanning.")
-            return False
+        return verdict
+
+    async def signature_version(self) -> str | None:
+        """Returns the engine's signature database version, re-checked every `version_refresh` seconds."""
+        now = time.monotonic()
+        if (
+            self._signature_version is None
+            or now - self._version_checked > self.version_refresh
+        ):
+            self._signature_version = signature_version(await self.engine.version())
+            self._version_checked = now
+        return self._signature_version
 
     async def update_database(self):
+        """Runs freshclam now if an update is due. Scans don't wait for this, see FreshClam.start()."""
         fresh_clam = FreshClam()
-        await fresh_clam.update()
+        with tracing.span("hiss.update_database"):
+            await fresh_clam.update()
+
+    async def _on_database_update(self):
+        await self.engine.reload(FreshClam().version)
+        # Look the version up again on the next scan so cached verdicts are invalidated
+        self._signature_version = None
+
+    async def close(self):
+        await self.engine.close()
+
+
+_scanners: dict[Options, Scanner] = {}
+
+
+def get_scanner(options: Options = Options()) -> Scanner:
+    """Returns the Scanner shared by everything using these options, creating it on first use.
+
+    The decorator and middleware use this, so requests reuse one long-lived
+    scanner instead of building a new one each time.
+    """
+    scanner = _scanners.get(options)
+    if scanner is None:
+        scanner = _scanners[options] = Scanner(options=options)
+    return scanner
@@ -0,0 +1,341 @@
+"""Contains the HashIndex class, which matches files against ClamAV's hash signatures without running an engine"""
+
+import array
+import asyncio
+import bisect
+import hashlib
+import os
+import tarfile
+import threading
+from typing import IO, Collection, Iterable, Iterator
+
+from hiss.engines.base import item_size, iter_chunks
+from hiss.logger import Hisss
+from hiss.options import ScannerOptions
+from hiss.update import FreshClam
+
+hisss = Hisss()
+
+# Hash signature files: .hdb holds MD5s, .hsb SHA1s and SHA256s
+HASH_EXTENSIONS = (".hdb", ".hsb")
+# False positive lists in the same formats, files matching them are not malware
+ALLOW_EXTENSIONS = (".fp", ".sfp")
+# Names of signatures to disable, one per line, optionally followed by ":<md5>"
+IGNORE_EXTENSIONS = (".ign2",)
+SIGNATURE_EXTENSIONS = HASH_EXTENSIONS + ALLOW_EXTENSIONS + IGNORE_EXTENSIONS
+# Signature containers, a 512 byte header followed by a (compressed) tar archive
+CONTAINER_EXTENSIONS = (".cvd", ".cld")
+CONTAINER_HEADER_SIZE = 512
+# Hash algorithm by hex digest length
+ALGORITHMS = {32: "md5", 40: "sha1", 64: "sha256"}
+# Size field of signatures matching files of any size ("*")
+ANY_SIZE = -1
+
+
+class HashTable:
+    """The digests of one algorithm, sorted by (file size, digest) in two flat arrays."""
+
+    def __init__(self, records: Iterable[tuple[int, bytes]], width: int):
+        records = sorted(records)
+        self.width = width
+        self.sizes = array.array("q", (size for size, _ in records))
+        self.digests = b"".join(digest for _, digest in records)
+
+    def __len__(self) -> int:
+        return len(self.sizes)
+
+    def has_size(self, size: int) -> bool:
+        """True if some signature applies to files of this size."""
+        for candidate in (size, ANY_SIZE):
+            index = bisect.bisect_left(self.sizes, candidate)
+            if index < len(self.sizes) and self.sizes[index] == candidate:
+                return True
+        return False
+
+    def contains(self, digest: bytes, size: int) -> bool:
+        for candidate in (size, ANY_SIZE):
+            lo = bisect.bisect_left(self.sizes, candidate)
+            hi = bisect.bisect_right(self.sizes, candidate, lo)
+            # Binary search the digests of that size
+            while lo < hi:
+                middle = (lo + hi) // 2
+                found = self.digests[middle * self.width : (middle + 1) * self.width]
+                if found == digest:
+                    return True
+                if found < digest:
+                    lo = middle + 1
+                else:
+                    hi = middle
+        return False
+
+
+def _hash_records(lines: Iterable[bytes]) -> Iterator[tuple[str, int, bytes, bytes]]:
+    """Yields the (algorithm, size, digest, name) of each valid hash signature line."""
+    for line in lines:
+        fields = line.strip().split(b":")
+        if len(fields) < 3:
+            continue
+        algorithm = ALGORITHMS.get(len(fields[0]))
+        if algorithm is None:
+            continue
+        try:
+            digest = bytes.fromhex(fields[0].decode("ascii"))
+            size = ANY_SIZE if fields[1] == b"*" else int(fields[1])
+        except ValueError:
+            continue
+        yield algorithm, size, digest, fields[2]
+
+
+def parse_hash_signatures(
+    lines: Iterable[bytes], ignored: Collection[bytes] = frozenset()
+) -> dict[str, list[tuple[int, bytes]]]:
+    """Parses .hdb/.hsb/.fp/.sfp lines ("HashString:FileSize:MalwareName[:FLevel]") into (size, digest) records by algorithm.
+
+    Signatures whose name is in `ignored` are left out.
+    """
+    records: dict[str, list[tuple[int, bytes]]] = {}
+    for algorithm, size, digest, name in _hash_records(lines):
+        if name not in ignored:
+            records.setdefault(algorithm, []).append((size, digest))
+    return records
+
+
+def parse_ignored_names(lines: Iterable[bytes]) -> set[bytes]:
+    """Parses .ign2 lines ("SignatureName[:md5]") into the names of the signatures to disable."""
+    return {name for line in lines if (name := line.strip().split(b":", 1)[0])}
+
+
+def _read_signature_files(path: str) -> Iterator[tuple[str, IO[bytes]]]:
+    """Yields the name and content of the signature files in a plain signature file or a .cvd/.cld container."""
+    if path.endswith(SIGNATURE_EXTENSIONS):
+        with open(path, "rb") as f:
+            yield path, f
+        return
+    with open(path, "rb") as f:
+        f.seek(CONTAINER_HEADER_SIZE)
+        with tarfile.open(fileobj=f, mode="r:*") as archive:
+            for member in archive:
+                if member.isfile() and member.name.endswith(SIGNATURE_EXTENSIONS):
+                    yield member.name, archive.extractfile(member)
+
+
+class _Signatures:
+    """The signatures read from one file of the database, before ignore lists are applied."""
+
+    def __init__(self, path: str):
+        self.records: list[tuple[str, int, bytes, bytes]] = []
+        self.allowed: dict[str, list[tuple[int, bytes]]] = {}
+        self.ignores: set[bytes] = set()
+        for name, f in _read_signature_files(path):
+            if name.endswith(HASH_EXTENSIONS):
+                self.records.extend(_hash_records(f))
+            elif name.endswith(ALLOW_EXTENSIONS):
+                for algorithm, parsed in parse_hash_signatures(f).items():
+                    self.allowed.setdefault(algorithm, []).extend(parsed)
+            else:
+                self.ignores |= parse_ignored_names(f)
+
+
+class _Source:
+    """The hash tables built from one file of the database.
+
+    Attributes:
+        - mtime (float): Modification time of the file when it was read
+        - tables (dict[str, HashTable]): Its malware hashes by algorithm, without the ignored ones
+        - allowed (dict[str, HashTable]): Its false positive hashes by algorithm
+        - ignores (frozenset[bytes]): Names of the signatures its ignore lists disable
+        - ignored (frozenset[bytes]): The names left out of `tables`, from the ignore lists of the whole database
+    """
+
+    def __init__(
+        self, mtime: float, signatures: _Signatures, ignored: frozenset[bytes]
+    ):
+        self.mtime = mtime
+        self.ignores = frozenset(signatures.ignores)
+        self.ignored = ignored
+        records: dict[str, list[tuple[int, bytes]]] = {}
+        for algorithm, size, digest, name in signatures.records:
+            if name not in ignored:
+                records.setdefault(algorithm, []).append((size, digest))
+        self.tables = _tables(records)
+        self.allowed = _tables(signatures.allowed)
+
+
+def _tables(records: dict[str, list[tuple[int, bytes]]]) -> dict[str, HashTable]:
+    return {
+        algorithm: HashTable(parsed, hashlib.new(algorithm).digest_size)
+        for algorithm, parsed in records.items()
+    }
+
+
+def _contains(
+    tables: Iterable[dict[str, HashTable]], algorithm: str, digest: bytes, size: int
+) -> bool:
+    for by_algorithm in tables:
+        table = by_algorithm.get(algorithm)
+        if table is not None and table.contains(digest, size):
+            return True
+    return False
+
+
+class HashIndex:
+    """An in-memory index of the exact-hash signatures in the ClamAV database.
+
+    The .hdb and .hsb signatures, whether loose in the database directory or
+    inside main/daily .cvd/.cld containers, are kept as sorted arrays of
+    digests per file size. A file whose size has no signature is cleared
+    without hashing. Anything else costs one hash and a binary search, so
+    known malware is rejected before an engine ever sees it. Files that don't
+    match still have to be scanned.
+
+    Like ClamAV, the index honours the database's false positive lists
+    (.fp/.sfp), files matching them are never rejected, and drops the
+    signatures named in its ignore lists (.ign2).
+
+    The database is loaded when the index is created, which raises if it
+    can't be read. `refresh` only re-reads the signature files that changed
+    since the last load, and runs whenever FreshClam installs a new database.
+
+    Attributes:
+        - directory (str): The signature database directory (default: None, found with clamconf)
+    """
+
+    def __init__(self, directory: str | None = None):
+        self.directory = directory
+        self._sources: dict[str, _Source] = {}
+        self._lock = threading.Lock()
+        self._load()
+        FreshClam().add_listener(self.refresh)
+
+    def __len__(self) -> int:
+        return sum(
+            len(table)
+            for source in self._sources.values()
+            for table in source.tables.values()
+        )
+
+    @property
+    def algorithms(self) -> set[str]:
+        """The hash algorithms used by the loaded signatures and false positive lists."""
+        return {
+            algorithm
+            for source in self._sources.values()
+            for algorithm in (*source.tables, *source.allowed)
+        }
+
+    async def refresh(self) -> None:
+        """(Re)loads the signature files that changed, off the event loop."""
+        await asyncio.to_thread(self.load)
+
+    def load(self) -> None:
+        """(Re)loads the signature files that changed since the last load, keeping the current index if the database can't be read."""
+        try:
+            self._load()
+        except OSError as e:
+            hisss.error(msg=f"Unable to read the signature database: {e!r}")
+
+    def _load(self) -> None:
+        with self._lock:
+            directory = self.directory or ScannerOptions().get_virus_db_directory()
+            mtimes = {}
+            for name in sorted(os.listdir(directory)):
+                if not name.endswith(SIGNATURE_EXTENSIONS + CONTAINER_EXTENSIONS):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    mtimes[path] = os.stat(path).st_mtime
+                except OSError:
+                    continue
+            sources: dict[str, _Source] = {}
+            read: dict[str, tuple[float, _Signatures]] = {}
+            for path, mtime in mtimes.items():
+                loaded = self._sources.get(path)
+                if loaded is not None and loaded.mtime == mtime:
+                    sources[path] = loaded
+                elif (signatures := self._read(path)) is not None:
+                    read[path] = (mtime, signatures)
+            # Ignore lists apply to the whole database, e.g. local.ign2 to main.cvd
+            ignored = frozenset().union(
+                *(source.ignores for source in sources.values()),
+                *(signatures.ignores for _, signatures in read.values()),
+            )
+            for path, source in list(sources.items()):
+                if source.ignored != ignored:
+                    del sources[path]
+                    if (signatures := self._read(path)) is not None:
+                        read[path] = (source.mtime, signatures)
+            for path, (mtime, signatures) in read.items():
+                sources[path] = _Source(mtime, signatures, ignored)
+            self._sources = sources
+        hisss.info(msg=f"Hash index holds {len(self)} signatures.")
+
+    @staticmethod
+    def _read(path: str) -> _Signatures | None:
+        try:
+            signatures = _Signatures(path)
+        except (OSError, tarfile.TarError) as e:
+            hisss.error(msg=f"Unable to load hash signatures from {path}: {e!r}")
+            return None
+        hisss.debug(msg=f"Loaded {len(signatures.records)} hashes from {path}")
+        return signatures
+
+    def algorithms_for(self, size: int) -> set[str]:
+        """The algorithms with signatures for files of this size, and with false positives to rule out."""
+        algorithms = {
+            algorithm
+            for source in self._sources.values()
+            for algorithm, table in source.tables.items()
+            if table.has_size(size)
+        }
+        if algorithms:
+            algorithms |= {
+                algorithm
+                for source in self._sources.values()
+                for algorithm, table in source.allowed.items()
+                if table.has_size(size)
+            }
+        return algorithms
+
+    def contains(self, algorithm: str, digest: bytes, size: int) -> bool:
+        """True if the digest of a file of this size is a known malware hash."""
+        return _contains(
+            (source.tables for source in self._sources.values()),
+            algorithm,
+            digest,
+            size,
+        )
+
+    def allows(self, algorithm: str, digest: bytes, size: int) -> bool:
+        """True if the digest of a file of this size is on a false positive list."""
+        return _contains(
+            (source.allowed for source in self._sources.values()),
+            algorithm,
+            digest,
+            size,
+        )
+
+    def matches(self, digests: dict[str, bytes], size: int) -> bool:
+        """True if any of the digests of a file of this size is a known malware hash, and none is a false positive."""
+        return any(
+            self.contains(algorithm, digest, size)
+            for algorithm, digest in digests.items()
+        ) and not any(
+            self.allows(algorithm, digest, size)
+            for algorithm, digest in digests.items()
+        )
+
+    async def match(self, file) -> bool:
+        """Hashes a file with the algorithms its size calls for and looks it up."""
+        size = getattr(file, "size", None)  # UploadFile knows its size
+        if size is None:
+            size = item_size(getattr(file, "file", file))
+        algorithms = self.algorithms_for(size)
+        if not algorithms:
+            return False
+        hashers = {algorithm: hashlib.new(algorithm) for algorithm in algorithms}
+        async for chunk in iter_chunks(file):
+            for hasher in hashers.values():
+                hasher.update(chunk)
+        return self.matches(
+            {algorithm: hasher.digest() for algorithm, hasher in hashers.items()}, size
+        )
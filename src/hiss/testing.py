@@ -0,0 +1,253 @@
+"""Contains the FakeClamd class and a stub clamscan, which stand in for ClamAV in tests and benchmarks"""
+
+import array
+import asyncio
+import collections
+import os
+import socket
+import stat
+import struct
+import sys
+
+EICAR = b"X5O!P%@AP[4\\PZX54(P^)7CC)7}$EICAR-STANDARD-ANTIVIRUS-TEST-FILE!$H+H*"
+
+# A clamscan that flags EICAR, reading its input in chunks so memory stays flat
+# whatever the file size. Handles stdin ("-"), paths and --file-list like the real one.
+FAKE_CLAMSCAN = r"""
+import sys
+
+EICAR = %r
+CHUNK_SIZE = 1024 * 1024
+
+
+def infected(file):
+    tail = b""
+    while chunk := file.read(CHUNK_SIZE):
+        data = tail + chunk
+        if EICAR in data:
+            return True
+        tail = data[-(len(EICAR) - 1):]
+    return False
+
+
+args = sys.argv[1:]
+if "--version" in args:
+    print("ClamAV 1.0.0/27000/Mon Jan  1 00:00:00 2024")
+    sys.exit(0)
+paths = [arg for arg in args if not arg.startswith("--")]
+for arg in args:
+    if arg.startswith("--file-list="):
+        with open(arg.split("=", 1)[1]) as f:
+            paths += [line for line in f.read().splitlines() if line]
+code = 0
+for path in paths or ["-"]:
+    if path == "-":
+        name, found = "stdin", infected(sys.stdin.buffer)
+    else:
+        try:
+            with open(path, "rb") as f:
+                name, found = path, infected(f)
+        except OSError as e:
+            print(f"{path}: {e.strerror}. ERROR")
+            code = 2
+            continue
+    if found:
+        print(f"{name}: Eicar-Signature FOUND")
+        code = max(code, 1)
+    else:
+        print(f"{name}: OK")
+sys.exit(code)
+"""
+
+
+def fake_clamscan(directory: str) -> str:
+    """Writes a stub clamscan executable to `directory` and returns its path.
+
+    The stub runs on the current interpreter and answers like clamscan: exit
+    code 1 and a FOUND line when the input contains EICAR, 2 and an ERROR
+    line when a file can't be read, 0 otherwise.
+    """
+    path = os.path.join(directory, "clamscan")
+    with open(path, "w") as f:
+        f.write(f"#!{sys.executable}\n")
+        f.write(FAKE_CLAMSCAN % EICAR)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return path
+
+
+class _EicarMatcher:
+    """Looks for EICAR in data fed chunk by chunk, without keeping more than a signature's worth of it."""
+
+    def __init__(self):
+        self.found = False
+        self._tail = b""
+
+    def feed(self, chunk: bytes) -> None:
+        if not self.found:
+            data = self._tail + chunk
+            self.found = EICAR in data
+            self._tail = data[-(len(EICAR) - 1) :]
+
+
+class FakeClamd:
+    """A minimal clamd speaking the z-prefixed IDSESSION protocol over a unix socket.
+
+    Built on raw sockets rather than streams so descriptors passed with FILDES
+    (SCM_RIGHTS) can be received. Streams are matched chunk by chunk, so large
+    files cost no more memory than small ones, and `latency` seconds are added
+    to every scan to model a slower daemon deterministically.
+
+    Attributes:
+        - socket_path (str): Path of the unix socket to listen on
+        - latency (float): Seconds added to every scan (default: 0)
+        - connections (int): Connections accepted so far
+        - scans (int): Scans answered so far
+        - fildes (int): Scans of a passed descriptor so far
+        - reloads (int): RELOAD commands received so far
+    """
+
+    def __init__(self, socket_path: str, latency: float = 0):
+        self.socket_path = socket_path
+        self.latency = latency
+        self.connections = 0
+        self.scans = 0
+        self.fildes = 0
+        self.reloads = 0
+        self._server: socket.socket | None = None
+        self._tasks: set[asyncio.Task] = set()
+
+    async def start(self):
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(self.socket_path)
+        self._server.listen()
+        self._server.setblocking(False)
+        self._tasks.add(asyncio.ensure_future(self._accept()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._server.close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    async def __aenter__(self) -> "FakeClamd":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.stop()
+
+    async def _accept(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            conn, _ = await loop.sock_accept(self._server)
+            self._tasks.add(asyncio.ensure_future(self._handle(conn)))
+
+    async def _handle(self, conn: socket.socket):
+        self.connections += 1
+        connection = _FakeClamdConnection(conn)
+        request_id = 0
+        session = False
+        try:
+            while True:
+                command = (await connection.read_until(b"\0"))[1:-1]
+                if command == b"IDSESSION":
+                    session = True
+                    continue
+                if command == b"END":
+                    break
+                request_id += 1
+                if command == b"PING":
+                    reply = b"PONG"
+                elif command == b"RELOAD":
+                    self.reloads += 1
+                    reply = b"RELOADING"
+                elif command == b"VERSION":
+                    reply = b"ClamAV 1.0.0/27000/Mon Jan  1 00:00:00 2024"
+                elif command == b"INSTREAM":
+                    matcher = _EicarMatcher()
+                    while length := struct.unpack("!L", await connection.read(4))[0]:
+                        matcher.feed(await connection.read(length))
+                    reply = await self._verdict(b"stream", matcher)
+                elif command == b"FILDES":
+                    await connection.read(1)
+                    fd = connection.fds.popleft()
+                    # Like clamd, read from the start without moving the shared offset
+                    matcher, offset = _EicarMatcher(), 0
+                    try:
+                        while chunk := os.pread(fd, 1024 * 1024, offset):
+                            matcher.feed(chunk)
+                            offset += len(chunk)
+                    finally:
+                        os.close(fd)
+                    self.fildes += 1
+                    reply = await self._verdict(f"fd[{fd}]".encode(), matcher)
+                else:
+                    reply = command + b": Unknown command ERROR"
+                prefix = f"{request_id}: ".encode() if session else b""
+                await connection.write(prefix + reply + b"\0")
+                if not session:
+                    break
+        except (ConnectionError, EOFError):
+            pass
+        finally:
+            conn.close()
+
+    async def _verdict(self, name: bytes, matcher: _EicarMatcher) -> bytes:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.scans += 1
+        if matcher.found:
+            return name + b": Eicar-Signature FOUND"
+        return name + b": OK"
+
+
+class _FakeClamdConnection:
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.fds: collections.deque[int] = collections.deque()
+        self._buffer = bytearray()
+
+    async def _recv(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                data, ancdata, _, _ = self.sock.recvmsg(
+                    65536, socket.CMSG_SPACE(16 * array.array("i").itemsize)
+                )
+                break
+            except BlockingIOError:
+                waiter = loop.create_future()
+                loop.add_reader(self.sock.fileno(), waiter.set_result, None)
+                try:
+                    await waiter
+                finally:
+                    loop.remove_reader(self.sock.fileno())
+        for level, kind, payload in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds = array.array("i")
+                fds.frombytes(payload[: len(payload) - len(payload) % fds.itemsize])
+                self.fds.extend(fds)
+        if not data:
+            raise EOFError
+        self._buffer += data
+
+    async def read_until(self, separator: bytes) -> bytes:
+        while separator not in self._buffer:
+            await self._recv()
+        index = self._buffer.index(separator) + len(separator)
+        data = bytes(self._buffer[:index])
+        del self._buffer[:index]
+        return data
+
+    async def read(self, size: int) -> bytes:
+        while len(self._buffer) < size:
+            await self._recv()
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    async def write(self, data: bytes):
+        await asyncio.get_running_loop().sock_sendall(self.sock, data)
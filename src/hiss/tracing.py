@@ -0,0 +1,87 @@
+"""Contains the tracing hooks, which time each phase of an upload scan"""
+
+import contextlib
+import time
+from typing import Any, Callable, ContextManager
+
+Hook = Callable[[str, dict[str, Any]], ContextManager]
+
+_hooks: list[Hook] = []
+# Handed out while no hook is registered, so a traced phase costs one list check
+_NO_SPAN = contextlib.nullcontext()
+
+
+def add_hook(hook: Hook) -> None:
+    """Registers a hook called as `hook(phase, attributes)` at the start of every phase.
+
+    The hook returns a context manager, which is exited when the phase ends,
+    with the exception if it failed.
+    """
+    _hooks.append(hook)
+
+
+def remove_hook(hook: Hook) -> None:
+    _hooks.remove(hook)
+
+
+def span(phase: str, **attributes: Any) -> ContextManager:
+    """Returns a context manager covering one phase, entered by every registered hook."""
+    if not _hooks:
+        return _NO_SPAN
+    return _span(phase, attributes)
+
+
+@contextlib.contextmanager
+def _span(phase: str, attributes: dict[str, Any]):
+    with contextlib.ExitStack() as stack:
+        for hook in list(_hooks):
+            stack.enter_context(hook(phase, attributes))
+        yield
+
+
+class TimingHook:
+    """Calls `callback(phase, seconds, attributes)` at the end of every phase.
+
+    Attributes:
+        - callback (Callable[[str, float, dict], None]): Receives the timing of each phase
+    """
+
+    def __init__(self, callback: Callable[[str, float, dict[str, Any]], None]):
+        self.callback = callback
+
+    @contextlib.contextmanager
+    def __call__(self, phase: str, attributes: dict[str, Any]):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.callback(phase, time.perf_counter() - started, attributes)
+
+
+class OpenTelemetryHook:
+    """Emits every phase as an OpenTelemetry span, nested under the current one.
+
+    Needs the opentelemetry-api package (`pip install hiss[otel]`).
+
+    Attributes:
+        - tracer (Tracer): The tracer spans are started with (default: the "hiss" tracer of the global provider)
+    """
+
+    def __init__(self, tracer=None):
+        if tracer is None:
+            try:
+                from opentelemetry import trace
+            except ImportError as e:
+                raise ImportError(
+                    "OpenTelemetryHook needs opentelemetry-api, install hiss[otel]"
+                ) from e
+            tracer = trace.get_tracer("hiss")
+        self.tracer = tracer
+
+    def __call__(self, phase: str, attributes: dict[str, Any]) -> ContextManager:
+        return self.tracer.start_as_current_span(
+            phase,
+            attributes={
+                name: value for name, value in attributes.items() if value is not None
+            },
+        )
@@ -2,43 +2,368 @@
 
 import asyncio
 import datetime
+import json
+import os
+import random
+import time
+import weakref
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable
+
+from hiss import metrics, tracing
+from hiss.cache import private_directory
 from hiss.logger import Hisss
+from hiss.options import ScannerOptions, discover_virus_db_directory
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
 
 hisss = Hisss()
 
+UpdateListener = Callable[[], Awaitable[None]]
+
+LOCK_FILE = ".hiss-freshclam.lock"
+RECORD_FILE = ".hiss-freshclam.json"
+
+
+def database_version(directory: str) -> str | None:
+    """Reads the signature version from the header of daily.cld/daily.cvd in a database directory."""
+    for name in ("daily.cld", "daily.cvd"):
+        try:
+            with open(os.path.join(directory, name), "rb") as f:
+                header = f.read(512).decode("ascii", errors="replace")
+        except OSError:
+            continue
+        # ClamAV-VDB:<build time>:<version>:<signatures>:...
+        fields = header.split(":")
+        if len(fields) > 2 and fields[0] == "ClamAV-VDB":
+            return fields[2]
+    return None
+
+
+class HostLock:
+    """A non-blocking lock on a file, held by at most one process on the host."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fd: int | None = None
+
+    def acquire(self) -> bool:
+        """Takes the lock if no other process holds it. Returns False otherwise."""
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        except OSError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    def release(self) -> None:
+        if self._fd is None:
+            return
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        else:
+            msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+        os.close(self._fd)
+        self._fd = None
+
 
 class FreshClam:
+    """Keeps the signature database fresh by running `freshclam` in the background.
+
+    FreshClam is a per-process singleton. Call `start()` (or use `lifespan` as the
+    application's lifespan) and every `poll_interval` seconds it checks whether
+    an update is due, which happens every `frequency` seconds give or take
+    `jitter` seconds so hosts don't all hit the mirrors at once. Scans never
+    wait on it: they keep using the current database, and listeners registered
+    with `add_listener` are awaited once a new one is in place so engines can
+    switch over.
+
+    Worker processes on a host coordinate through two files in
+    `state_directory`: a lock file, so only one of them runs freshclam at a
+    time, and a record of when it last ran and which signature version it
+    produced. The other workers skip their own run and pick up the new version
+    from the record. The database directory itself usually belongs to the
+    clamav user, so the files live elsewhere. If `state_directory` can't be
+    written, each worker updates on its own schedule without coordinating.
+
+    Attributes:
+        - frequency (float): Seconds between updates (default: 7200)
+        - jitter (float): Maximum random offset added to or removed from each interval (default: 300)
+        - poll_interval (float): Seconds between two checks by the background refresher (default: 60)
+        - timeout (float): Seconds freshclam may run before it is killed (default: 600)
+        - database (str): The signature database directory (default: None, found with clamconf)
+        - state_directory (str): Directory for the lock file and update record shared by the workers of the host (default: None, cache.private_directory())
+        - last_updated (datetime): When freshclam last completed on this host (default: None)
+        - version (str): The signature version of the current database (default: None)
+    """
+
     def __new__(cls):
         if not hasattr(cls, "instance"):
             cls.instance = super(FreshClam, cls).__new__(cls)
         return cls.instance
 
     def __init__(self):
-        self.frequency = None  # Seconds
+        # __init__ runs on every FreshClam() call, only set up the singleton once
+        if hasattr(self, "frequency"):
+            return
+        self.frequency = 7200  # Seconds
+        self.jitter = 300  # Seconds
+        self.poll_interval = 60  # Seconds
+        self.timeout = 600  # Seconds
+        self.database: str | None = None
+        self.state_directory: str | None = None
         self.last_updated = None
+        self.version: str | None = None
+        self._offset = 0.0
+        self._listeners: list[Callable[[], UpdateListener | None]] = []
+        self._inflight: asyncio.Task | None = None
+        self._refresher: asyncio.Task | None = None
+        self._uncoordinated = False
 
     def _update_required(self) -> bool:
         if self.frequency and self.last_updated:
             now = datetime.datetime.now()
-            next_update = self.last_updated + datetime.timedelta(seconds=self.frequency)
+            next_update = self.last_updated + datetime.timedelta(
+                seconds=self.frequency + self._offset
+            )
             return now > next_update
         elif self.frequency and not self.last_updated:
             return True
         elif not self.frequency:
             return True
 
-    async def _update_clamav(self) -> None:
+    def _set_last_updated(self, last_updated: datetime.datetime) -> None:
+        self.last_updated = last_updated
+        # Draw a new offset for the next interval
+        self._offset = random.uniform(-self.jitter, self.jitter)
+
+    def _database_directory(self) -> str | None:
+        if self.database is None:
+            try:
+                self.database = ScannerOptions().get_virus_db_directory()
+            except (OSError, RuntimeError, ValueError) as e:
+                hisss.debug(msg=f"No database directory: {e!r}")
+                return None
+        return self.database
+
+    def _coordination_directory(self) -> str | None:
+        if self._uncoordinated:
+            return None
+        try:
+            directory = self.state_directory or private_directory()
+            if not os.access(directory, os.W_OK | os.X_OK):
+                raise PermissionError(f"{directory} is not writable")
+        except OSError as e:
+            self._coordinate_without(e)
+            return None
+        return directory
+
+    def _coordinate_without(self, error: OSError) -> None:
+        """Gives up on coordinating with the other workers, logging why once."""
+        if not self._uncoordinated:
+            self._uncoordinated = True
+            hisss.warning(
+                msg=f"Unable to coordinate updates with other workers, updating alone: {error!r}"
+            )
+
+    def _read_record(self) -> dict:
+        directory = self._coordination_directory()
+        if directory is None:
+            return {}
+        try:
+            with open(os.path.join(directory, RECORD_FILE)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_record(self) -> None:
+        directory = self._coordination_directory()
+        if directory is None:
+            return
+        path = os.path.join(directory, RECORD_FILE)
+        record = {
+            "last_updated": self.last_updated.timestamp(),
+            "version": self.version,
+            "pid": os.getpid(),
+        }
+        # Write then rename, so readers never see a half written record
+        try:
+            with open(f"{path}.{os.getpid()}", "w") as f:
+                json.dump(record, f)
+            os.replace(f"{path}.{os.getpid()}", path)
+        except OSError as e:
+            self._coordinate_without(e)
+
+    async def _sync_with_host(self) -> None:
+        """Adopts an update another process on this host has completed."""
+        record = self._read_record()
+        if not record:
+            return
+        last_updated = datetime.datetime.fromtimestamp(record["last_updated"])
+        if self.last_updated is None or last_updated > self.last_updated:
+            self._set_last_updated(last_updated)
+        version = record.get("version")
+        if version is not None and version != self.version:
+            previous = self.version
+            self._set_version(version)
+            if previous is not None:
+                hisss.info(msg=f"Signature database updated to version {version}.")
+                await self._notify()
+
+    def _set_version(self, version: str | None) -> None:
+        self.version = version
+        if version is not None and version.isdigit():
+            metrics.SIGNATURE_VERSION.set(int(version))
+
+    def add_listener(self, listener: UpdateListener) -> None:
+        """Registers a coroutine function awaited after each database update.
+
+        Bound methods are held weakly, so registering a short-lived object does not keep it alive.
+        """
+        if hasattr(listener, "__self__"):
+            self._listeners.append(weakref.WeakMethod(listener))
+        else:
+            self._listeners.append(lambda: listener)
+
+    async def _notify(self) -> None:
+        alive = []
+        for ref in self._listeners:
+            listener = ref()
+            if listener is None:
+                continue
+            alive.append(ref)
+            try:
+                await listener()
+            except Exception as e:
+                hisss.error(msg=f"Database update listener failed: {e!r}")
+        self._listeners = alive
+
+    async def _update_clamav(self) -> bool:
+        """Runs freshclam. Returns True if a new database was downloaded."""
         command = ["freshclam"]  # TODO Add flag methods for customization
-        process = await asyncio.create_subprocess_exec(*command)
-        stdout, stderr = await process.communicate()
-        await process.wait()
+        if self.database is not None:
+            command.append(f"--datadir={self.database}")
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), self.timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            raise
         if stdout:
             hisss.info(msg=stdout.decode())
         if stderr:
             hisss.info(msg=stderr.decode())
+        # freshclam exits with 0 after an update and 1 when already up-to-date
+        if process.returncode not in (0, 1):
+            raise RuntimeError(f"freshclam exited with {process.returncode}")
+        return process.returncode == 0
+
+    async def _run_update(self) -> None:
+        await self._sync_with_host()
+        if not self._update_required():
+            return
+        coordination = self._coordination_directory()
+        lock = HostLock(os.path.join(coordination, LOCK_FILE)) if coordination else None
+        if lock is not None:
+            try:
+                acquired = lock.acquire()
+            except OSError as e:
+                self._coordinate_without(e)
+                lock, acquired = None, True
+            if not acquired:
+                hisss.debug(msg="freshclam is already running in another process.")
+                return
+        try:
+            # Another process may have finished just before we took the lock
+            await self._sync_with_host()
+            if not self._update_required():
+                return
+            hisss.info(msg="Updating!")
+            started = time.monotonic()
+            try:
+                with tracing.span("hiss.freshclam"):
+                    updated = await self._update_clamav()
+            except BaseException:
+                metrics.UPDATES.inc(result="failed")
+                raise
+            finally:
+                metrics.UPDATE_SECONDS.observe(time.monotonic() - started)
+            metrics.UPDATES.inc(result="updated" if updated else "current")
+            self._set_last_updated(datetime.datetime.now())
+            directory = self._database_directory()
+            if directory is not None:
+                self._set_version(database_version(directory) or self.version)
+            self._write_record()
+        finally:
+            if lock is not None:
+                lock.release()
+        if updated:
+            await self._notify()
 
     async def update(self) -> None:
-        hisss.info(msg="Updating!")
-        if self._update_required():
-            await self._update_clamav()
-            self.last_updated = datetime.datetime.now()
+        """Runs freshclam if an update is due and no other process on the host is running it.
+
+        Concurrent calls share a single run instead of starting their own.
+        """
+        if self._inflight is not None and not self._inflight.done():
+            if self._inflight.get_loop() is not asyncio.get_running_loop():
+                # Already running on another event loop, nothing to wait on here
+                return
+            return await asyncio.shield(self._inflight)
+        self._inflight = asyncio.ensure_future(self._run_update())
+        await asyncio.shield(self._inflight)
+
+    async def _refresh_forever(self) -> None:
+        while True:
+            try:
+                await self.update()
+            except Exception as e:
+                hisss.error(msg=f"Database update failed: {e!r}")
+            await asyncio.sleep(self.poll_interval)
+
+    def start(self) -> None:
+        """Starts refreshing the database in the background on the running event loop."""
+        if self._refresher is None or self._refresher.done():
+            self._refresher = asyncio.get_running_loop().create_task(
+                self._refresh_forever()
+            )
+
+    async def stop(self) -> None:
+        """Stops the background refresher."""
+        if self._refresher is not None:
+            self._refresher.cancel()
+            try:
+                await self._refresher
+            except asyncio.CancelledError:
+                pass
+            self._refresher = None
+
+    @asynccontextmanager
+    async def lifespan(self, app=None):
+        """Runs the refresher for the lifetime of an application, e.g. `FastAPI(lifespan=FreshClam().lifespan)`.
+
+        The database directory is looked up once at startup, off the event loop.
+        """
+        try:
+            await discover_virus_db_directory()
+        except (OSError, RuntimeError, ValueError) as e:
+            hisss.warning(msg=f"Unable to find the database directory: {e!r}")
+        self.start()
+        try:
+            yield
+        finally:
+            await self.stop()
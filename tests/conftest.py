@@ -0,0 +1,40 @@
+import asyncio
+
+import pytest_asyncio
+
+from hiss.engines import Engine, Verdict
+from hiss.engines.base import iter_chunks
+from hiss.testing import EICAR, FakeClamd
+
+
+class FakeEngine(Engine):
+    """An engine that flags EICAR and counts the scans it was asked to do."""
+
+    name = "fake"
+
+    def __init__(
+        self,
+        version: str = "ClamAV 1.0.0/27000/Mon Jan  1 00:00:00 2024",
+        delay: float = 0,
+    ):
+        self.scans = 0
+        self.delay = delay
+        self._version = version
+
+    async def scan(self, file) -> Verdict:
+        self.scans += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        data = b"".join([chunk async for chunk in iter_chunks(file)])
+        return Verdict.INFECTED if EICAR in data else Verdict.CLEAN
+
+    async def version(self) -> str:
+        return self._version
+
+
+@pytest_asyncio.fixture
+async def fake_clamd(tmp_path):
+    clamd = FakeClamd(str(tmp_path / "clamd.sock"))
+    await clamd.start()
+    yield clamd
+    await clamd.stop()
@@ -0,0 +1,87 @@
+# test_allowlist.py
+
+import hashlib
+import os
+
+import pytest
+
+from hiss.allowlist import TrustedHashes, parse_trusted_hashes
+from hiss.engines import Verdict
+from hiss.scanner import Scanner, ScanScheduler
+
+from conftest import FakeEngine
+
+REPORT = b"quarterly report template"
+
+
+def sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def test_parse_trusted_hashes():
+    digests = parse_trusted_hashes(
+        [
+            "# exported reports\n",
+            f"{sha256(REPORT)}  report.pdf\n",
+            "\n",
+            "not-a-digest\n",
+            "abcd\n",
+        ]
+    )
+    assert digests == {hashlib.sha256(REPORT).digest()}
+
+
+def test_trusted_hashes_needs_one_source(tmp_path):
+    with pytest.raises(ValueError):
+        TrustedHashes()
+    with pytest.raises(ValueError):
+        TrustedHashes(tmp_path / "trusted.txt", loader=list)
+
+
+@pytest.mark.asyncio
+async def test_file_is_reloaded_when_it_changes(tmp_path):
+    path = tmp_path / "trusted.txt"
+    path.write_text(sha256(REPORT) + "\n")
+    trusted = TrustedHashes(path)
+    await trusted.refresh()
+    assert sha256(REPORT) in trusted
+    assert sha256(b"other") not in trusted
+
+    path.write_text(sha256(b"other") + "\n")
+    os.utime(path, (1, 1))
+    await trusted.refresh()
+    assert sha256(REPORT) not in trusted
+    assert sha256(b"other") in trusted
+
+    # A failed reload keeps the current digests
+    path.unlink()
+    await trusted.refresh()
+    assert len(trusted) == 1
+
+
+@pytest.mark.asyncio
+async def test_async_loader():
+    async def loader():
+        return [sha256(REPORT)]
+
+    trusted = TrustedHashes(loader=loader)
+    await trusted.refresh()
+    assert sha256(REPORT) in trusted
+
+
+@pytest.mark.asyncio
+async def test_trusted_content_skips_the_engine():
+    trusted = TrustedHashes(loader=lambda: [sha256(REPORT)])
+    await trusted.refresh()
+    engine = FakeEngine()
+    scanner = Scanner(engine=engine, scheduler=ScanScheduler(2), trusted=trusted)
+    assert await scanner.scan(REPORT) is Verdict.CLEAN
+    assert engine.scans == 0
+    assert await scanner.scan(b"unknown upload") is Verdict.CLEAN
+    assert engine.scans == 1
+
+    session = await scanner.open_session()
+    await session.write(REPORT)
+    assert await session.finish() is Verdict.CLEAN
+    assert engine.scans == 1
+    assert trusted.stats() == {"trusted": 1, "bypassed": 2}
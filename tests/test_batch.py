@@ -0,0 +1,113 @@
+from io import BytesIO
+
+import pytest
+from starlette.datastructures import UploadFile
+
+from hiss.batch import MIN_THROUGHPUT
+from hiss.breaker import CircuitBreaker
+from hiss.cache import VerdictCache
+from hiss.engines import ClamscanEngine, Verdict
+from hiss.scanner import ScanScheduler, Scanner
+from hiss.testing import fake_clamscan
+
+from conftest import EICAR, FakeEngine
+
+
+async def collect(batch):
+    return dict([result async for result in batch])
+
+
+@pytest.mark.asyncio
+async def test_scan_many_mixed_items(tmp_path):
+    path = tmp_path / "eicar.txt"
+    path.write_bytes(EICAR)
+    items = [b"hello", memoryview(b"world"), str(path), bytearray(b"!")]
+    scanner = Scanner(engine=FakeEngine(), scheduler=ScanScheduler(4))
+    batch = scanner.scan_many(items, batch_size=3, concurrency=2)
+    verdicts = await collect(batch)
+    assert verdicts == {
+        0: Verdict.CLEAN,
+        1: Verdict.CLEAN,
+        2: Verdict.INFECTED,
+        3: Verdict.CLEAN,
+    }
+    stats = batch.stats()
+    assert stats["files"] == 4
+    assert stats["bytes"] == 11 + len(EICAR)
+    assert stats["infected"] == 1
+    assert stats["files_per_second"] > 0
+
+
+@pytest.mark.asyncio
+async def test_scan_many_async_source():
+    async def source():
+        for i in range(10):
+            yield EICAR if i == 7 else b"x" * i
+
+    engine = FakeEngine()
+    batch = Scanner(engine=engine).scan_many(source(), batch_size=4)
+    verdicts = await collect(batch)
+    assert len(verdicts) == 10
+    assert [i for i, v in verdicts.items() if v is Verdict.INFECTED] == [7]
+    assert engine.scans == 10
+
+
+@pytest.mark.asyncio
+async def test_scan_many_times_out_stuck_batches():
+    scanner = Scanner(engine=FakeEngine(delay=10), scan_timeout=0.01)
+    verdicts = await collect(scanner.scan_many([b"a", b"b", b"c"], batch_size=2))
+    assert verdicts == {0: Verdict.TIMEOUT, 1: Verdict.TIMEOUT, 2: Verdict.TIMEOUT}
+    assert scanner.stats()["timeouts"] == 2
+
+
+@pytest.mark.asyncio
+async def test_scan_many_uses_the_cache_and_upload_files():
+    engine = FakeEngine()
+    scanner = Scanner(engine=engine, cache=VerdictCache())
+    uploads = [UploadFile(BytesIO(b"hello")), UploadFile(BytesIO(EICAR))]
+    assert await collect(scanner.scan_many(uploads)) == {
+        0: Verdict.CLEAN,
+        1: Verdict.INFECTED,
+    }
+    assert engine.scans == 2
+    again = [UploadFile(BytesIO(b"hello")), UploadFile(BytesIO(EICAR))]
+    assert await collect(scanner.scan_many(again)) == {
+        0: Verdict.CLEAN,
+        1: Verdict.INFECTED,
+    }
+    assert engine.scans == 2
+
+
+@pytest.mark.asyncio
+async def test_scan_many_fails_fast_while_the_breaker_is_open():
+    breaker = CircuitBreaker(min_calls=1)
+    breaker.record(Verdict.ERROR, 0)
+    engine = FakeEngine()
+    scanner = Scanner(engine=engine, breaker=breaker)
+    verdicts = await collect(scanner.scan_many([b"a", b"b"]))
+    assert verdicts == {0: Verdict.UNAVAILABLE, 1: Verdict.UNAVAILABLE}
+    assert engine.scans == 0
+
+
+def test_batch_deadline_is_capped():
+    scanner = Scanner(engine=FakeEngine(), scan_timeout=300)
+    batch = scanner.scan_many([])
+    assert batch._deadline(64 * 1024) == 300
+    assert batch._deadline(1024 * MIN_THROUGHPUT) == 1024
+
+
+@pytest.mark.asyncio
+async def test_clamscan_batch_runs_one_process_per_batch(tmp_path, mocker):
+    path = tmp_path / "clean.txt"
+    path.write_bytes(b"clean")
+    engine = ClamscanEngine([fake_clamscan(str(tmp_path)), "--infected"])
+    spawn = mocker.spy(engine, "_spawn")
+    items = [EICAR, str(path), b"hello", str(tmp_path / "missing")]
+    verdicts = await collect(Scanner(engine=engine).scan_many(items, batch_size=8))
+    assert verdicts == {
+        0: Verdict.INFECTED,
+        1: Verdict.CLEAN,
+        2: Verdict.CLEAN,
+        3: Verdict.ERROR,
+    }
+    spawn.assert_not_called()
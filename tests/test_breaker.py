@@ -0,0 +1,119 @@
+# test_breaker.py
+
+import pytest
+from fastapi import FastAPI, File, UploadFile
+from fastapi.testclient import TestClient
+
+from hiss.breaker import BreakerState, CircuitBreaker
+from hiss.engines import Verdict
+from hiss.fastapi.decorators import scan_upload
+from hiss.scanner import Scanner, ScanScheduler
+
+from conftest import FakeEngine
+
+
+class BrokenEngine(FakeEngine):
+    """An engine that fails until it is fixed."""
+
+    def __init__(self):
+        super().__init__()
+        self.broken = True
+
+    async def scan(self, file) -> Verdict:
+        verdict = await super().scan(file)
+        return Verdict.ERROR if self.broken else verdict
+
+
+def test_breaker_opens_on_failure_rate():
+    breaker = CircuitBreaker(failure_rate=0.5, min_calls=4)
+    changes = []
+    breaker.add_listener(lambda old, new: changes.append((old, new)))
+    for verdict in (Verdict.CLEAN, Verdict.ERROR, Verdict.CLEAN):
+        assert breaker.allow()
+        breaker.record(verdict, 0.1)
+    assert breaker.state is BreakerState.CLOSED
+    breaker.record(Verdict.TIMEOUT, 0.1)
+    assert breaker.state is BreakerState.OPEN
+    assert not breaker.allow()
+    assert breaker.retry_after > 0
+    assert changes == [(BreakerState.CLOSED, BreakerState.OPEN)]
+    assert breaker.stats()["rejected"] == 1
+
+
+def test_slow_scans_count_as_failures():
+    breaker = CircuitBreaker(min_calls=2, slow_call_seconds=1)
+    breaker.record(Verdict.CLEAN, 5)
+    breaker.record(Verdict.CLEAN, 5)
+    assert breaker.state is BreakerState.OPEN
+
+
+def test_half_open_probe_recovers_or_reopens():
+    breaker = CircuitBreaker(min_calls=1, open_seconds=0)
+    breaker.record(Verdict.ERROR, 0)
+    assert breaker.state is BreakerState.OPEN
+
+    assert breaker.allow()
+    assert breaker.state is BreakerState.HALF_OPEN
+    # Only one probe at a time
+    assert not breaker.allow()
+    breaker.record(Verdict.ERROR, 0)
+    assert breaker.state is BreakerState.OPEN
+
+    assert breaker.allow()
+    breaker.discard()
+    assert breaker.allow()
+    breaker.record(Verdict.CLEAN, 0)
+    assert breaker.state is BreakerState.CLOSED
+    assert breaker.stats()["half_open_transitions"] == 2
+
+
+@pytest.mark.asyncio
+async def test_scanner_fails_fast_while_open():
+    engine = BrokenEngine()
+    breaker = CircuitBreaker(min_calls=2, open_seconds=60)
+    scanner = Scanner(engine=engine, scheduler=ScanScheduler(2), breaker=breaker)
+    assert await scanner.scan(b"a") is Verdict.ERROR
+    assert await scanner.scan(b"b") is Verdict.ERROR
+    assert await scanner.scan(b"c") is Verdict.UNAVAILABLE
+    assert engine.scans == 2
+
+    session = await scanner.open_session()
+    await session.write(b"d")
+    assert await session.finish() is Verdict.UNAVAILABLE
+    assert scanner.scheduler.active == 0
+    assert engine.scans == 2
+
+    breaker.open_seconds = 0
+    engine.broken = False
+    assert await scanner.scan(b"e") is Verdict.CLEAN
+    assert breaker.state is BreakerState.CLOSED
+
+
+def make_client(fail_open: bool) -> TestClient:
+    breaker = CircuitBreaker(min_calls=1, open_seconds=60)
+    breaker.record(Verdict.ERROR, 0)
+    scanner = Scanner(engine=FakeEngine(), breaker=breaker)
+    app = FastAPI()
+
+    @app.post("/upload")
+    @scan_upload(scanner=scanner, fail_open=fail_open)
+    async def upload(file: UploadFile = File(...)):
+        return {"size": len(await file.read())}
+
+    return TestClient(app)
+
+
+def test_route_fails_closed():
+    response = make_client(fail_open=False).post(
+        "/upload", files={"file": ("a.txt", b"hello")}
+    )
+    assert response.status_code == 503
+    assert 1 <= int(response.headers["Retry-After"]) <= 60
+
+
+def test_route_fails_open():
+    response = make_client(fail_open=True).post(
+        "/upload", files={"file": ("a.txt", b"hello")}
+    )
+    assert response.status_code == 200
+    assert response.json() == {"size": 5}
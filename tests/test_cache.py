@@ -0,0 +1,183 @@
+import os
+import sqlite3
+import tempfile
+from io import BytesIO
+
+import pytest
+
+from hiss.cache import (
+    SharedVerdictCache,
+    VerdictCache,
+    private_directory,
+    sha256_digest,
+)
+from hiss.engines import Verdict
+from hiss.scanner import Scanner
+
+from conftest import EICAR, FakeEngine
+
+
+def test_hit_and_miss():
+    cache = VerdictCache()
+    assert cache.get("a", "1") is None
+    cache.put("a", "1", Verdict.CLEAN)
+    assert cache.get("a", "1") is Verdict.CLEAN
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_lru_eviction_by_entries():
+    cache = VerdictCache(max_entries=2)
+    cache.put("a", "1", Verdict.CLEAN)
+    cache.put("b", "1", Verdict.CLEAN)
+    cache.get("a", "1")
+    cache.put("c", "1", Verdict.CLEAN)
+    assert cache.get("b", "1") is None
+    assert cache.get("a", "1") is Verdict.CLEAN
+    assert cache.evictions == 1
+
+
+def test_eviction_by_bytes():
+    cache = VerdictCache(max_bytes=1000)
+    for i in range(10):
+        cache.put(str(i), "1", Verdict.CLEAN)
+    assert cache.size_bytes <= 1000
+    assert len(cache) < 10
+    assert cache.evictions == 10 - len(cache)
+
+
+def test_ttl_expiry():
+    cache = VerdictCache(ttl=0)
+    cache.put("a", "1", Verdict.CLEAN)
+    assert cache.get("a", "1") is None
+    assert cache.evictions == 1
+
+
+def test_signature_version_change_invalidates():
+    cache = VerdictCache()
+    cache.put("a", "1", Verdict.CLEAN)
+    assert cache.get("a", "2") is None
+    assert len(cache) == 0
+
+
+def test_older_signature_version_misses_without_invalidating():
+    cache = VerdictCache()
+    cache.put("a", "2", Verdict.CLEAN)
+    assert cache.get("a", "1") is None
+    cache.put("b", "1", Verdict.CLEAN)
+    assert cache.get("a", "2") is Verdict.CLEAN
+    assert cache.get("b", "2") is None
+
+
+@pytest.mark.asyncio
+async def test_sha256_digest():
+    digest, size = await sha256_digest(BytesIO(b"hello"))
+    assert digest == "2cf24dba5fb0a30e26e83b2ac5b9e29e1b161e5c1fa7425e73043362938b9824"
+    assert size == 5
+
+
+@pytest.mark.asyncio
+async def test_scanner_serves_repeated_content_from_cache():
+    engine = FakeEngine()
+    scanner = Scanner(engine=engine, cache=VerdictCache())
+    for _ in range(3):
+        assert await scanner.scan_file(BytesIO(b"Test file content")) is True
+        assert await scanner.scan_file(BytesIO(EICAR)) is False
+    assert engine.scans == 2
+    assert scanner.cache.hits == 4
+
+
+@pytest.mark.asyncio
+async def test_cached_verdicts_are_kept_apart_by_engine_settings():
+    class LenientEngine(FakeEngine):
+        # e.g. archives left unpacked, so the malware inside goes unseen
+        settings = "lenient"
+
+        async def scan(self, file) -> Verdict:
+            self.scans += 1
+            return Verdict.CLEAN
+
+    cache = VerdictCache()
+    lenient = Scanner(engine=LenientEngine(), cache=cache)
+    strict = Scanner(engine=FakeEngine(), cache=cache)
+    assert await lenient.scan(BytesIO(EICAR)) is Verdict.CLEAN
+    assert await strict.scan(BytesIO(EICAR)) is Verdict.INFECTED
+    assert len(cache) == 2
+
+
+def test_shared_cache_is_shared_between_instances(tmp_path):
+    path = str(tmp_path / "verdicts.sqlite3")
+    worker_a = SharedVerdictCache(path)
+    worker_b = SharedVerdictCache(path)
+    worker_a.put("a", "1", Verdict.CLEAN)
+    assert worker_b.get("a", "1") is Verdict.CLEAN
+    assert worker_b.hits == 1
+
+
+def test_shared_cache_newer_version_invalidates(tmp_path):
+    path = str(tmp_path / "verdicts.sqlite3")
+    worker_a = SharedVerdictCache(path)
+    worker_b = SharedVerdictCache(path)
+    worker_a.put("a", "1", Verdict.INFECTED)
+    assert worker_b.get("a", "2") is None
+    assert len(worker_a) == 0
+    # A worker still on the old signatures must not repopulate the table
+    worker_a.put("b", "1", Verdict.CLEAN)
+    assert worker_b.get("b", "2") is None
+
+
+def test_shared_cache_trim(tmp_path):
+    cache = SharedVerdictCache(str(tmp_path / "verdicts.sqlite3"), max_entries=5)
+    for i in range(10):
+        cache.put(str(i), "1", Verdict.CLEAN)
+    cache.trim()
+    assert len(cache) == 5
+    assert cache.get("0", "1") is None
+    assert cache.get("9", "1") is Verdict.CLEAN
+
+
+@pytest.mark.asyncio
+async def test_shared_cache_is_used_off_the_event_loop(tmp_path):
+    cache = SharedVerdictCache(str(tmp_path / "verdicts.sqlite3"))
+    await cache.store("a", "1", Verdict.CLEAN)
+    assert await cache.lookup("a", "1") is Verdict.CLEAN
+    assert await cache.lookup("b", "1") is None
+
+
+@pytest.mark.asyncio
+async def test_shared_cache_treats_a_locked_database_as_a_miss(tmp_path):
+    path = str(tmp_path / "verdicts.sqlite3")
+    cache = SharedVerdictCache(path, timeout=0.01)
+    # Another worker holds the write lock
+    other = sqlite3.connect(path, isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    try:
+        await cache.store("a", "1", Verdict.CLEAN)
+        assert await cache.lookup("a", "1") is None
+        engine = FakeEngine()
+        scanner = Scanner(engine=engine, cache=cache)
+        assert await scanner.scan(EICAR) is Verdict.INFECTED
+        assert engine.scans == 1
+    finally:
+        other.execute("ROLLBACK")
+        other.close()
+    assert cache.stats()["errors"] == 4
+    await cache.store("a", "1", Verdict.CLEAN)
+    assert await cache.lookup("a", "1") is Verdict.CLEAN
+
+
+def test_shared_cache_default_path_is_private(tmp_path, monkeypatch):
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    cache = SharedVerdictCache()
+    directory = os.path.dirname(cache.path)
+    assert directory == private_directory()
+    assert os.stat(directory).st_mode & 0o777 == 0o700
+
+
+def test_shared_cache_refuses_a_directory_others_can_write(tmp_path, monkeypatch):
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    directory = tmp_path / f"hiss-{os.getuid()}"
+    directory.mkdir()
+    directory.chmod(0o777)
+    with pytest.raises(PermissionError):
+        SharedVerdictCache()
@@ -0,0 +1,43 @@
+import io
+import mmap
+import tempfile
+
+from hiss.engines.base import BufferReader, item_size, memory_buffer, open_item
+
+
+def test_buffer_reader_does_not_copy():
+    data = bytearray(b"hello world")
+    reader = BufferReader(data)
+    chunk = reader.read(5)
+    data[0:5] = b"HELLO"
+    assert chunk == b"HELLO"
+    assert reader.read() == b" world"
+    assert reader.read() == b""
+    assert reader.seek(0) == 0
+    assert reader.seek(-5, io.SEEK_END) == 6
+
+
+def test_open_item(tmp_path):
+    path = tmp_path / "file.bin"
+    path.write_bytes(b"on disk")
+    with open_item(str(path)) as file:
+        assert file.read() == b"on disk"
+    assert file.closed
+    with mmap.mmap(-1, 4) as mapped:
+        mapped.write(b"mmap")
+        with open_item(mapped) as file:
+            assert bytes(file.read()) == b"mmap"
+        assert item_size(mapped) == 4
+    bytes_io = io.BytesIO(b"x")
+    with open_item(bytes_io) as file:
+        assert file is bytes_io
+
+
+def test_memory_buffer():
+    bytes_io = io.BytesIO(b"in memory")
+    assert memory_buffer(bytes_io) == b"in memory"
+    spooled = tempfile.SpooledTemporaryFile(max_size=4)
+    spooled.write(b"abc")
+    assert memory_buffer(spooled) == b"abc"
+    spooled.write(b"rolled over")
+    assert memory_buffer(spooled) is None
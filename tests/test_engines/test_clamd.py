@@ -0,0 +1,86 @@
+import asyncio
+import tempfile
+from io import BytesIO
+
+import pytest
+
+from hiss.engines import ClamdEngine, Verdict
+from hiss.options import ClamdOptions
+from hiss.scanner import Scanner
+
+from conftest import EICAR
+
+
+@pytest.mark.asyncio
+async def test_ping_and_version(fake_clamd):
+    engine = ClamdEngine(ClamdOptions(socket_path=fake_clamd.socket_path))
+    assert await engine.ping() is True
+    assert (await engine.version()).startswith("ClamAV 1.0.0/27000")
+    await engine.close()
+
+
+@pytest.mark.asyncio
+async def test_scan_verdicts(fake_clamd):
+    engine = ClamdEngine(
+        ClamdOptions(socket_path=fake_clamd.socket_path, chunk_size=16)
+    )
+    assert await engine.scan(BytesIO(b"Test file content")) is Verdict.CLEAN
+    assert await engine.scan(BytesIO(EICAR)) is Verdict.INFECTED
+    await engine.close()
+
+
+@pytest.mark.asyncio
+async def test_connections_are_pooled(fake_clamd):
+    engine = ClamdEngine(ClamdOptions(socket_path=fake_clamd.socket_path, pool_size=2))
+    results = await asyncio.gather(
+        *(engine.scan(BytesIO(b"Test file content")) for _ in range(10))
+    )
+    assert all(result is Verdict.CLEAN for result in results)
+    assert fake_clamd.scans == 10
+    assert fake_clamd.connections <= 2
+    assert engine.pool.size <= 2
+    await engine.close()
+
+
+@pytest.mark.asyncio
+async def test_unreachable_clamd_is_an_error(tmp_path):
+    engine = ClamdEngine(ClamdOptions(socket_path=str(tmp_path / "missing.sock")))
+    assert await engine.ping() is False
+    assert await engine.scan(BytesIO(b"Test file content")) is Verdict.ERROR
+
+
+@pytest.mark.asyncio
+async def test_scanner_with_clamd_engine(fake_clamd):
+    scanner = Scanner(
+        engine=ClamdEngine(ClamdOptions(socket_path=fake_clamd.socket_path))
+    )
+    assert await scanner.scan_file(BytesIO(b"Test file content")) is True
+    assert await scanner.scan_file(BytesIO(EICAR)) is False
+    await scanner.close()
+
+
+@pytest.mark.asyncio
+async def test_spooled_files_are_passed_as_descriptors(fake_clamd):
+    engine = ClamdEngine(ClamdOptions(socket_path=fake_clamd.socket_path))
+    rolled = tempfile.SpooledTemporaryFile(max_size=16)
+    rolled.write(b"x" * 32 + EICAR)
+    in_memory = tempfile.SpooledTemporaryFile(max_size=1024)
+    in_memory.write(b"Test file content")
+    assert await engine.scan(rolled) is Verdict.INFECTED
+    assert fake_clamd.fildes == 1
+    assert await engine.scan(in_memory) is Verdict.CLEAN
+    assert fake_clamd.fildes == 1
+    assert fake_clamd.scans == 2
+    await engine.close()
+
+
+@pytest.mark.asyncio
+async def test_descriptor_passing_can_be_disabled(fake_clamd):
+    engine = ClamdEngine(
+        ClamdOptions(socket_path=fake_clamd.socket_path, fd_passing=False)
+    )
+    with tempfile.TemporaryFile() as file:
+        file.write(EICAR)
+        assert await engine.scan(file) is Verdict.INFECTED
+    assert fake_clamd.fildes == 0
+    await engine.close()
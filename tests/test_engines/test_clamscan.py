@@ -0,0 +1,44 @@
+import asyncio
+from io import BytesIO
+
+import pytest
+
+from hiss.engines import ClamscanEngine, Verdict
+from hiss.testing import EICAR, fake_clamscan
+
+
+@pytest.mark.asyncio
+async def test_scan_signals_end_of_input(tmp_path):
+    # Before 3.12 communicate() left stdin open, so clamscan waited for more input
+    engine = ClamscanEngine([fake_clamscan(str(tmp_path))])
+    verdict = await asyncio.wait_for(engine.scan(BytesIO(b"Test file content")), 10)
+    assert verdict is Verdict.CLEAN
+
+
+@pytest.mark.asyncio
+async def test_session_signals_end_of_input(tmp_path):
+    engine = ClamscanEngine([fake_clamscan(str(tmp_path))])
+    session = await engine.open_session()
+    await session.write(EICAR)
+    assert await asyncio.wait_for(session.finish(), 10) is Verdict.INFECTED
+
+
+@pytest.mark.asyncio
+async def test_cancelled_spawn_kills_the_process(tmp_path, monkeypatch):
+    engine = ClamscanEngine([fake_clamscan(str(tmp_path))])
+    spawned = []
+    create_subprocess_exec = asyncio.create_subprocess_exec
+
+    async def slow_spawn(*args, **kwargs):
+        spawned.append(await create_subprocess_exec(*args, **kwargs))
+        await asyncio.sleep(0.2)
+        return spawned[-1]
+
+    monkeypatch.setattr(asyncio, "create_subprocess_exec", slow_spawn)
+    session = asyncio.ensure_future(engine.open_session())
+    while not spawned:
+        await asyncio.sleep(0.01)
+    session.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await session
+    assert spawned[0].returncode is not None
@@ -0,0 +1,65 @@
+import pytest
+
+from hiss.engines import libclamav
+from hiss.engines.libclamav import LibClamavEngine, LibClamavError
+from hiss.options import ScannerOptions, parse_size
+
+
+def test_parse_size():
+    assert parse_size(1024) == 1024
+    assert parse_size("1024") == 1024
+    assert parse_size("500K") == 500 * 1024
+    assert parse_size("100m") == 100 * 1024 * 1024
+
+
+def test_engine_limits_follow_options():
+    limits = libclamav.engine_limits(
+        ScannerOptions(max_filesize="50M", max_scansize="200M", max_recursion=10)
+    )
+    assert limits[libclamav.CL_ENGINE_MAX_FILESIZE] == 50 * 1024 * 1024
+    assert limits[libclamav.CL_ENGINE_MAX_SCANSIZE] == 200 * 1024 * 1024
+    assert limits[libclamav.CL_ENGINE_MAX_RECURSION] == 10
+    assert limits[libclamav.CL_ENGINE_MAX_SCANTIME] == 120000
+
+
+def test_scan_options_follow_options():
+    defaults = libclamav.scan_options(ScannerOptions())
+    assert defaults.parse & libclamav.CL_SCAN_PARSE_ARCHIVE
+    assert defaults.general & libclamav.CL_SCAN_GENERAL_HEURISTICS
+    assert defaults.heuristic == 0
+
+    custom = libclamav.scan_options(
+        ScannerOptions(scan_archive="no", alert_macros="yes", allmatch=True)
+    )
+    assert not custom.parse & libclamav.CL_SCAN_PARSE_ARCHIVE
+    assert custom.heuristic & libclamav.CL_SCAN_HEURISTIC_MACROS
+    assert custom.general & libclamav.CL_SCAN_GENERAL_ALLMATCHES
+
+
+def test_db_options_follow_options():
+    flags = libclamav.db_options(ScannerOptions(detect_pua="yes", bytecode="no"))
+    assert flags & libclamav.CL_DB_PUA
+    assert not flags & libclamav.CL_DB_PUA_MODE
+    assert not flags & libclamav.CL_DB_BYTECODE
+
+    flags = libclamav.db_options(
+        ScannerOptions(detect_pua="yes", include_pua=["Win.Packer"])
+    )
+    assert flags & libclamav.CL_DB_PUA_MODE
+    assert flags & libclamav.CL_DB_PUA_INCLUDE
+    assert not flags & libclamav.CL_DB_PUA_EXCLUDE
+    # clamav.h: 0x80 PUA_MODE, 0x100 PUA_INCLUDE, 0x200 PUA_EXCLUDE
+    assert flags & 0x380 == 0x180
+
+    flags = libclamav.db_options(
+        ScannerOptions(detect_pua="yes", exclude_pua=["Win.Packer"])
+    )
+    assert flags & 0x380 == 0x280
+    # Not the obsolete CL_DB_CVDNOTMP or the internal CL_DB_OFFICIAL
+    assert not flags & 0x60
+
+
+def test_missing_library(monkeypatch):
+    monkeypatch.setattr(libclamav, "_library", None)
+    with pytest.raises(LibClamavError):
+        LibClamavEngine(library="/nonexistent/libclamav.so")
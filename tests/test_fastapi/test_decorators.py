@@ -0,0 +1,47 @@
+from typing import List
+
+from fastapi import FastAPI, File, UploadFile
+from fastapi.testclient import TestClient
+
+from hiss.fastapi.decorators import scan_upload
+from hiss.scanner import Scanner
+
+from conftest import EICAR, FakeEngine
+
+engine = FakeEngine()
+app = FastAPI()
+
+
+@app.post("/single")
+@scan_upload(scanner=Scanner(engine=engine))
+async def single(file: UploadFile = File(...)):
+    return {"size": len(await file.read())}
+
+
+@app.post("/many")
+@scan_upload(scanner=Scanner(engine=engine), max_concurrency=2)
+async def many(files: List[UploadFile] = File(...)):
+    return {"sizes": [len(await file.read()) for file in files]}
+
+
+client = TestClient(app)
+
+
+def test_single_clean_file():
+    response = client.post("/single", files={"file": ("a.txt", b"hello")})
+    assert response.status_code == 200
+    assert response.json() == {"size": 5}
+
+
+def test_list_of_clean_files():
+    files = [("files", (f"{i}.txt", b"x" * i)) for i in range(1, 6)]
+    response = client.post("/many", files=files)
+    assert response.status_code == 200
+    assert response.json() == {"sizes": [1, 2, 3, 4, 5]}
+
+
+def test_list_with_infected_file():
+    files = [("files", ("a.txt", b"hello")), ("files", ("eicar.txt", EICAR))]
+    response = client.post("/many", files=files)
+    assert response.status_code == 400
+    assert response.json() == {"detail": "File is infected"}
@@ -0,0 +1,259 @@
+import asyncio
+
+import pytest
+from fastapi import FastAPI, File, UploadFile
+from fastapi.testclient import TestClient
+
+from hiss.breaker import CircuitBreaker
+from hiss.fastapi.middleware import FileUploadScanMiddleware
+from hiss.engines import Verdict
+from hiss.scanner import ScanScheduler, Scanner, SizeAwareScheduler
+
+from conftest import EICAR, FakeEngine
+
+BOUNDARY = "hissboundary"
+
+
+def multipart_body(*files: tuple[str, bytes]) -> bytes:
+    body = b""
+    for filename, content in files:
+        body += (
+            f"--{BOUNDARY}\r\n"
+            f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+            "Content-Type: application/octet-stream\r\n\r\n"
+        ).encode()
+        body += content + b"\r\n"
+    body += (
+        f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="note"\r\n\r\nhi\r\n'
+    ).encode()
+    return body + f"--{BOUNDARY}--\r\n".encode()
+
+
+async def send_chunked(middleware, body: bytes, chunk_size: int, result=None):
+    """Sends the body through the middleware in chunks and returns (status, response body).
+
+    If given, `result` is filled with the response headers and the number of messages left unread.
+    """
+    chunks = [body[i : i + chunk_size] for i in range(0, len(body), chunk_size)]
+    messages = [
+        {"type": "http.request", "body": chunk, "more_body": i < len(chunks) - 1}
+        for i, chunk in enumerate(chunks)
+    ]
+    sent = []
+
+    async def receive():
+        await asyncio.sleep(0.001)  # The network, lets background scans run
+        return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "path": "/",
+        "headers": [
+            (b"content-type", f"multipart/form-data; boundary={BOUNDARY}".encode())
+        ],
+    }
+    await middleware(scope, receive, send)
+    if result is not None:
+        result["headers"] = dict(sent[0]["headers"])
+        result["unread"] = len(messages)
+    return sent[0]["status"], b"".join(m.get("body", b"") for m in sent[1:])
+
+
+async def echo_app(scope, receive, send):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": body})
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("chunk_size", [1, 7, 4096])
+async def test_streamed_body_is_scanned_and_replayed(chunk_size):
+    engine = FakeEngine()
+    middleware = FileUploadScanMiddleware(
+        echo_app, scanner=Scanner(engine=engine), spool_max_size=64
+    )
+    body = multipart_body(("a.txt", b"hello" * 100), ("b.txt", b"world"))
+    status, replayed = await send_chunked(middleware, body, chunk_size)
+    assert status == 200
+    assert replayed == body
+    assert engine.scans == 2
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("chunk_size", [1, 13, 4096])
+async def test_infected_part_split_across_chunks(chunk_size):
+    engine = FakeEngine()
+    middleware = FileUploadScanMiddleware(echo_app, scanner=Scanner(engine=engine))
+    body = multipart_body(("clean.txt", b"hello"), ("dirty.txt", EICAR))
+    status, response = await send_chunked(middleware, body, chunk_size)
+    assert status == 400
+    assert response == b"Infected file detected. File upload rejected."
+
+
+def test_fastapi_endpoint_receives_replayed_upload():
+    app = FastAPI()
+    app.add_middleware(FileUploadScanMiddleware, scanner=Scanner(engine=FakeEngine()))
+
+    @app.post("/upload")
+    async def upload(file: UploadFile = File(...)):
+        return {"filename": file.filename, "size": len(await file.read())}
+
+    client = TestClient(app)
+    response = client.post("/upload", files={"file": ("big.bin", b"x" * 300_000)})
+    assert response.status_code == 200
+    assert response.json() == {"filename": "big.bin", "size": 300_000}
+
+
+@pytest.mark.asyncio
+async def test_infected_upload_is_aborted_without_reading_the_rest():
+    engine = FakeEngine()
+    middleware = FileUploadScanMiddleware(echo_app, scanner=Scanner(engine=engine))
+    body = multipart_body(("dirty.txt", EICAR), ("big.bin", b"x" * 100_000))
+    result = {}
+    status, _ = await send_chunked(middleware, body, 1024, result)
+    assert status == 400
+    assert result["headers"][b"connection"] == b"close"
+    assert result["unread"] > 90
+    assert engine.scans == 1
+
+
+@pytest.mark.asyncio
+async def test_infected_upload_is_drained_without_abort():
+    engine = FakeEngine()
+    middleware = FileUploadScanMiddleware(
+        echo_app, scanner=Scanner(engine=engine), abort_on_infection=False
+    )
+    body = multipart_body(("dirty.txt", EICAR), ("big.bin", b"x" * 100_000))
+    result = {}
+    status, _ = await send_chunked(middleware, body, 1024, result)
+    assert status == 400
+    assert b"connection" not in result["headers"]
+    assert result["unread"] == 0
+    assert engine.scans == 1
+
+
+class SlowEngine(FakeEngine):
+    """Tracks how many scans run at the same time."""
+
+    def __init__(self):
+        super().__init__()
+        self.running = 0
+        self.peak = 0
+
+    async def scan(self, file) -> Verdict:
+        self.running += 1
+        self.peak = max(self.peak, self.running)
+        try:
+            await asyncio.sleep(0.05)
+            return await super().scan(file)
+        finally:
+            self.running -= 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("max_concurrency", [1, 3])
+async def test_files_of_a_request_are_scanned_concurrently(max_concurrency):
+    engine = SlowEngine()
+    scanner = Scanner(engine=engine, scheduler=ScanScheduler(max_concurrency=8))
+    middleware = FileUploadScanMiddleware(
+        echo_app, scanner=scanner, max_concurrency=max_concurrency
+    )
+    body = multipart_body(*[(f"{i}.txt", b"hello") for i in range(5)])
+    status, replayed = await send_chunked(middleware, body, 4096)
+    assert status == 200
+    assert replayed == body
+    assert engine.scans == 5
+    assert engine.peak == max_concurrency
+
+
+@pytest.mark.asyncio
+async def test_busy_scheduler_answers_with_retry_after():
+    scheduler = ScanScheduler(max_concurrency=1, max_queue=0, retry_after=2.5)
+    await scheduler.acquire()
+    scanner = Scanner(engine=FakeEngine(), scheduler=scheduler)
+    middleware = FileUploadScanMiddleware(
+        echo_app, scanner=scanner, busy_status_code=429
+    )
+    result = {}
+    status, _ = await send_chunked(
+        middleware, multipart_body(("a.txt", b"hello")), 4096, result
+    )
+    assert status == 429
+    assert result["headers"][b"retry-after"] == b"3"
+    scheduler.release()
+    assert scheduler.active == 0
+
+
+@pytest.mark.asyncio
+async def test_open_breaker_fails_closed_or_open_per_route():
+    breaker = CircuitBreaker(min_calls=1, open_seconds=60)
+    breaker.record(Verdict.ERROR, 0)
+    scanner = Scanner(engine=FakeEngine(), breaker=breaker)
+    body = multipart_body(("a.txt", b"hello"))
+
+    middleware = FileUploadScanMiddleware(echo_app, scanner=scanner)
+    result = {}
+    status, _ = await send_chunked(middleware, body, 4096, result)
+    assert status == 503
+    assert b"retry-after" in result["headers"]
+
+    middleware = FileUploadScanMiddleware(
+        echo_app, scanner=scanner, fail_open=lambda scope: scope["path"] == "/"
+    )
+    status, replayed = await send_chunked(middleware, body, 4096)
+    assert status == 200
+    assert replayed == body
+
+
+@pytest.mark.asyncio
+async def test_parts_are_scheduled_by_their_own_size(mocker):
+    scanner = Scanner(
+        engine=FakeEngine(),
+        scheduler=SizeAwareScheduler(4, large_file_size=200 * 1024),
+    )
+    open_session = mocker.spy(scanner, "open_session")
+    small = [(f"{i}.txt", b"x" * 100 * 1024) for i in range(3)]
+    body = multipart_body(*small, ("empty.txt", b""), ("big.bin", b"y" * 300 * 1024))
+    status, _ = await send_chunked(
+        FileUploadScanMiddleware(echo_app, scanner=scanner), body, 64 * 1024
+    )
+    assert status == 200
+    # The big file is held back only until it outgrows the lookahead, then
+    # sized by the unknown request length, which sends it to the large lane
+    assert [call.args[0] for call in open_session.call_args_list] == [
+        100 * 1024,
+        100 * 1024,
+        100 * 1024,
+        0,
+        None,
+    ]
+
+
+@pytest.mark.asyncio
+async def test_default_scanner_is_resolved_at_startup(monkeypatch):
+    scanner = Scanner(engine=FakeEngine())
+    resolved = []
+
+    def get_scanner():
+        resolved.append(scanner)
+        return scanner
+
+    monkeypatch.setattr("hiss.fastapi.middleware.get_scanner", get_scanner)
+
+    async def app(scope, receive, send):
+        pass
+
+    middleware = FileUploadScanMiddleware(app)
+    assert resolved == []
+    await middleware({"type": "lifespan"}, None, None)
+    assert middleware.scanner is scanner
+    assert len(resolved) == 1
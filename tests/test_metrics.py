@@ -0,0 +1,160 @@
+# test_metrics.py
+
+import asyncio
+
+import pytest
+
+from hiss import metrics
+from hiss.breaker import CircuitBreaker
+from hiss.cache import VerdictCache
+from hiss.engines import Verdict
+from hiss.metrics import MetricsRegistry, metrics_app, size_class
+from hiss.scanner import Scanner, ScanScheduler
+
+from conftest import EICAR, FakeEngine
+
+
+@pytest.fixture
+def enabled():
+    metrics.registry.clear()
+    metrics.registry.enable()
+    yield metrics.registry
+    metrics.registry.disable()
+    metrics.registry.clear()
+
+
+def test_disabled_registry_records_nothing():
+    registry = MetricsRegistry()
+    counter = registry.counter("scans", "Scans", ("verdict",))
+    histogram = registry.histogram("seconds", "Seconds")
+    counter.inc(verdict="clean")
+    histogram.observe(1)
+    assert counter.value(verdict="clean") == 0
+    assert histogram.count() == 0
+    assert registry.render() == ""
+
+
+def test_gauges_track_while_disabled():
+    registry = MetricsRegistry()
+    gauge = registry.gauge("active", "Active")
+    gauge.inc()
+    registry.enable()
+    gauge.dec()
+    assert gauge.value() == 0
+
+
+def test_prometheus_text_format():
+    registry = MetricsRegistry(enabled=True)
+    registry.counter("hiss_scans", "Scans done", ("verdict",)).inc(verdict="clean")
+    registry.gauge("hiss_queue", "Queued").set(3)
+    histogram = registry.histogram("hiss_seconds", "Scan time", buckets=(0.1, 1))
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+    assert registry.render() == (
+        "# HELP hiss_scans_total Scans done\n"
+        "# TYPE hiss_scans_total counter\n"
+        'hiss_scans_total{verdict="clean"} 1\n'
+        "# HELP hiss_queue Queued\n"
+        "# TYPE hiss_queue gauge\n"
+        "hiss_queue 3\n"
+        "# HELP hiss_seconds Scan time\n"
+        "# TYPE hiss_seconds histogram\n"
+        'hiss_seconds_bucket{le="0.1"} 1\n'
+        'hiss_seconds_bucket{le="1"} 2\n'
+        'hiss_seconds_bucket{le="+Inf"} 3\n'
+        "hiss_seconds_sum 5.55\n"
+        "hiss_seconds_count 3\n"
+    )
+
+
+def test_size_class():
+    assert size_class(None) == "unknown"
+    assert size_class(10) == "64KiB"
+    assert size_class(2 * 1024 * 1024) == "16MiB"
+    assert size_class(1024**3) == "large"
+
+
+@pytest.mark.asyncio
+async def test_scans_are_instrumented(enabled):
+    scanner = Scanner(
+        engine=FakeEngine(), scheduler=ScanScheduler(2), cache=VerdictCache()
+    )
+    assert await scanner.scan(b"hello") is Verdict.CLEAN
+    assert await scanner.scan(b"hello") is Verdict.CLEAN
+    assert await scanner.scan(EICAR) is Verdict.INFECTED
+
+    assert metrics.VERDICTS.value(verdict="clean") == 2
+    assert metrics.VERDICTS.value(verdict="infected") == 1
+    assert metrics.CACHE_LOOKUPS.value(result="hit") == 1
+    assert metrics.CACHE_LOOKUPS.value(result="miss") == 2
+    assert metrics.SKIPPED_SCANS.value(reason="cache") == 1
+    assert metrics.SCAN_SECONDS.count(backend="fake", size="64KiB") == 2
+    assert metrics.SCANNED_BYTES.value(backend="fake") == 5 + len(EICAR)
+    assert metrics.ADMISSIONS.value(result="admitted") == 2
+    assert metrics.ACTIVE_SCANS.value() == 0
+
+
+@pytest.mark.asyncio
+async def test_queue_depth_is_tracked(enabled):
+    scheduler = ScanScheduler(1)
+    await scheduler.acquire()
+    waiting = asyncio.ensure_future(scheduler.acquire())
+    await asyncio.sleep(0)
+    assert metrics.QUEUE_DEPTH.value() == 1
+    assert metrics.ACTIVE_SCANS.value() == 1
+    scheduler.release()
+    await waiting
+    assert metrics.QUEUE_DEPTH.value() == 0
+    assert metrics.QUEUE_WAIT_SECONDS.count() == 2
+    scheduler.release()
+    assert metrics.ACTIVE_SCANS.value() == 0
+
+
+@pytest.mark.asyncio
+async def test_metrics_app(enabled):
+    metrics.VERDICTS.inc(verdict="clean")
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    await metrics_app({"type": "http"}, None, send)
+    assert sent[0]["status"] == 200
+    assert 'hiss_verdicts_total{verdict="clean"} 1' in sent[1]["body"].decode()
+
+
+def test_breaker_transitions(enabled):
+    breaker = CircuitBreaker(min_calls=1, open_seconds=0, name="clamd")
+    breaker.record(Verdict.ERROR, 0)
+    assert metrics.BREAKER_STATE.value(breaker="clamd", state="open") == 1
+    assert metrics.BREAKER_STATE.value(breaker="clamd", state="closed") == 0
+    assert breaker.allow()
+    breaker.record(Verdict.CLEAN, 0)
+    assert metrics.BREAKER_STATE.value(breaker="clamd", state="closed") == 1
+    assert metrics.BREAKER_STATE.value(breaker="clamd", state="open") == 0
+    transitions = metrics.BREAKER_TRANSITIONS
+    assert transitions.value(breaker="clamd", previous="closed", state="open") == 1
+    assert transitions.value(breaker="clamd", previous="open", state="half_open") == 1
+    assert transitions.value(breaker="clamd", previous="half_open", state="closed") == 1
+
+
+def test_breakers_are_labelled_by_engine(enabled):
+    breaker = CircuitBreaker(min_calls=1)
+    Scanner(engine=FakeEngine(), scheduler=ScanScheduler(1), breaker=breaker)
+    other = CircuitBreaker(min_calls=1, open_seconds=0, name="clamd")
+    breaker.record(Verdict.ERROR, 0)
+    other.record(Verdict.ERROR, 0)
+    assert other.allow()
+    assert metrics.BREAKER_STATE.value(breaker="fake", state="open") == 1
+    assert metrics.BREAKER_STATE.value(breaker="clamd", state="open") == 0
+    assert metrics.BREAKER_STATE.value(breaker="clamd", state="half_open") == 1
+
+
+@pytest.mark.asyncio
+async def test_scan_timeouts(enabled):
+    scanner = Scanner(
+        engine=FakeEngine(delay=10), scheduler=ScanScheduler(1), scan_timeout=0.01
+    )
+    assert await scanner.scan(b"slow") is Verdict.TIMEOUT
+    assert metrics.SCAN_TIMEOUTS.value(reason="deadline") == 1
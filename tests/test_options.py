@@ -1,7 +1,7 @@
 import pytest
 from pydantic import ValidationError
 
-from hiss.options import ScannerOptions
+from hiss.options import ScannerOptions, discover_virus_db_directory
 import logging
 
 
@@ -472,5 +472,34 @@ def test_get_virus_db_directory(caplog):
     assert db_directory
 
 
+def test_options_are_frozen_and_hashable():
+    options = ScannerOptions(include_pua=["Andr.Tool"])
+    with pytest.raises(ValidationError):
+        options.verbose = True
+    assert hash(options) == hash(ScannerOptions(include_pua=["Andr.Tool"]))
+    assert options == ScannerOptions(include_pua=["Andr.Tool"])
+    assert hash(options) != hash(ScannerOptions())
+
+
+def test_command_list_is_memoized(mocker):
+    options = ScannerOptions(database="/db", max_files=123)
+    first = options.build_command_list()
+    build = mocker.spy(ScannerOptions, "_build_command_list")
+    second = ScannerOptions(database="/db", max_files=123).build_command_list()
+    build.assert_not_called()
+    assert first == second
+    assert first is not second
+    assert options.database == "/db"
+
+
+@pytest.mark.asyncio
+async def test_discover_virus_db_directory(mocker):
+    mocker.patch("hiss.options._virus_db_directory", None)
+    directory = await discover_virus_db_directory()
+    check_output = mocker.patch("subprocess.check_output")
+    assert ScannerOptions().get_virus_db_directory() == directory
+    check_output.assert_not_called()
+
+
 if __name__ == "__main__":
     pytest.main()
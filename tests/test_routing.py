@@ -0,0 +1,92 @@
+# test_routing.py
+
+import io
+import tarfile
+from io import BytesIO
+
+import pytest
+
+from hiss.engines import Verdict
+from hiss.routing import ProfileRouter, sniff
+from hiss.scanner import Scanner, ScanScheduler
+
+from conftest import EICAR, FakeEngine
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 64
+
+
+def tar_archive() -> bytes:
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode="w") as tar:
+        info = tarfile.TarInfo("report.txt")
+        info.size = 4
+        tar.addfile(info, io.BytesIO(b"data"))
+    return archive.getvalue()
+
+
+def test_sniff():
+    assert sniff(PNG) == "image"
+    assert sniff(b"RIFF\x00\x00\x00\x00WEBPVP8 ") == "image"
+    assert sniff(b"RIFF\x00\x00\x00\x00WAVEfmt ") == "other"
+    assert sniff(b"%PDF-1.7\n") == "pdf"
+    assert sniff(b"PK\x03\x04rest") == "archive"
+    assert sniff(tar_archive()) == "archive"
+    assert sniff(b"MZ\x90\x00") == "executable"
+    assert sniff(b"hello") == "other"
+    assert sniff(b"") == "other"
+
+
+def make_router():
+    scheduler = ScanScheduler(4)
+    engines = {name: FakeEngine() for name in ("default", "image", "bulk")}
+    router = ProfileRouter(
+        {
+            name: Scanner(engine=engine, scheduler=scheduler)
+            for name, engine in engines.items()
+        },
+        routes={"archive": "bulk", "executable": "bulk"},
+    )
+    return router, engines
+
+
+@pytest.mark.asyncio
+async def test_files_are_scanned_with_their_profile(tmp_path):
+    router, engines = make_router()
+    path = tmp_path / "upload.zip"
+    path.write_bytes(b"PK\x03\x04" + EICAR)
+
+    assert await router.scan(PNG) is Verdict.CLEAN
+    assert await router.scan(str(path)) is Verdict.INFECTED
+    file = BytesIO(b"plain text")
+    assert await router.scan(file) is Verdict.CLEAN
+    assert await router.scan_file(BytesIO(b"MZ" + EICAR)) is False
+
+    assert {name: engine.scans for name, engine in engines.items()} == {
+        "default": 1,
+        "image": 1,
+        "bulk": 2,
+    }
+    assert router.stats() == {"default": 1, "image": 1, "bulk": 2}
+
+
+@pytest.mark.asyncio
+async def test_sessions_are_routed_on_their_first_bytes():
+    router, engines = make_router()
+    session = await router.open_session()
+    await session.write(PNG[:4])
+    await session.write(PNG[4:] + b"\x00" * 600)
+    assert session.session is not None
+    assert await session.finish() is Verdict.CLEAN
+
+    # Smaller than the sniffed head, routed on finish
+    session = await router.open_session()
+    await session.write(b"PK\x03\x04")
+    await session.write(EICAR)
+    assert await session.finish() is Verdict.INFECTED
+    assert engines["image"].scans == 1
+    assert engines["bulk"].scans == 1
+
+
+def test_router_needs_a_default_profile():
+    with pytest.raises(ValueError):
+        ProfileRouter({"image": Scanner(engine=FakeEngine())})
@@ -3,10 +3,23 @@
 import pytest
 import asyncio
 from io import BytesIO
-from unittest.mock import patch, AsyncMock
-from hiss.scanner import Scanner
+from unittest.mock import patch, AsyncMock, MagicMock
+from hiss.engines import ClamscanEngine, Verdict
+from hiss.engines.base import SpooledSession
+from hiss.options import ScannerOptions as Options
+from hiss.scanner import (
+    ScanGroup,
+    ScanScheduler,
+    Scanner,
+    ScannerBusy,
+    SizeAwareScheduler,
+    file_size,
+    get_scanner,
+)
 from hiss.update import FreshClam
 
+from conftest import EICAR, FakeEngine
+
 
 @pytest.mark.asyncio
 async def test_update_database():
@@ -49,12 +62,13 @@ async def test_scan_file_error():
         "asyncio.create_subprocess_exec", new_callable=AsyncMock
     ) as mock_subprocess:
         mock_process = AsyncMock()
+        mock_process.stdin.write = MagicMock()
         mock_process.communicate.return_value = (b"", b"Some error occurred")
         mock_process.returncode = 2
         mock_subprocess.return_value = mock_process
 
         result = await scanner.scan_file(test_file)
-        mock_update.assert_called_once()
+        mock_update.assert_not_called()
         mock_subprocess.assert_called_once_with(
             *scanner.options + ["-"],
             stdin=asyncio.subprocess.PIPE,
@@ -62,3 +76,319 @@ async def test_scan_file_error():
             stderr=asyncio.subprocess.PIPE,
         )
         assert result is False
+
+
+async def slow_scan(verdict, delay, running):
+    running.append(1)
+    try:
+        await asyncio.sleep(delay)
+        return verdict
+    finally:
+        running.pop()
+
+
+@pytest.mark.asyncio
+async def test_scan_group_bounds_concurrency():
+    group = ScanGroup(max_concurrency=2)
+    running = []
+    peak = 0
+    for i in range(5):
+        await group.add(f"file{i}", slow_scan(Verdict.CLEAN, 0.01, running))
+        peak = max(peak, len(running) + 1)
+    assert await group.wait() is True
+    assert peak <= 3
+    assert len(group.results) == 5
+
+
+@pytest.mark.asyncio
+async def test_scan_group_cancels_on_infection():
+    group = ScanGroup(max_concurrency=4)
+    running = []
+    await group.add("slow", slow_scan(Verdict.CLEAN, 10, running))
+    await group.add("dirty", slow_scan(Verdict.INFECTED, 0.01, running))
+    assert await asyncio.wait_for(group.wait(), 1) is False
+    assert group.results == [("dirty", Verdict.INFECTED)]
+    assert running == []
+
+
+@pytest.mark.asyncio
+async def test_scheduler_limits_running_scans():
+    scheduler = ScanScheduler(max_concurrency=2)
+    running = []
+    peak = 0
+
+    async def scan():
+        nonlocal peak
+        async with scheduler.slot():
+            running.append(1)
+            peak = max(peak, len(running))
+            await asyncio.sleep(0.01)
+            running.pop()
+
+    await asyncio.gather(*[scan() for _ in range(6)])
+    stats = scheduler.stats()
+    assert peak == 2
+    assert stats["admitted"] == 6
+    assert stats["active"] == 0
+    assert stats["queue_depth"] == 0
+    assert stats["wait_seconds_max"] > 0
+
+
+@pytest.mark.asyncio
+async def test_scheduler_rejects_when_queue_is_full():
+    scheduler = ScanScheduler(max_concurrency=1, max_queue=1, retry_after=5)
+    await scheduler.acquire()
+    waiting = asyncio.ensure_future(scheduler.acquire())
+    await asyncio.sleep(0)
+    assert scheduler.queue_depth == 1
+    with pytest.raises(ScannerBusy) as e:
+        await scheduler.acquire()
+    assert e.value.retry_after == 5
+    scheduler.release()
+    await waiting
+    assert scheduler.active == 1
+    assert scheduler.stats()["rejected"] == 1
+
+
+@pytest.mark.asyncio
+async def test_scheduler_deadline():
+    scheduler = ScanScheduler(max_concurrency=1)
+    await scheduler.acquire()
+    with pytest.raises(ScannerBusy):
+        await scheduler.acquire(timeout=0.01)
+    assert scheduler.queue_depth == 0
+    assert scheduler.stats()["timed_out"] == 1
+    scheduler.release()
+    assert scheduler.active == 0
+
+
+@pytest.mark.asyncio
+async def test_small_files_are_not_held_up_by_large_ones():
+    scheduler = SizeAwareScheduler(
+        max_concurrency=2, large_file_size=100, max_large=1, max_large_queue=1
+    )
+    await scheduler.acquire(size=1000)
+    waiting = asyncio.ensure_future(scheduler.acquire(size=None))
+    await asyncio.sleep(0)
+    with pytest.raises(ScannerBusy):
+        await scheduler.acquire(size=500)
+    # The second slot is kept for small files
+    await asyncio.wait_for(scheduler.acquire(size=10), 0.1)
+    stats = scheduler.stats()
+    assert stats["large_active"] == 1
+    assert stats["large_queue_depth"] == 1
+    assert stats["queue_depth"] == 1
+    scheduler.release(1000)
+    await waiting
+    scheduler.release(None)
+    scheduler.release(10)
+    assert scheduler.active == 0
+    assert scheduler.stats()["large_active"] == 0
+
+
+@pytest.mark.asyncio
+async def test_large_files_get_a_slot_after_a_streak_of_small_ones():
+    scheduler = SizeAwareScheduler(max_concurrency=1, small_streak=2)
+    order = []
+
+    async def scan(name, size):
+        async with scheduler.slot(size=size):
+            order.append(name)
+            await asyncio.sleep(0)
+
+    await scheduler.acquire(size=1)
+    tasks = [asyncio.ensure_future(scan("large", None))]
+    await asyncio.sleep(0)
+    tasks += [asyncio.ensure_future(scan(f"small{i}", 1)) for i in range(4)]
+    await asyncio.sleep(0)
+    scheduler.release(1)
+    await asyncio.gather(*tasks)
+    assert order == ["small0", "small1", "large", "small2", "small3"]
+
+
+def test_get_scanner_is_shared_per_options():
+    first = get_scanner(Options(database="/db"))
+    assert get_scanner(Options(database="/db")) is first
+    assert get_scanner(Options(database="/db", max_files=1)) is not first
+
+
+@pytest.mark.asyncio
+async def test_scan_buffers_and_paths(tmp_path):
+    scanner = Scanner()
+    virus_signature = (
+        b"X5O!P%@AP[4\\PZX54(P^)7CC)7}$EICAR-STANDARD-ANTIVIRUS-TEST-FILE!$H+H*"
+    )
+    path = tmp_path / "eicar.txt"
+    path.write_bytes(virus_signature)
+    assert await scanner.scan(b"clean") is Verdict.CLEAN
+    assert await scanner.scan(memoryview(virus_signature)) is Verdict.INFECTED
+    assert await scanner.scan(str(path)) is Verdict.INFECTED
+    assert await scanner.scan(path) is Verdict.INFECTED
+
+
+@pytest.mark.asyncio
+async def test_identical_concurrent_scans_are_coalesced():
+    engine = FakeEngine(delay=0.05)
+    scanner = Scanner(engine=engine, scheduler=ScanScheduler(8), coalesce=True)
+    verdicts = await asyncio.gather(
+        *[scanner.scan(BytesIO(b"same pdf")) for _ in range(5)],
+        scanner.scan(BytesIO(b"another pdf")),
+    )
+    assert all(verdict is Verdict.CLEAN for verdict in verdicts)
+    assert engine.scans == 2
+    assert scanner.stats() == {"coalesced": 4, "inflight": 0, "timeouts": 0}
+
+
+@pytest.mark.asyncio
+async def test_coalesced_scan_is_cancelled_with_its_last_waiter():
+    engine = FakeEngine(delay=10)
+    scanner = Scanner(engine=engine, scheduler=ScanScheduler(8), coalesce=True)
+    tasks = [asyncio.ensure_future(scanner.scan(b"same pdf")) for _ in range(2)]
+    await asyncio.sleep(0.01)
+    tasks[0].cancel()
+    await asyncio.sleep(0.01)
+    assert scanner.stats()["inflight"] == 1
+    tasks[1].cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await asyncio.sleep(0)
+    assert scanner.stats()["inflight"] == 0
+
+
+@pytest.mark.asyncio
+async def test_coalesced_scan_survives_its_leader():
+    engine = FakeEngine(delay=0.05)
+    scanner = Scanner(engine=engine, scheduler=ScanScheduler(8), coalesce=True)
+    leader = asyncio.ensure_future(scanner.scan(EICAR))
+    await asyncio.sleep(0.01)
+    follower = asyncio.ensure_future(scanner.scan(EICAR))
+    await asyncio.sleep(0.01)
+    leader.cancel()
+    assert await follower is Verdict.INFECTED
+    assert engine.scans == 1
+
+
+@pytest.mark.asyncio
+async def test_follower_rescans_when_the_leaders_file_is_closed():
+    engine = FakeEngine(delay=0.05)
+    scanner = Scanner(engine=engine, scheduler=ScanScheduler(8), coalesce=True)
+    upload = BytesIO(b"same pdf")
+    leader = asyncio.ensure_future(scanner.scan(upload))
+    await asyncio.sleep(0.01)
+    follower = asyncio.ensure_future(scanner.scan(BytesIO(b"same pdf")))
+    await asyncio.sleep(0.01)
+    # The leader's request goes away and its upload is closed under the shared scan
+    leader.cancel()
+    upload.close()
+    assert await follower is Verdict.CLEAN
+    assert engine.scans == 2
+
+
+@pytest.mark.asyncio
+async def test_streaming_sessions_are_coalesced():
+    engine = FakeEngine(delay=0.05)
+    scanner = Scanner(engine=engine, scheduler=ScanScheduler(8), coalesce=True)
+
+    async def upload():
+        session = await scanner.open_session()
+        await session.write(b"same ")
+        await session.write(b"pdf")
+        return await session.finish()
+
+    verdicts = await asyncio.gather(*[upload() for _ in range(3)])
+    assert verdicts == [Verdict.CLEAN] * 3
+    assert engine.scans == 1
+    assert scanner.coalesced == 2
+
+
+@pytest.mark.asyncio
+async def test_shared_session_scan_keeps_the_leaders_slot():
+    scheduler = ScanScheduler(2)
+    engine = FakeEngine(delay=0.1)
+    scanner = Scanner(engine=engine, scheduler=scheduler, coalesce=True)
+
+    async def upload():
+        session = await scanner.open_session()
+        await session.write(b"same pdf")
+        return await session.finish()
+
+    leader = asyncio.ensure_future(upload())
+    await asyncio.sleep(0.01)
+    follower = asyncio.ensure_future(upload())
+    await asyncio.sleep(0.01)
+    leader.cancel()
+    await asyncio.sleep(0.01)
+    # The engine still runs the leader's scan for the follower
+    assert scheduler.active == 2
+    assert await follower is Verdict.CLEAN
+    assert scheduler.active == 0
+    assert engine.scans == 1
+
+
+@pytest.mark.asyncio
+async def test_idle_session_frees_the_slot():
+    scheduler = ScanScheduler(1, max_queue=0)
+    scanner = Scanner(
+        engine=FakeEngine(), scheduler=scheduler, session_idle_timeout=0.05
+    )
+    stalled = await scanner.open_session()
+    await stalled.write(b"first chunk, then nothing")
+    await asyncio.sleep(0.1)
+    assert scheduler.active == 0
+    session = await scanner.open_session()
+    await session.write(b"clean")
+    assert await session.finish() is Verdict.CLEAN
+    assert await stalled.finish() is Verdict.TIMEOUT
+    assert scanner.stats()["timeouts"] == 1
+
+
+@pytest.mark.asyncio
+async def test_engine_backpressure_is_not_idleness():
+    class SlowSession(SpooledSession):
+        async def write(self, chunk: bytes) -> None:
+            await asyncio.sleep(0.1)
+            await super().write(chunk)
+
+    class SlowEngine(FakeEngine):
+        async def open_session(self):
+            return SlowSession(self)
+
+    scanner = Scanner(
+        engine=SlowEngine(), scheduler=ScanScheduler(1), session_idle_timeout=0.05
+    )
+    session = await scanner.open_session()
+    await session.write(b"held up ")
+    await session.write(b"by the engine")
+    assert await session.finish() is Verdict.CLEAN
+    assert scanner.stats()["timeouts"] == 0
+
+
+@pytest.mark.asyncio
+async def test_scan_deadline_frees_the_slot():
+    scheduler = ScanScheduler(1)
+    scanner = Scanner(
+        engine=FakeEngine(delay=10), scheduler=scheduler, scan_timeout=0.05
+    )
+    assert await scanner.scan(b"slow") is Verdict.TIMEOUT
+    assert scheduler.active == 0
+    assert scanner.stats()["timeouts"] == 1
+
+
+@pytest.mark.asyncio
+async def test_scan_deadline_kills_clamscan():
+    # A "clamscan" that never answers
+    engine = ClamscanEngine(["sh", "-c", "exec sleep 30"])
+    scanner = Scanner(engine=engine, scheduler=ScanScheduler(1), scan_timeout=0.2)
+    session = await scanner.open_session()
+    await session.write(b"data")
+    assert await session.finish() is Verdict.TIMEOUT
+    assert session.session.process.returncode is not None
+    assert scanner.scheduler.active == 0
+
+
+def test_file_size_of_empty_files(tmp_path):
+    path = tmp_path / "empty"
+    path.write_bytes(b"")
+    assert file_size(b"") == 0
+    assert file_size(BytesIO()) == 0
+    assert file_size(str(path)) == 0
+    assert file_size(str(tmp_path / "missing")) is None
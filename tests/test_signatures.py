@@ -0,0 +1,137 @@
+# test_signatures.py
+
+import hashlib
+import io
+import os
+import tarfile
+
+import pytest
+
+from hiss.engines import Verdict
+from hiss.scanner import Scanner, ScanScheduler
+from hiss.signatures import HashIndex, parse_hash_signatures
+
+from conftest import FakeEngine
+
+MALWARE = b"definitely malware"
+OTHER_MALWARE = b"other malware"
+
+
+def signature(data: bytes, algorithm: str = "md5", size: str | None = None) -> str:
+    digest = hashlib.new(algorithm, data).hexdigest()
+    return f"{digest}:{len(data) if size is None else size}:Test.Malware-1:73\n"
+
+
+def write_cvd(path, members: dict[str, str]):
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode="w:gz") as tar:
+        for name, content in members.items():
+            data = content.encode()
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    header = b"ClamAV-VDB:test".ljust(512, b" ")
+    path.write_bytes(header + archive.getvalue())
+
+
+def test_parse_hash_signatures():
+    records = parse_hash_signatures(
+        [
+            signature(MALWARE).encode(),
+            signature(MALWARE, "sha256", "*").encode(),
+            b"not a signature\n",
+            b"zz:12:Bad.Hex\n",
+        ]
+    )
+    assert records["md5"] == [(len(MALWARE), hashlib.md5(MALWARE).digest())]
+    assert records["sha256"] == [(-1, hashlib.sha256(MALWARE).digest())]
+
+
+@pytest.mark.asyncio
+async def test_index_loads_plain_files_and_containers(tmp_path):
+    (tmp_path / "local.hdb").write_text(signature(MALWARE))
+    write_cvd(
+        tmp_path / "daily.cvd",
+        {"daily.hsb": signature(OTHER_MALWARE, "sha256", "*"), "daily.ndb": "x"},
+    )
+    index = HashIndex(str(tmp_path))
+    await index.refresh()
+    assert len(index) == 2
+    assert index.algorithms == {"md5", "sha256"}
+    assert await index.match(io.BytesIO(MALWARE))
+    assert await index.match(io.BytesIO(OTHER_MALWARE))
+    assert not await index.match(io.BytesIO(b"harmless"))
+    # Same digest, wrong size
+    assert not index.contains("md5", hashlib.md5(MALWARE).digest(), 1)
+
+
+def test_reload_only_reads_changed_files(tmp_path):
+    (tmp_path / "main.hdb").write_text(signature(MALWARE))
+    (tmp_path / "daily.hdb").write_text("")
+    index = HashIndex(str(tmp_path))
+    index.load()
+    main = index._sources[str(tmp_path / "main.hdb")]
+    assert len(index) == 1
+
+    daily = tmp_path / "daily.hdb"
+    daily.write_text(signature(OTHER_MALWARE))
+    os.utime(daily, (1, 1))
+    index.load()
+    assert index._sources[str(tmp_path / "main.hdb")] is main
+    assert len(index) == 2
+    assert index.contains(
+        "md5", hashlib.md5(OTHER_MALWARE).digest(), len(OTHER_MALWARE)
+    )
+
+
+@pytest.mark.asyncio
+async def test_false_positives_are_not_rejected(tmp_path):
+    (tmp_path / "main.hdb").write_text(signature(MALWARE) + signature(OTHER_MALWARE))
+    # Allowlisted by another algorithm than the one flagging it
+    (tmp_path / "local.sfp").write_text(signature(MALWARE, "sha256"))
+    index = HashIndex(str(tmp_path))
+    assert index.algorithms == {"md5", "sha256"}
+    assert not await index.match(io.BytesIO(MALWARE))
+    assert await index.match(io.BytesIO(OTHER_MALWARE))
+
+
+def test_ignore_lists_drop_signatures_across_files(tmp_path):
+    (tmp_path / "main.hdb").write_text(
+        signature(MALWARE).replace("Test.Malware-1", "Test.Ignored-1")
+        + signature(OTHER_MALWARE)
+    )
+    index = HashIndex(str(tmp_path))
+    assert len(index) == 2
+
+    write_cvd(tmp_path / "daily.cvd", {"daily.ign2": "Test.Ignored-1:0123abcd\n"})
+    index.load()
+    assert len(index) == 1
+    assert not index.contains("md5", hashlib.md5(MALWARE).digest(), len(MALWARE))
+
+    os.remove(tmp_path / "daily.cvd")
+    index.load()
+    assert len(index) == 2
+
+
+def test_index_fails_loudly_without_a_database(tmp_path):
+    with pytest.raises(OSError):
+        HashIndex(str(tmp_path / "missing"))
+
+
+@pytest.mark.asyncio
+async def test_scanner_rejects_known_hashes_without_the_engine(tmp_path):
+    (tmp_path / "local.hdb").write_text(signature(MALWARE))
+    index = HashIndex(str(tmp_path))
+    index.load()
+    engine = FakeEngine()
+    scanner = Scanner(engine=engine, scheduler=ScanScheduler(2), hash_index=index)
+    assert await scanner.scan(MALWARE) is Verdict.INFECTED
+    assert engine.scans == 0
+    assert await scanner.scan(b"harmless") is Verdict.CLEAN
+    assert engine.scans == 1
+
+    session = await scanner.open_session()
+    await session.write(MALWARE[:5])
+    await session.write(MALWARE[5:])
+    assert await session.finish() is Verdict.INFECTED
+    assert engine.scans == 1
@@ -0,0 +1,31 @@
+from io import BytesIO
+
+import pytest
+
+from hiss.engines import ClamscanEngine, Verdict
+from hiss.testing import EICAR, fake_clamscan
+
+
+@pytest.mark.asyncio
+async def test_fake_clamscan_flags_eicar(tmp_path):
+    engine = ClamscanEngine([fake_clamscan(str(tmp_path))])
+    assert await engine.scan(BytesIO(b"Test file content")) is Verdict.CLEAN
+    assert await engine.scan(BytesIO(EICAR)) is Verdict.INFECTED
+    assert (await engine.version()).startswith("ClamAV 1.0.0/27000")
+
+
+@pytest.mark.asyncio
+async def test_fake_clamscan_finds_eicar_across_chunks(tmp_path):
+    engine = ClamscanEngine([fake_clamscan(str(tmp_path))])
+    # The signature straddles the stub's 1MiB reads
+    data = b"\0" * (1024 * 1024 - 10) + EICAR
+    assert await engine.scan(BytesIO(data)) is Verdict.INFECTED
+
+
+@pytest.mark.asyncio
+async def test_fake_clamscan_batch(tmp_path):
+    engine = ClamscanEngine([fake_clamscan(str(tmp_path))])
+    verdicts = dict(
+        [item async for item in engine.scan_batch([b"Test file content", EICAR])]
+    )
+    assert verdicts == {0: Verdict.CLEAN, 1: Verdict.INFECTED}
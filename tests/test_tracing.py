@@ -0,0 +1,67 @@
+# test_tracing.py
+
+import contextlib
+
+import pytest
+
+from hiss import tracing
+from hiss.scanner import Scanner, ScanScheduler
+from hiss.tracing import OpenTelemetryHook, TimingHook
+
+from conftest import FakeEngine
+
+
+@pytest.fixture
+def phases():
+    timings = []
+    hook = TimingHook(lambda phase, seconds, attributes: timings.append(phase))
+    tracing.add_hook(hook)
+    yield timings
+    tracing.remove_hook(hook)
+
+
+def test_span_without_hooks_is_a_shared_no_op():
+    assert tracing.span("a") is tracing.span("b", size=1)
+
+
+@pytest.mark.asyncio
+async def test_scan_phases_are_timed(phases):
+    scanner = Scanner(engine=FakeEngine(), scheduler=ScanScheduler(1), coalesce=True)
+    await scanner.scan(b"hello")
+    assert phases == ["hiss.hash", "hiss.queue", "hiss.engine", "hiss.scan"]
+
+
+@pytest.mark.asyncio
+async def test_session_phases_are_timed(phases):
+    scanner = Scanner(engine=FakeEngine(), scheduler=ScanScheduler(1))
+    session = await scanner.open_session()
+    await session.write(b"hello")
+    await session.finish()
+    assert phases == ["hiss.queue", "hiss.engine", "hiss.scan_finish"]
+
+
+class FakeTracer:
+    def __init__(self):
+        self.spans = []
+
+    @contextlib.contextmanager
+    def start_as_current_span(self, name, attributes=None):
+        self.spans.append((name, attributes))
+        yield
+
+
+@pytest.mark.asyncio
+async def test_opentelemetry_hook_starts_spans():
+    tracer = FakeTracer()
+    hook = OpenTelemetryHook(tracer)
+    tracing.add_hook(hook)
+    try:
+        scanner = Scanner(engine=FakeEngine(), scheduler=ScanScheduler(1))
+        await scanner.scan(b"hello")
+    finally:
+        tracing.remove_hook(hook)
+    assert tracer.spans == [
+        ("hiss.scan", {"backend": "fake"}),
+        ("hiss.queue", {"size": 5}),
+        ("hiss.engine", {"backend": "fake", "size": 5}),
+    ]
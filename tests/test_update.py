@@ -0,0 +1,204 @@
+import asyncio
+import datetime
+import json
+import os
+
+import pytest
+
+from hiss.engines import ClamdEngine
+from hiss.options import ClamdOptions
+from hiss.scanner import Scanner
+from hiss.update import (
+    LOCK_FILE,
+    RECORD_FILE,
+    FreshClam,
+    HostLock,
+    database_version,
+    hisss,
+)
+
+
+@pytest.fixture
+def fresh_clam(tmp_path):
+    if hasattr(FreshClam, "instance"):
+        del FreshClam.instance
+    fresh_clam = FreshClam()
+    fresh_clam.database = str(tmp_path)
+    fresh_clam.state_directory = str(tmp_path / "state")
+    os.mkdir(fresh_clam.state_directory)
+    yield fresh_clam
+    del FreshClam.instance
+
+
+def fake_freshclam(mocker, returncode=0, delay=0.0):
+    async def communicate():
+        await asyncio.sleep(delay)
+        return b"", b""
+
+    process = mocker.Mock(returncode=returncode, communicate=communicate)
+    return mocker.patch(
+        "asyncio.create_subprocess_exec", new=mocker.AsyncMock(return_value=process)
+    )
+
+
+def test_singleton_keeps_state(fresh_clam):
+    fresh_clam.last_updated = datetime.datetime.now()
+    assert FreshClam().last_updated is fresh_clam.last_updated
+
+
+@pytest.mark.asyncio
+async def test_update_is_throttled(fresh_clam, mocker):
+    subprocess = fake_freshclam(mocker)
+    await fresh_clam.update()
+    await fresh_clam.update()
+    assert subprocess.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_concurrent_updates_share_one_run(fresh_clam, mocker):
+    subprocess = fake_freshclam(mocker, delay=0.05)
+    await asyncio.gather(*(fresh_clam.update() for _ in range(5)))
+    assert subprocess.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_listeners_only_run_after_new_database(fresh_clam, mocker):
+    calls = []
+
+    async def listener():
+        calls.append(True)
+
+    fresh_clam.add_listener(listener)
+    fake_freshclam(mocker, returncode=1)
+    await fresh_clam.update()
+    assert calls == []
+
+    fresh_clam.last_updated = None
+    os.remove(os.path.join(fresh_clam.state_directory, RECORD_FILE))
+    fake_freshclam(mocker, returncode=0)
+    await fresh_clam.update()
+    assert calls == [True]
+
+
+@pytest.mark.asyncio
+async def test_refresher_runs_in_background(fresh_clam, mocker):
+    discover = mocker.patch(
+        "hiss.update.discover_virus_db_directory",
+        new=mocker.AsyncMock(return_value=fresh_clam.database),
+    )
+    subprocess = fake_freshclam(mocker)
+    async with fresh_clam.lifespan():
+        await asyncio.sleep(0.01)
+        assert fresh_clam._refresher is not None
+    discover.assert_awaited_once()
+    assert subprocess.call_count == 1
+    assert fresh_clam._refresher is None
+
+
+@pytest.mark.asyncio
+async def test_scanner_engine_reloads_after_update(fresh_clam, fake_clamd, mocker):
+    scanner = Scanner(
+        engine=ClamdEngine(ClamdOptions(socket_path=fake_clamd.socket_path))
+    )
+    fake_freshclam(mocker)
+    await fresh_clam.update()
+    assert fake_clamd.reloads == 1
+    await scanner.close()
+
+
+@pytest.mark.asyncio
+async def test_shared_clamd_is_reloaded_once_per_version(
+    fresh_clam, fake_clamd, mocker
+):
+    scanner = Scanner(
+        engine=ClamdEngine(ClamdOptions(socket_path=fake_clamd.socket_path))
+    )
+    fresh_clam.version = "26999"
+    # Another worker ran freshclam and had clamd load version 27000 already
+    with open(os.path.join(fresh_clam.state_directory, RECORD_FILE), "w") as f:
+        json.dump({"last_updated": 0, "version": "27000", "pid": 1}, f)
+    fake_freshclam(mocker, returncode=1)
+    await fresh_clam.update()
+    assert fresh_clam.version == "27000"
+    assert fake_clamd.reloads == 0
+    await scanner.close()
+
+
+def test_database_version(tmp_path):
+    (tmp_path / "daily.cld").write_bytes(
+        b"ClamAV-VDB:14 Jan 2024 07-25 -0500:27155:2051000:90:X:X:raynman:1705235134"
+    )
+    assert database_version(str(tmp_path)) == "27155"
+    assert database_version(str(tmp_path / "missing")) is None
+
+
+def test_host_lock_is_exclusive(tmp_path):
+    path = str(tmp_path / LOCK_FILE)
+    first, second = HostLock(path), HostLock(path)
+    assert first.acquire() is True
+    assert second.acquire() is False
+    first.release()
+    assert second.acquire() is True
+    second.release()
+
+
+@pytest.mark.asyncio
+async def test_update_records_version_for_other_workers(fresh_clam, mocker):
+    fresh_clam_dir = fresh_clam.database
+    with open(os.path.join(fresh_clam_dir, "daily.cld"), "wb") as f:
+        f.write(b"ClamAV-VDB:14 Jan 2024 07-25 -0500:27155:2051000:90")
+    fake_freshclam(mocker)
+    await fresh_clam.update()
+    with open(os.path.join(fresh_clam.state_directory, RECORD_FILE)) as f:
+        record = json.load(f)
+    assert record["version"] == "27155"
+    assert fresh_clam.version == "27155"
+
+
+@pytest.mark.asyncio
+async def test_updates_alone_when_the_state_directory_is_unusable(fresh_clam, mocker):
+    fresh_clam.state_directory = os.path.join(fresh_clam.database, "missing")
+    warning = mocker.spy(hisss, "warning")
+    subprocess = fake_freshclam(mocker)
+    await fresh_clam.update()
+    fresh_clam.last_updated = None
+    await fresh_clam.update()
+    assert subprocess.call_count == 2
+    assert warning.call_count == 1
+    assert not os.path.exists(fresh_clam.state_directory)
+
+
+@pytest.mark.asyncio
+async def test_skips_update_while_another_worker_holds_the_lock(fresh_clam, mocker):
+    subprocess = fake_freshclam(mocker)
+    other_worker = HostLock(os.path.join(fresh_clam.state_directory, LOCK_FILE))
+    assert other_worker.acquire()
+    await fresh_clam.update()
+    assert subprocess.call_count == 0
+    other_worker.release()
+
+
+@pytest.mark.asyncio
+async def test_picks_up_update_from_another_worker(fresh_clam, mocker):
+    subprocess = fake_freshclam(mocker)
+    calls = []
+
+    async def listener():
+        calls.append(fresh_clam.version)
+
+    fresh_clam.add_listener(listener)
+    record_path = os.path.join(fresh_clam.state_directory, RECORD_FILE)
+    with open(record_path, "w") as f:
+        json.dump(
+            {"last_updated": datetime.datetime.now().timestamp(), "version": "1"}, f
+        )
+    await fresh_clam.update()
+    assert fresh_clam.version == "1"
+
+    with open(record_path, "w") as f:
+        json.dump(
+            {"last_updated": datetime.datetime.now().timestamp(), "version": "2"}, f
+        )
+    await fresh_clam.update()
+    assert subprocess.call_count == 0
+    assert calls == ["2"]